@@ -0,0 +1,10 @@
+"""Benchmarks of compactor's hot paths over loopback.
+
+Run every benchmark, or those named, and optionally write the results as
+JSON or compare them with an earlier run:
+
+    $ python -m benchmarks --json before.json
+    $ python -m benchmarks --baseline before.json local_send remote_send
+
+Each benchmark may also be run by itself, e.g. ``python -m benchmarks.local_send``.
+"""
@@ -0,0 +1,42 @@
+from __future__ import print_function
+
+import importlib
+
+from benchmarks.harness import format_result, parser, report
+
+BENCHMARKS = (
+  'local_send',
+  'pids',
+  'remote_send',
+  'protobuf_round_trip',
+  'spawn',
+  'routes',
+  'exit_storm',
+  'inbound',
+  'fairness',
+  'cluster',
+)
+
+
+def main():
+  argparser = parser(importlib.import_module('benchmarks').__doc__)
+  argparser.prog = 'python -m benchmarks'
+  argparser.add_argument(
+      'benchmarks', nargs='*', metavar='BENCHMARK',
+      help='The benchmarks to run, by default all of: %s' % ', '.join(BENCHMARKS))
+  args = argparser.parse_args()
+  for name in args.benchmarks:
+    if name not in BENCHMARKS:
+      argparser.error('Unknown benchmark %r' % name)
+
+  results = []
+  for name in args.benchmarks or BENCHMARKS:
+    module = importlib.import_module('benchmarks.%s' % name)
+    for result in module.run(scale=args.scale):
+      print(format_result(result))
+      results.append(result)
+  report(results, args)
+
+
+if __name__ == '__main__':
+  main()
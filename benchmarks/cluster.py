@@ -0,0 +1,82 @@
+"""Compare message throughput of a single worker against a multi-worker ContextCluster.
+
+Several client processes, each with its own context, send pings to echo
+processes spread over the cluster and wait for every pong.  The aggregate
+round trips per second are reported for one worker and for one worker per CPU.
+Scaling requires as many free CPUs as there are workers plus clients.
+
+    $ python -m benchmarks.cluster
+"""
+
+import multiprocessing
+import threading
+import time
+
+from benchmarks.harness import HIGHER, main, result, scaled
+from compactor.cluster import ContextCluster
+from compactor.process import Process
+from compactor.testing import ephemeral_context
+
+
+class EchoProcess(Process):
+  @Process.install('ping')
+  def ping(self, from_pid, body):
+    self.send(from_pid, 'pong', body)
+
+
+class ClientProcess(Process):
+  def __init__(self, name, expected):
+    self.received = 0
+    self.expected = expected
+    self.done = threading.Event()
+    super(ClientProcess, self).__init__(name)
+
+  @Process.install('pong')
+  def pong(self, from_pid, body):
+    self.received += 1
+    if self.received == self.expected:
+      self.done.set()
+
+
+def run_client(echoes, messages, start, results):
+  with ephemeral_context() as context:
+    client = ClientProcess('client', messages)
+    context.spawn(client)
+    start.wait()
+    for k in range(messages):
+      client.send(echoes[k % len(echoes)], 'ping', b'ping')
+    client.done.wait()
+  results.put(time.time())
+
+
+def bench_cluster(workers, clients, messages, echoes=64):
+  cluster = ContextCluster(workers=workers)
+  pids = [cluster.spawn(EchoProcess('echo(%d)' % k)) for k in range(echoes)]
+  cluster.start()
+  try:
+    start, results = multiprocessing.Event(), multiprocessing.Queue()
+    children = [multiprocessing.Process(target=run_client, args=(pids, messages, start, results))
+                for _ in range(clients)]
+    for child in children:
+      child.start()
+    time.sleep(1)  # let the clients come up
+    started = time.time()
+    start.set()
+    finished = max(results.get() for _ in children)
+    for child in children:
+      child.join()
+    return clients * messages / (finished - started)
+  finally:
+    cluster.stop()
+
+
+def run(scale=1.0, clients=4):
+  cpus = multiprocessing.cpu_count()
+  for workers in sorted(set([1, cpus])):
+    rate = bench_cluster(workers, clients, scaled(5000, scale))
+    yield result('cluster', 'throughput', rate, 'round trips/sec', better=HIGHER,
+                 workers=workers, clients=clients)
+
+
+if __name__ == '__main__':
+  main(run)
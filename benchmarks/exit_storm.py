@@ -0,0 +1,130 @@
+"""Measure how long it takes to deliver exits to linked processes.
+
+Many local processes are each linked to a few pids on a remote endpoint,
+alongside a large population of processes linked to nothing.  The remote
+endpoint then drops its connection, and the time until every linked process
+has handled ``exited`` is reported.  The same is measured for terminating a
+local process that many others are linked to.
+
+The remote endpoint is a bare socket so that the disconnect can be triggered
+on demand.
+
+    $ python -m benchmarks.exit_storm
+"""
+
+import socket
+import threading
+import time
+
+from benchmarks.harness import main, result, scaled
+from compactor.pid import PID
+from compactor.process import Process
+from compactor.testing import ephemeral_context
+
+
+class Counter(object):  # noqa
+  def __init__(self, expected):
+    self.expected = expected
+    self.count = 0
+    self.lock = threading.Lock()
+    self.done = threading.Event()
+
+  def increment(self):
+    with self.lock:
+      self.count += 1
+      if self.count == self.expected:
+        self.done.set()
+
+
+class LinkedProcess(Process):
+  def __init__(self, name, counter):
+    self.counter = counter
+    super(LinkedProcess, self).__init__(name)
+
+  def exited(self, pid):
+    self.counter.increment()
+
+
+class Endpoint(object):  # noqa
+  """A listening socket whose accepted connections are held open until ``disconnect``."""
+
+  def __init__(self):
+    self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.sock.bind(('127.0.0.1', 0))
+    self.sock.listen(16)
+    self.port = self.sock.getsockname()[1]
+    self.connections = []
+    self.thread = threading.Thread(target=self.accept)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def accept(self):
+    while True:
+      try:
+        connection, _ = self.sock.accept()
+      except socket.error:
+        return
+      self.connections.append(connection)
+
+  def disconnect(self):
+    for connection in self.connections:
+      connection.close()
+    self.sock.close()
+
+
+def wait_for(predicate):
+  while not predicate():
+    time.sleep(0.01)
+
+
+def bench_remote_exit(linked, bystanders, links_per_process=3, remotes=100):
+  endpoint = Endpoint()
+  with ephemeral_context() as context:
+    counter = Counter(linked * links_per_process)
+    remote_pids = [PID('127.0.0.1', endpoint.port, 'remote(%d)' % k) for k in range(remotes)]
+    for k in range(bystanders):
+      context.spawn(Process('bystander(%d)' % k))
+    for k in range(linked):
+      process = LinkedProcess('linked(%d)' % k, counter)
+      context.spawn(process)
+      for j in range(links_per_process):
+        process.link(remote_pids[(k + j) % remotes])
+    wait_for(lambda: sum(len(links) for links in context._links.values()) ==
+             linked * links_per_process)
+
+    started = time.time()
+    endpoint.disconnect()
+    counter.done.wait()
+    return time.time() - started
+
+
+def bench_local_exit(linked, bystanders):
+  with ephemeral_context() as context:
+    counter = Counter(linked)
+    target = Process('target')
+    context.spawn(target)
+    for k in range(bystanders):
+      context.spawn(Process('bystander(%d)' % k))
+    for k in range(linked):
+      process = LinkedProcess('linked(%d)' % k, counter)
+      context.spawn(process)
+      process.link(target.pid)
+
+    started = time.time()
+    context.terminate(target.pid)
+    counter.done.wait()
+    return time.time() - started
+
+
+def run(scale=1.0):
+  linked, bystanders = scaled(2000, scale), scaled(10000, scale)
+  elapsed = bench_remote_exit(linked, bystanders)
+  yield result('exit_storm', 'remote_disconnect', elapsed * 1e3, 'ms',
+               linked=linked, processes=linked + bystanders)
+  elapsed = bench_local_exit(linked, bystanders)
+  yield result('exit_storm', 'local_terminate', elapsed * 1e3, 'ms',
+               linked=linked, processes=linked + bystanders)
+
+
+if __name__ == '__main__':
+  main(run)
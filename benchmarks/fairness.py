@@ -0,0 +1,65 @@
+"""Measure the latency of a quiet process while another process on its context is flooded.
+
+A noisy process is sent a large backlog of messages and, while it works
+through them, a quiet process is pinged.  With a small mailbox budget the
+quiet process waits for at most one turn of the noisy one; with an
+effectively unlimited budget it waits behind the noisy process' backlog.
+
+    $ python -m benchmarks.fairness
+"""
+
+import threading
+import time
+
+from benchmarks.harness import main, percentile, result, scaled
+from compactor.process import Process
+from compactor.testing import ephemeral_context
+
+
+class NoisyProcess(Process):
+  @Process.install('work')
+  def work(self, from_pid, body):
+    sum(range(2000))
+
+
+class QuietProcess(Process):
+  def __init__(self, name, expected):
+    self.latencies = []
+    self.expected = expected
+    self.done = threading.Event()
+    super(QuietProcess, self).__init__(name)
+
+  @Process.install('ping')
+  def ping(self, from_pid, body):
+    self.latencies.append(time.time() - float(body))
+    if len(self.latencies) == self.expected:
+      self.done.set()
+
+
+def bench_fairness(budget, backlog=50000, pings=50):
+  with ephemeral_context(mailbox_budget=budget) as context:
+    noisy = NoisyProcess('noisy')
+    quiet = QuietProcess('quiet', pings)
+    sender = Process('sender')
+    for process in (noisy, quiet, sender):
+      context.spawn(process)
+
+    for _ in range(backlog):
+      sender.send(noisy.pid, 'work')
+    for _ in range(pings):
+      sender.send(quiet.pid, 'ping', repr(time.time()).encode('ascii'))
+      time.sleep(0.001)
+    quiet.done.wait()
+
+    return percentile(quiet.latencies, 50), percentile(quiet.latencies, 99)
+
+
+def run(scale=1.0):
+  for budget in (16, 1 << 30):
+    p50, p99 = bench_fairness(budget, backlog=scaled(50000, scale), pings=scaled(50, scale))
+    yield result('fairness', 'quiet_latency_p50', p50 * 1e3, 'ms', budget=budget)
+    yield result('fairness', 'quiet_latency_p99', p99 * 1e3, 'ms', budget=budget)
+
+
+if __name__ == '__main__':
+  main(run)
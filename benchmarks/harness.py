@@ -0,0 +1,142 @@
+"""Record benchmark results, print them and write them as JSON to compare runs.
+
+Every benchmark module defines ``run(scale=1.0)``, a generator of results
+made with :func:`result`, and may be run by itself through :func:`main`:
+
+    $ python -m benchmarks.local_send --json local_send.json
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import multiprocessing
+import platform
+import sys
+import threading
+import time
+
+LOWER = 'lower'
+HIGHER = 'higher'
+
+
+def result(benchmark, metric, value, unit, better=LOWER, **params):
+  """A single measurement.
+
+  :param benchmark: The name of the benchmark module.
+  :param metric: What was measured, e.g. ``send_latency``.
+  :param value: The measurement.
+  :param unit: The unit of ``value``, e.g. ``us`` or ``messages/sec``.
+  :keyword better: Whether ``LOWER`` or ``HIGHER`` values are better.
+  :param params: The parameters the measurement was taken with.
+  """
+  return {
+    'benchmark': benchmark,
+    'metric': metric,
+    'value': value,
+    'unit': unit,
+    'better': better,
+    'params': params,
+  }
+
+
+def key(result):
+  """A key identifying the same measurement across runs."""
+  return (result['benchmark'], result['metric'], tuple(sorted(result['params'].items())))
+
+
+def format_result(result):
+  params = ' '.join('%s=%s' % item for item in sorted(result['params'].items()))
+  return '%-14s %-24s %-32s %12.2f %s' % (
+      result['benchmark'], result['metric'], params, result['value'], result['unit'])
+
+
+def environment():
+  return {
+    'time': time.time(),
+    'python': platform.python_version(),
+    'implementation': platform.python_implementation(),
+    'platform': platform.platform(),
+    'cpus': multiprocessing.cpu_count(),
+  }
+
+
+def write_json(path, results):
+  with open(path, 'w') as fp:
+    json.dump({'environment': environment(), 'results': results}, fp, indent=2, sort_keys=True)
+
+
+def read_json(path):
+  with open(path) as fp:
+    return json.load(fp)['results']
+
+
+def compare(baseline, results):
+  """Yield lines comparing ``results`` against the ``baseline`` results of an earlier run."""
+  previous = dict((key(result), result) for result in baseline)
+  for result in results:
+    old = previous.get(key(result))
+    if old is None or not old['value']:
+      continue
+    change = (result['value'] - old['value']) / old['value']
+    worse = change > 0 if result['better'] == LOWER else change < 0
+    yield '%s  %+7.1f%%%s' % (format_result(result), change * 100, ' (worse)' if worse else '')
+
+
+def percentile(samples, percentile):
+  samples = sorted(samples)
+  return samples[min(len(samples) - 1, len(samples) * percentile // 100)]
+
+
+def scaled(count, scale):
+  """Scale an iteration count, keeping at least one iteration."""
+  return max(1, int(count * scale))
+
+
+class Latch(object):  # noqa
+  """An event set once the latch has been called ``expected`` times, from any thread."""
+
+  def __init__(self, expected):
+    self.expected = expected
+    self.count = 0
+    self.lock = threading.Lock()
+    self.done = threading.Event()
+
+  def __call__(self):
+    with self.lock:
+      self.count += 1
+      if self.count == self.expected:
+        self.done.set()
+
+  def wait(self, timeout=None):
+    return self.done.wait(timeout)
+
+
+def parser(description):
+  parser = argparse.ArgumentParser(
+      description=description, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--scale', type=float, default=1.0,
+                      help='Multiply the iterations of every benchmark, e.g. 0.1 for a quick run.')
+  parser.add_argument('--json', metavar='PATH', help='Write the results as JSON to PATH.')
+  parser.add_argument('--baseline', metavar='PATH',
+                      help='Compare the results with those written to PATH by an earlier run.')
+  return parser
+
+
+def report(results, args):
+  if args.baseline:
+    print('')
+    for line in compare(read_json(args.baseline), results):
+      print(line)
+  if args.json:
+    write_json(args.json, results)
+
+
+def main(run, argv=None):
+  """Run one benchmark module's ``run`` and report its results, as the module's ``__main__``."""
+  args = parser(sys.modules[run.__module__].__doc__).parse_args(argv)
+  results = []
+  for result in run(scale=args.scale):
+    print(format_result(result))
+    results.append(result)
+  report(results, args)
@@ -0,0 +1,75 @@
+"""Compare inbound message delivery through tornado and the wire protocol fast path.
+
+A raw socket client writes pre-encoded libprocess messages to a context over
+a single connection and the time until the destination process has received
+all of them is measured, for small and large bodies.
+
+    $ python -m benchmarks.inbound
+"""
+
+import socket
+import threading
+import time
+
+from benchmarks.harness import HIGHER, main, result, scaled
+from compactor.pid import PID
+from compactor.process import Process
+from compactor.request import encode_request
+from compactor.testing import ephemeral_context
+
+
+class Sink(Process):
+  def __init__(self, expected):
+    self.received = 0
+    self.expected = expected
+    self.done = threading.Event()
+    super(Sink, self).__init__('sink')
+
+  @Process.install('message')
+  def message(self, from_pid, body):
+    self.received += 1
+    if self.received == self.expected:
+      self.done.set()
+
+
+def drain(sock):
+  try:
+    while sock.recv(65536):
+      pass
+  except socket.error:
+    pass
+
+
+def bench_inbound(fast_path, body_size, messages):
+  with ephemeral_context(wire_protocol_fast_path=fast_path) as context:
+    sink = Sink(messages)
+    context.spawn(sink)
+
+    from_pid = PID('127.0.0.1', 1, 'client')
+    request = encode_request(from_pid, sink.pid, 'message', body=b'x' * body_size)
+
+    sock = socket.create_connection((context.ip, context.port))
+    drainer = threading.Thread(target=drain, args=(sock,))
+    drainer.daemon = True
+    drainer.start()
+
+    start = time.time()
+    for _ in range(messages):
+      sock.sendall(request)
+    sink.done.wait()
+    elapsed = time.time() - start
+
+    sock.close()
+    return messages / elapsed
+
+
+def run(scale=1.0):
+  for body_size, messages in ((16, 20000), (64 * 1024, 2000)):
+    for fast_path in (False, True):
+      rate = bench_inbound(fast_path, body_size, scaled(messages, scale))
+      yield result('inbound', 'throughput', rate, 'messages/sec', better=HIGHER,
+                   server='fast' if fast_path else 'tornado', body_bytes=body_size)
+
+
+if __name__ == '__main__':
+  main(run)
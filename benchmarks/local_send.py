@@ -0,0 +1,62 @@
+"""Measure the cost of a local Context.send as the number of methods on a Process grows.
+
+Local sends resolve their mailbox through the context's dispatch index, so the
+cost per send should stay flat regardless of how many methods the destination
+process class defines.
+
+    $ python -m benchmarks.local_send
+"""
+
+import threading
+import time
+
+from benchmarks.harness import main, result, scaled
+from compactor.process import Process
+from compactor.testing import ephemeral_context
+
+
+def make_process_class(methods):
+  """Create a Process subclass with ``methods`` plain methods and one installed mailbox."""
+  namespace = dict(('method_%d' % k, lambda self: None) for k in range(methods))
+
+  @Process.install('ping')
+  def ping(self, from_pid, body):
+    self.received += 1
+    if self.received == self.expected:
+      self.done.set()
+
+  namespace['ping'] = ping
+  return type('Process%d' % methods, (Process,), namespace)
+
+
+def bench_local_send(context, methods, iterations):
+  process_class = make_process_class(methods)
+  receiver = process_class('receiver(%d)' % methods)
+  receiver.received = 0
+  receiver.expected = iterations
+  receiver.done = threading.Event()
+  sender = Process('sender(%d)' % methods)
+  context.spawn(receiver)
+  context.spawn(sender)
+
+  start = time.time()
+  for _ in range(iterations):
+    sender.send(receiver.pid, 'ping')
+  elapsed = time.time() - start
+  receiver.done.wait()
+
+  context.terminate(receiver.pid)
+  context.terminate(sender.pid)
+  return elapsed / iterations
+
+
+def run(scale=1.0):
+  iterations = scaled(20000, scale)
+  with ephemeral_context() as context:
+    for methods in (1, 10, 100, 1000):
+      per_send = bench_local_send(context, methods, iterations)
+      yield result('local_send', 'send_time', per_send * 1e6, 'us', methods=methods)
+
+
+if __name__ == '__main__':
+  main(run)
@@ -0,0 +1,89 @@
+"""Measure the cost of the pid operations made for every message.
+
+Every inbound message has its sender parsed from the Libprocess-From
+header, every message handled or sent looks up the pid of a process, and
+pids are the keys of most of a context's tables.  The time per operation is
+reported for each, along with the memory allocated per parsed header.
+
+    $ python -m benchmarks.pids
+"""
+
+import time
+
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None
+
+from benchmarks.harness import main, result, scaled
+from compactor.pid import PID
+from compactor.process import Process
+from compactor.testing import ephemeral_context
+
+
+class PeerProcess(Process):
+  pass
+
+
+def timed(fn, operations):
+  start = time.time()
+  fn(operations)
+  return (time.time() - start) / operations
+
+
+def bench_from_string(headers, operations):
+  def parse(operations):
+    for k in range(operations):
+      PID.from_string(headers[k % len(headers)])
+  return timed(parse, operations)
+
+
+def bench_allocation(headers, operations):
+  for header in headers:
+    PID.from_string(header)
+  tracemalloc.start()
+  try:
+    before = tracemalloc.get_traced_memory()[0]
+    pids = [PID.from_string(headers[k % len(headers)]) for k in range(operations)]
+    allocated = tracemalloc.get_traced_memory()[0] - before
+  finally:
+    tracemalloc.stop()
+  # discount the list holding the parsed pids
+  return float(allocated) / len(pids) - 8
+
+
+def bench_lookup(pids, operations):
+  table = dict((pid, pid.id) for pid in pids)
+  keys = [PID.from_string(str(pid)) for pid in pids]
+
+  def lookup(operations):
+    for k in range(operations):
+      table[keys[k % len(keys)]]
+  return timed(lookup, operations)
+
+
+def bench_process_pid(process, operations):
+  def access(operations):
+    for _ in range(operations):
+      process.pid
+  return timed(access, operations)
+
+
+def run(scale=1.0):
+  operations = scaled(200000, scale)
+  with ephemeral_context() as context:
+    processes = [PeerProcess('peer(%d)' % k) for k in range(100)]
+    pids = [context.spawn(process) for process in processes]
+    headers = [str(pid) for pid in pids]
+
+    yield result('pids', 'from_string_time', bench_from_string(headers, operations) * 1e9, 'ns')
+    if tracemalloc is not None:
+      yield result('pids', 'from_string_allocated', bench_allocation(headers, operations),
+                   'bytes')
+    yield result('pids', 'lookup_time', bench_lookup(pids, operations) * 1e9, 'ns')
+    yield result('pids', 'process_pid_time', bench_process_pid(processes[0], operations) * 1e9,
+                 'ns')
+
+
+if __name__ == '__main__':
+  main(run)
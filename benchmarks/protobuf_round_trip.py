@@ -0,0 +1,87 @@
+"""Measure round trips of protobuf messages between ProtobufProcesses.
+
+A pinger sends a protobuf message and waits for the ponger to send it back
+before sending the next, on the same context and between two contexts, so
+each round trip includes serializing and parsing the message twice.
+
+Requires the ``protobuf`` package.
+
+    $ python -m benchmarks.protobuf_round_trip
+"""
+
+import threading
+import time
+
+from benchmarks.harness import main, percentile, result, scaled
+from compactor.process import ProtobufProcess
+from compactor.testing import ephemeral_context
+
+try:
+  from google.protobuf import descriptor_pb2
+except ImportError:
+  descriptor_pb2 = None
+
+
+def make_message(fields):
+  message = descriptor_pb2.DescriptorProto()
+  message.name = 'ping'
+  for k in range(fields):
+    field = message.field.add()
+    field.name = 'field_%d' % k
+    field.number = k + 1
+  return message
+
+
+def make_processes():
+  # the message class is only available with protobuf installed, so the processes
+  # are defined once it is known to be.
+  class Ponger(ProtobufProcess):
+    @ProtobufProcess.install(descriptor_pb2.DescriptorProto)
+    def ping(self, from_pid, message):
+      self.send(from_pid, message)
+
+  class Pinger(ProtobufProcess):
+    def __init__(self, name):
+      self.ponged = threading.Event()
+      super(Pinger, self).__init__(name)
+
+    @ProtobufProcess.install(descriptor_pb2.DescriptorProto)
+    def pong(self, from_pid, message):
+      self.ponged.set()
+
+  return Pinger('pinger'), Ponger('ponger')
+
+
+def bench_round_trip(remote, fields, round_trips):
+  with ephemeral_context() as pinging, ephemeral_context() as ponging:
+    pinger, ponger = make_processes()
+    pinging.spawn(pinger)
+    (ponging if remote else pinging).spawn(ponger)
+    message = make_message(fields)
+
+    latencies = []
+    for k in range(round_trips + 1):
+      pinger.ponged.clear()
+      start = time.time()
+      pinger.send(ponger.pid, message)
+      pinger.ponged.wait()
+      if k:  # the first round trip establishes any connections
+        latencies.append(time.time() - start)
+    return latencies
+
+
+def run(scale=1.0):
+  if descriptor_pb2 is None:
+    return
+  for remote in (False, True):
+    for fields in (1, 100):
+      latencies = bench_round_trip(remote, fields, scaled(2000, scale))
+      placement = 'remote' if remote else 'local'
+      yield result('protobuf', 'round_trip_p50', percentile(latencies, 50) * 1e6, 'us',
+                   placement=placement, fields=fields)
+      yield result('protobuf', 'round_trip_p99', percentile(latencies, 99) * 1e6, 'us',
+                   placement=placement, fields=fields)
+
+
+if __name__ == '__main__':
+  main(run)
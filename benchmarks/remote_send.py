@@ -0,0 +1,97 @@
+"""Measure messages sent between two contexts over loopback.
+
+A sender streams messages to a sink on another context and the rate at
+which the sink receives them is reported, for small and large bodies.  Then
+a pinger waits for each pong before sending the next ping, and the round
+trip latency is reported.
+
+    $ python -m benchmarks.remote_send
+"""
+
+import threading
+import time
+
+from benchmarks.harness import HIGHER, Latch, main, percentile, result, scaled
+from compactor.process import Process
+from compactor.testing import ephemeral_context
+
+
+class Sink(Process):
+  def __init__(self, name, latch):
+    self.latch = latch
+    super(Sink, self).__init__(name)
+
+  @Process.install('message')
+  def message(self, from_pid, body):
+    self.latch()
+
+
+class Ponger(Process):
+  @Process.install('ping')
+  def ping(self, from_pid, body):
+    self.send(from_pid, 'pong', body)
+
+
+class Pinger(Process):
+  def __init__(self, name):
+    self.pong = threading.Event()
+    super(Pinger, self).__init__(name)
+
+  @Process.install('pong')
+  def on_pong(self, from_pid, body):
+    self.pong.set()
+
+
+def bench_throughput(body_size, messages):
+  with ephemeral_context() as sending, ephemeral_context() as receiving:
+    latch = Latch(messages)
+    sink = Sink('sink', latch)
+    receiving.spawn(sink)
+    sender = Process('sender')
+    sending.spawn(sender)
+    body = b'x' * body_size
+
+    # establish the connection before timing
+    warmup = threading.Event()
+    sink.latch = lambda: warmup.set()
+    sender.send(sink.pid, 'message', body)
+    warmup.wait()
+    sink.latch = latch
+
+    start = time.time()
+    for _ in range(messages):
+      sender.send(sink.pid, 'message', body)
+    latch.wait()
+    return messages / (time.time() - start)
+
+
+def bench_round_trip(round_trips):
+  with ephemeral_context() as pinging, ephemeral_context() as ponging:
+    ponger = Ponger('ponger')
+    ponging.spawn(ponger)
+    pinger = Pinger('pinger')
+    pinging.spawn(pinger)
+
+    latencies = []
+    for k in range(round_trips + 1):
+      pinger.pong.clear()
+      start = time.time()
+      pinger.send(ponger.pid, 'ping', b'ping')
+      pinger.pong.wait()
+      if k:  # the first round trip establishes the connections
+        latencies.append(time.time() - start)
+    return latencies
+
+
+def run(scale=1.0):
+  for body_size, messages in ((16, 20000), (64 * 1024, 2000)):
+    rate = bench_throughput(body_size, scaled(messages, scale))
+    yield result('remote_send', 'throughput', rate, 'messages/sec', better=HIGHER,
+                 body_bytes=body_size)
+  latencies = bench_round_trip(scaled(2000, scale))
+  yield result('remote_send', 'round_trip_p50', percentile(latencies, 50) * 1e6, 'us')
+  yield result('remote_send', 'round_trip_p99', percentile(latencies, 99) * 1e6, 'us')
+
+
+if __name__ == '__main__':
+  main(run)
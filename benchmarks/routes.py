@@ -0,0 +1,88 @@
+"""Measure how requests are routed by a context's HTTP server as more processes are mounted.
+
+Every process mounts a mailbox, a literal route and a pattern route.  The
+time the router takes to find the handler of each kind of path is reported,
+along with the latency of requests to a literal route over a keep-alive
+connection.
+
+    $ python -m benchmarks.routes
+"""
+
+import time
+
+try:
+  from http.client import HTTPConnection
+except ImportError:
+  from httplib import HTTPConnection
+
+from benchmarks.harness import main, percentile, result, scaled
+from compactor.process import Process
+from compactor.testing import ephemeral_context
+
+
+class ActorProcess(Process):
+  @Process.install('message')
+  def message(self, from_pid, body):
+    pass
+
+  @Process.route('/status')
+  def status(self, handler):
+    handler.write('ok')
+
+  @Process.route('/tasks/([0-9]+)')
+  def task(self, handler, task_id):
+    handler.write(task_id)
+
+
+def resolve(router, path):
+  # as tornado does with the candidates returned by the router
+  for spec in router.find(path):
+    match = spec.regex.match(path)
+    if match:
+      return spec, match.groups()
+
+
+def bench_lookup(router, paths, lookups):
+  start = time.time()
+  for k in range(lookups):
+    resolve(router, paths[k % len(paths)])
+  return (time.time() - start) / lookups
+
+
+def bench_requests(context, path, requests):
+  connection = HTTPConnection(context.ip, context.port)
+  latencies = []
+  for _ in range(requests):
+    start = time.time()
+    connection.request('GET', path)
+    connection.getresponse().read()
+    latencies.append(time.time() - start)
+  connection.close()
+  return latencies
+
+
+def run(scale=1.0):
+  lookups = scaled(100000, scale)
+  for actors in (10, 1000, 10000):
+    with ephemeral_context() as context:
+      for k in range(actors):
+        context.spawn(ActorProcess('actor(%d)' % k))
+      router = context.http.router
+      ids = ['actor(%d)' % k for k in range(0, actors, max(1, actors // 100))]
+      paths = {
+        'mailbox': ['/%s/message' % id_ for id_ in ids],
+        'literal': ['/%s/status' % id_ for id_ in ids],
+        'pattern': ['/%s/tasks/42' % id_ for id_ in ids],
+        'missing': ['/%s/missing' % id_ for id_ in ids],
+      }
+      for kind, kind_paths in sorted(paths.items()):
+        per_lookup = bench_lookup(router, kind_paths, lookups)
+        yield result('routes', 'lookup_time', per_lookup * 1e6, 'us', path=kind, actors=actors)
+
+      latencies = bench_requests(context, paths['literal'][0], scaled(1000, scale))
+      yield result('routes', 'request_p50', percentile(latencies, 50) * 1e6, 'us',
+                   actors=actors)
+
+
+if __name__ == '__main__':
+  main(run)
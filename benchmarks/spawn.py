@@ -0,0 +1,86 @@
+"""Measure the rate at which processes are created, spawned on and terminated from a context.
+
+Each process has a few installed mailboxes and a route, so spawning it
+mounts them on the context's HTTP server and terminating it unmounts them.
+The memory allocated per process is reported for processes that have been
+created but not yet spawned.
+
+    $ python -m benchmarks.spawn
+"""
+
+import time
+
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None
+
+from benchmarks.harness import HIGHER, main, result, scaled
+from compactor.process import Process
+from compactor.testing import ephemeral_context
+
+
+class TaskProcess(Process):
+  @Process.install('start')
+  def start(self, from_pid, body):
+    pass
+
+  @Process.install('stop')
+  def stop(self, from_pid, body):
+    pass
+
+  @Process.install('status')
+  def status(self, from_pid, body):
+    pass
+
+  @Process.route('/state')
+  def state(self, handler):
+    handler.write('running')
+
+
+def bench_create(processes):
+  start = time.time()
+  [TaskProcess('task(%d)' % k) for k in range(processes)]
+  return processes / (time.time() - start)
+
+
+def bench_memory(processes):
+  names = ['task(%d)' % k for k in range(processes)]
+  TaskProcess(names[0])
+  tracemalloc.start()
+  try:
+    before = tracemalloc.get_traced_memory()[0]
+    tasks = [TaskProcess(name) for name in names]
+    allocated = tracemalloc.get_traced_memory()[0] - before
+  finally:
+    tracemalloc.stop()
+  return float(allocated) / len(tasks)
+
+
+def bench_spawn(processes):
+  with ephemeral_context() as context:
+    start = time.time()
+    pids = [context.spawn(TaskProcess('task(%d)' % k)) for k in range(processes)]
+    spawned = time.time()
+    for pid in pids:
+      context.terminate(pid)
+    terminated = time.time()
+    return processes / (spawned - start), processes / (terminated - spawned)
+
+
+def run(scale=1.0):
+  for processes in (1000, 10000):
+    processes = scaled(processes, scale)
+    yield result('spawn', 'create_rate', bench_create(processes), 'processes/sec',
+                 better=HIGHER, processes=processes)
+    spawn_rate, terminate_rate = bench_spawn(processes)
+    yield result('spawn', 'spawn_rate', spawn_rate, 'processes/sec', better=HIGHER,
+                 processes=processes)
+    yield result('spawn', 'terminate_rate', terminate_rate, 'processes/sec', better=HIGHER,
+                 processes=processes)
+  if tracemalloc is not None:
+    yield result('spawn', 'process_memory', bench_memory(scaled(10000, scale)), 'bytes')
+
+
+if __name__ == '__main__':
+  main(run)
@@ -16,19 +16,14 @@ class WebProcess(Process):
   def ping(self, from_pid, body):
     log.info("Received ping")
 
-    def respond():
-      time.sleep(0.5)
-      self.send(from_pid, "pong")
-    self.context.loop.add_callback(respond)
+    # Sleep in the context's thread pool rather than on its event loop, which
+    # would stall every other process on the context.
+    self.defer(time.sleep, 0.5).add_done_callback(lambda future: self.send(from_pid, "pong"))
 
   @Process.install('pong')
   def pong(self, from_pid, body):
     log.info("Received pong")
-
-    def respond():
-      time.sleep(0.5)
-      self.send(from_pid, "ping")
-    self.context.loop.add_callback(respond)
+    self.defer(time.sleep, 0.5).add_done_callback(lambda future: self.send(from_pid, "ping"))
 
 
 def listen(identifier):
@@ -37,6 +32,7 @@ def listen(identifier):
   """
 
   context = Context()
+  context.start()
   process = WebProcess(identifier)
 
   context.spawn(process)
@@ -51,11 +47,8 @@ if __name__ == '__main__':
   a, a_context = listen("web(1)")
   b, b_context = listen("web(2)")
 
-  a_context.start()
-  b_context.start()
-
   # Kick off the game of ping/pong by sending a message to B from A
   a.send(b.pid, "ping")
 
-  while a_context.isAlive() or b_context.isAlive():
+  while a_context.is_alive() or b_context.is_alive():
     time.sleep(0.5)
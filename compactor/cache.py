@@ -0,0 +1,56 @@
+"""A small thread-safe least-recently-used cache."""
+
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):  # noqa
+  """A mapping bounded to ``capacity`` entries, evicting the least recently used.
+
+  This may be used from any thread.
+  """
+
+  def __init__(self, capacity):
+    """
+    :param capacity: The maximum number of entries to keep.
+    :type capacity: ``int``
+    """
+    if capacity < 1:
+      raise ValueError('capacity must be at least 1.')
+    self.capacity = capacity
+    self.hits = 0
+    self.misses = 0
+    self._entries = OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, key, default=None):
+    with self._lock:
+      try:
+        value = self._entries.pop(key)
+      except KeyError:
+        self.misses += 1
+        return default
+      self._entries[key] = value
+      self.hits += 1
+      return value
+
+  def put(self, key, value):
+    with self._lock:
+      self._entries.pop(key, None)
+      self._entries[key] = value
+      while len(self._entries) > self.capacity:
+        self._entries.popitem(last=False)
+
+  def pop(self, key, default=None):
+    with self._lock:
+      return self._entries.pop(key, default)
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+
+  def __contains__(self, key):
+    return key in self._entries
+
+  def __len__(self):
+    return len(self._entries)
@@ -0,0 +1,270 @@
+"""A cluster of contexts in pre-forked worker processes sharing one listening port."""
+
+import errno
+import logging
+import os
+import signal
+import socket
+import threading
+import zlib
+
+from .context import Context
+from .pid import PID
+
+from tornado.netutil import bind_sockets
+
+log = logging.getLogger(__name__)
+
+
+def place(name, workers):
+  """Return the index of the worker on which the process named ``name`` is placed.
+
+  Placement is a stable hash of the process name, so every worker (and any
+  client that knows the number of workers) computes the same answer.
+  """
+  return (zlib.crc32(name.encode('utf8')) & 0xffffffff) % workers
+
+
+class Placement(object):  # noqa
+  """The placement of one worker context within a :class:`ContextCluster`."""
+
+  def __init__(self, index, forward_endpoints, sock=None):
+    """
+    :param index: The index of this worker.
+    :type index: ``int``
+    :param forward_endpoints: The (ip, port) forwarding endpoint of every worker, by index.
+    :type forward_endpoints: ``list``
+    :keyword sock: The bound socket on which this worker accepts forwarded messages.
+    :type sock: ``socket.socket`` or None
+    """
+    self.index = index
+    self.forward_endpoints = forward_endpoints
+    self.sock = sock
+
+  @property
+  def workers(self):
+    return len(self.forward_endpoints)
+
+  def worker_for(self, name):
+    """The index of the worker that owns the process named ``name``."""
+    return place(name, self.workers)
+
+  def owns(self, name):
+    """Whether the process named ``name`` is placed on this worker."""
+    return self.worker_for(name) == self.index
+
+  def forward_endpoint(self, name):
+    """The (ip, port) at which the owner of the process ``name`` accepts forwarded messages."""
+    return self.forward_endpoints[self.worker_for(name)]
+
+
+class ContextCluster(object):  # noqa
+  """Run a fixed set of processes across several forked worker contexts.
+
+  Every worker listens on the same public (ip, port), either through its own
+  ``SO_REUSEPORT`` socket where the platform supports it, or by accepting on
+  a listening socket inherited from the parent.  Each spawned process is
+  placed on exactly one worker by a hash of its name (see :func:`place`), so
+  all processes keep the pid they would have on a single context.
+
+  A libprocess message that the kernel hands to the wrong worker is
+  forwarded over loopback to the worker that owns its destination, and
+  messages sent between processes on different workers travel the same
+  way.  ``Process.route`` requests are not forwarded, so routes should only
+  be relied upon for processes on single-worker clusters or reached through
+  the owning worker's context directly.
+
+  .. code-block:: python
+
+      cluster = ContextCluster(workers=4, port=5051)
+      for k in range(16):
+        cluster.spawn(EchoProcess('echo(%d)' % k))
+      cluster.start()
+      cluster.join()
+
+  Processes are spawned in the workers after ``start``, so their state in
+  the parent is a template and is not updated by the workers.
+  """
+
+  class Error(Exception): pass
+  class InvalidProcess(Error): pass
+
+  FORWARD_IP = '127.0.0.1'
+
+  @classmethod
+  def supports_reuse_port(cls):
+    return hasattr(socket, 'SO_REUSEPORT')
+
+  def __init__(self, workers=None, ip=None, port=None, reuse_port=None, initializer=None,
+               **context_kw):
+    """Construct a cluster.  No worker is forked until ``start`` is called.
+
+    :keyword workers: The number of worker processes.  Defaults to the number of CPUs.
+    :type workers: ``int`` or None
+    :keyword ip: The ip on which the cluster listens, as for :class:`Context`.
+    :type ip: ``str`` or None
+    :keyword port: The port on which the cluster listens, as for :class:`Context`.
+    :type port: ``int`` or None
+    :keyword reuse_port: If True, each worker binds its own ``SO_REUSEPORT`` socket and
+       the kernel balances connections between them.  If False, workers accept from one
+       shared socket.  Defaults to True where ``SO_REUSEPORT`` is available.
+    :type reuse_port: ``bool`` or None
+    :keyword initializer: Called with each worker's context once its processes are spawned.
+    :type initializer: ``callable`` or None
+
+    Any other keyword arguments are passed to each worker's :class:`Context`.
+    """
+    if not hasattr(os, 'fork'):
+      raise self.Error('ContextCluster requires os.fork')
+    self.workers = workers or _cpu_count()
+    if self.workers < 1:
+      raise ValueError('A cluster needs at least one worker.')
+    if reuse_port is None:
+      reuse_port = self.supports_reuse_port()
+    elif reuse_port and not self.supports_reuse_port():
+      raise self.Error('SO_REUSEPORT is not supported on this platform')
+    self.reuse_port = reuse_port
+    self.__initializer = initializer
+    self.__context_kw = context_kw
+    self.__processes = {}
+    self.__children = []
+
+    ip, port = Context.get_ip_port(ip, port)
+    if reuse_port:
+      # Bind, but never listen on, a socket that reserves the port for the workers.
+      self.__sock = self.__bind_reuse_port(ip, port)
+    else:
+      self.__sock = bind_sockets(port, address=ip)[0]
+    self.__bind_address = self.__sock.getsockname()[:2]
+    _, self.ip, self.port = Context._adopt_socket(self.__sock)
+
+    self.__forward_socks = [
+        bind_sockets(0, address=self.FORWARD_IP)[0] for _ in range(self.workers)]
+    self.forward_endpoints = [
+        (self.FORWARD_IP, sock.getsockname()[1]) for sock in self.__forward_socks]
+
+  @classmethod
+  def __bind_reuse_port(cls, ip, port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.setblocking(0)
+    sock.bind((ip, port))
+    return sock
+
+  def spawn(self, process):
+    """Place a process on the cluster and return its pid.
+
+    Must be called before ``start``.
+
+    :param process: The process to run on its owning worker.
+    :type process: :class:`Process`
+    :return: The pid of the process.
+    :rtype: :class:`PID`
+    """
+    if self.__children:
+      raise self.Error('Processes must be spawned before the cluster is started.')
+    if process.name in self.__processes:
+      raise self.InvalidProcess('Process %s already spawned.' % process.name)
+    self.__processes[process.name] = process
+    return PID.intern(self.ip, self.port, process.name)
+
+  def worker_for(self, pid):
+    """The index of the worker that owns ``pid``."""
+    return place(pid.id, self.workers)
+
+  def start(self):
+    """Fork the workers and wait until each is serving its processes."""
+    if self.__children:
+      raise self.Error('Cluster already started.')
+    ready_r, ready_w = os.pipe()
+    for index in range(self.workers):
+      child = os.fork()
+      if child == 0:
+        os.close(ready_r)
+        self.__run_worker(index, ready_w)
+      self.__children.append(child)
+    os.close(ready_w)
+    for sock in self.__forward_socks:
+      sock.close()
+    try:
+      ready = 0
+      while ready < self.workers:
+        data = os.read(ready_r, self.workers - ready)
+        if not data:
+          break
+        ready += len(data)
+    finally:
+      os.close(ready_r)
+    if ready < self.workers:
+      self.stop()
+      raise self.Error('%d of %d workers failed to start.' % (self.workers - ready, self.workers))
+
+  def __run_worker(self, index, ready):
+    # The entry point of a forked worker.  This never returns.
+    status = 1
+    try:
+      stopped = threading.Event()
+      signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+      for k, sock in enumerate(self.__forward_socks):
+        if k != index:
+          sock.close()
+      if self.reuse_port:
+        self.__sock.close()
+        sock = self.__bind_reuse_port(*self.__bind_address)
+      else:
+        sock = self.__sock
+      placement = Placement(index, self.forward_endpoints, sock=self.__forward_socks[index])
+      context = Context(sock=sock, placement=placement, **self.__context_kw)
+      context.start()
+      for name, process in self.__processes.items():
+        if placement.owns(name):
+          context.spawn(process)
+      if self.__initializer:
+        self.__initializer(context)
+      os.write(ready, b'.')
+      os.close(ready)
+      # Event.wait without a timeout cannot be interrupted by signals on Python 2.
+      while not stopped.wait(0.1):
+        pass
+      context.stop()
+      status = 0
+    except Exception:
+      log.exception('Worker %d of %s failed' % (index, self))
+    finally:
+      os._exit(status)
+
+  def stop(self):
+    """Terminate the workers and wait for them to exit."""
+    for child in self.__children:
+      try:
+        os.kill(child, signal.SIGTERM)
+      except OSError as e:
+        if e.errno != errno.ESRCH:
+          raise
+    self.join()
+    self.__sock.close()
+
+  def join(self):
+    """Block until every worker has exited."""
+    while self.__children:
+      child = self.__children[0]
+      try:
+        os.waitpid(child, 0)
+      except OSError as e:
+        if e.errno == errno.EINTR:
+          continue
+        if e.errno != errno.ECHILD:
+          raise
+      self.__children.pop(0)
+
+  def __str__(self):
+    return 'ContextCluster(%s:%d, workers=%d)' % (self.ip, self.port, self.workers)
+
+
+def _cpu_count():
+  try:
+    import multiprocessing
+    return multiprocessing.cpu_count()
+  except (ImportError, NotImplementedError):
+    return 1
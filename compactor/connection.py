@@ -0,0 +1,908 @@
+"""Outbound connection pooling for compactor contexts."""
+
+import logging
+import random
+import socket
+import threading
+import time
+from collections import OrderedDict, deque
+
+from .cache import LRUCache
+from .metrics import Metrics
+from .request import HEARTBEAT_REQUEST
+
+from tornado import stack_context
+from tornado.ioloop import PeriodicCallback
+from tornado.iostream import IOStream
+
+log = logging.getLogger(__name__)
+
+
+def request_size(request):
+  """The length of an encoded request, given as bytes or as a sequence of byte segments."""
+  if isinstance(request, (tuple, list)):
+    return sum(len(segment) for segment in request)
+  return len(request)
+
+
+def join_requests(requests):
+  """Concatenate encoded requests, each bytes or a sequence of byte segments, into bytes."""
+  segments = []
+  for request in requests:
+    if isinstance(request, (tuple, list)):
+      segments.extend(request)
+    else:
+      segments.append(request)
+  return b''.join(segments)
+
+
+def iter_batches(requests, max_bytes, max_messages):
+  """Split a sequence of encoded requests into batches within the given limits.
+
+  A single request larger than ``max_bytes`` is yielded as its own batch.
+  """
+  batch, batch_bytes = [], 0
+  for request in requests:
+    size = request_size(request)
+    if batch and (len(batch) >= max_messages or batch_bytes + size > max_bytes):
+      yield batch
+      batch, batch_bytes = [], 0
+    batch.append(request)
+    batch_bytes += size
+  if batch:
+    yield batch
+
+
+class QueueLimits(object):  # noqa
+  """High and low watermarks for the messages queued to a destination endpoint.
+
+  A destination becomes congested when accepting another message would take
+  it past either high watermark, and stays congested until both its queued
+  messages and bytes fall to their low watermarks.  While congested, sends
+  are handled according to ``policy``:
+
+    * ``DROP_NEWEST`` discards the message being sent.
+    * ``DROP_OLDEST`` discards the oldest unwritten messages to make room.
+    * ``RAISE`` raises ``QueueFull`` in the sender.
+    * ``BLOCK`` blocks the sending thread until the destination drains.  Sends
+      from the event loop thread cannot block and raise ``QueueFull`` instead.
+  """
+
+  DROP_OLDEST = 'drop_oldest'
+  DROP_NEWEST = 'drop_newest'
+  RAISE = 'raise'
+  BLOCK = 'block'
+  POLICIES = frozenset([DROP_OLDEST, DROP_NEWEST, RAISE, BLOCK])
+
+  def __init__(self, high_messages=None, high_bytes=None, low_messages=None, low_bytes=None,
+               policy=DROP_NEWEST, block_timeout=None):
+    """Construct queue limits.
+
+    :keyword high_messages: The number of queued messages at which a destination congests.
+    :type high_messages: ``int`` or None
+    :keyword high_bytes: The number of queued bytes at which a destination congests.
+    :type high_bytes: ``int`` or None
+    :keyword low_messages: The number of queued messages at which a destination
+       decongests.  Defaults to half of ``high_messages``.
+    :type low_messages: ``int`` or None
+    :keyword low_bytes: The number of queued bytes at which a destination decongests.
+       Defaults to half of ``high_bytes``.
+    :type low_bytes: ``int`` or None
+    :keyword policy: The overflow policy for a congested destination.
+    :type policy: ``str``
+    :keyword block_timeout: The maximum number of seconds a ``BLOCK`` send waits before
+       raising ``QueueFull``, or None to wait indefinitely.
+    :type block_timeout: ``float`` or None
+    """
+    if policy not in self.POLICIES:
+      raise ValueError('Unknown overflow policy %r' % (policy,))
+    self.high_messages = high_messages
+    self.high_bytes = high_bytes
+    self.low_messages = (
+        high_messages // 2 if low_messages is None and high_messages else low_messages)
+    self.low_bytes = high_bytes // 2 if low_bytes is None and high_bytes else low_bytes
+    for low, high in ((self.low_messages, high_messages), (self.low_bytes, high_bytes)):
+      if high is not None and (high < 1 or low < 0 or low > high):
+        raise ValueError('Watermarks must satisfy 0 <= low <= high and high >= 1')
+    self.policy = policy
+    self.block_timeout = block_timeout
+
+  def exceeded(self, messages, bytes_):
+    """Whether a depth of ``messages`` and ``bytes_`` is past a high watermark."""
+    return ((self.high_messages is not None and messages > self.high_messages) or
+            (self.high_bytes is not None and bytes_ > self.high_bytes))
+
+  def drained(self, messages, bytes_):
+    """Whether a depth of ``messages`` and ``bytes_`` is at or below both low watermarks."""
+    return ((self.low_messages is None or messages <= self.low_messages) and
+            (self.low_bytes is None or bytes_ <= self.low_bytes))
+
+
+class Backoff(object):  # noqa
+  """Capped exponential backoff with jitter between attempts to reconnect to an endpoint.
+
+  After ``n`` consecutive failures to connect, the next attempt is delayed by
+  ``initial_secs * multiplier ** (n - 1)`` seconds, capped at ``max_secs``, less
+  a random fraction of up to ``jitter`` of the delay so that many contexts
+  reconnecting to the same endpoint spread out their attempts.  Once
+  ``max_failures`` consecutive attempts have failed, the messages queued to the
+  endpoint are discarded.
+  """
+
+  def __init__(self, initial_secs=0.1, max_secs=10.0, multiplier=2.0, jitter=0.5,
+               max_failures=8):
+    """Construct a backoff policy.
+
+    :keyword initial_secs: The delay after the first failure.
+    :type initial_secs: ``float``
+    :keyword max_secs: The maximum delay between attempts.
+    :type max_secs: ``float``
+    :keyword multiplier: The factor by which the delay grows with each failure.
+    :type multiplier: ``float``
+    :keyword jitter: The maximum fraction of each delay that is randomly subtracted from it.
+    :type jitter: ``float``
+    :keyword max_failures: The number of consecutive failures after which queued messages
+       are discarded, or None to keep them until the endpoint is reachable.
+    :type max_failures: ``int`` or None
+    """
+    if initial_secs <= 0 or max_secs < initial_secs:
+      raise ValueError('Delays must satisfy 0 < initial_secs <= max_secs')
+    if multiplier < 1:
+      raise ValueError('multiplier must be at least 1.')
+    if not 0 <= jitter <= 1:
+      raise ValueError('jitter must be between 0 and 1.')
+    if max_failures is not None and max_failures < 1:
+      raise ValueError('max_failures must be at least 1.')
+    self.initial_secs = initial_secs
+    self.max_secs = max_secs
+    self.multiplier = multiplier
+    self.jitter = jitter
+    self.max_failures = max_failures
+
+  def delay(self, failures):
+    """The number of seconds to wait before reconnecting after ``failures`` consecutive failures."""
+    if failures < 1:
+      return 0
+    # bound the exponent so that the delay cannot overflow before it is capped
+    exponent = min(failures - 1, 64)
+    delay = min(self.max_secs, self.initial_secs * self.multiplier ** exponent)
+    return delay * (1 - self.jitter * random.random())
+
+  def exhausted(self, failures):
+    """Whether queued messages should be discarded after ``failures`` consecutive failures."""
+    return self.max_failures is not None and failures >= self.max_failures
+
+
+class Outbox(object):  # noqa
+  """The messages queued to a single destination endpoint.
+
+  A message counts toward the depth of its outbox from the time it is sent
+  until the write buffer of the connection that carried it has drained to the
+  socket.  ``put`` may be called from any thread; everything else runs on the
+  event loop.
+
+  Unwritten messages stay in the outbox if the connections to its endpoint
+  close, and are written once the endpoint has been reconnected.  While the
+  endpoint is backing off from failed connection attempts, no new connection
+  to it is opened before ``retry_at``.
+  """
+
+  class QueueFull(Exception): pass
+
+  def __init__(self, endpoint, limits=None):
+    self.endpoint = endpoint
+    self.limits = limits or QueueLimits()
+    self.messages = 0
+    self.bytes = 0
+    self.dropped = 0
+    self.congested = False
+    self.failures = 0  # consecutive failed connection attempts
+    self.retry_at = 0  # loop time before which no connection is opened
+    self.reconnect = None  # timeout handle of a scheduled reconnect
+    self._entries = deque()  # (pid, data, enqueue time)
+    self._flush_scheduled = False
+    self._condition = threading.Condition()
+
+  @property
+  def depth(self):
+    """The (messages, bytes) queued to this destination."""
+    with self._condition:
+      return self.messages, self.bytes
+
+  @property
+  def unwritten(self):
+    """The number of messages not yet taken to be written."""
+    return len(self._entries)
+
+  def __drop_oldest(self, size):
+    dropped = 0
+    while self._entries and self.limits.exceeded(self.messages + 1, self.bytes + size):
+      _, data, _ = self._entries.popleft()
+      self.__release(1, request_size(data))
+      dropped += 1
+    return dropped
+
+  def __release(self, messages, bytes_):
+    self.messages -= messages
+    self.bytes -= bytes_
+    if self.congested and self.limits.drained(self.messages, self.bytes):
+      self.congested = False
+      self._condition.notify_all()
+
+  def __wait_until_drained(self, timeout):
+    deadline = None if timeout is None else time.time() + timeout
+    while self.congested:
+      remaining = None if deadline is None else deadline - time.time()
+      if remaining is not None and remaining <= 0:
+        raise self.QueueFull('Timed out waiting for %s:%d to drain' % self.endpoint)
+      self._condition.wait(remaining)
+
+  def put(self, pid, data, block=True):
+    """Queue ``data`` to ``pid``.
+
+    :returns: A tuple of the number of messages dropped to apply the overflow
+       policy, and whether the caller should schedule a flush of this outbox.
+    :raises: ``Outbox.QueueFull`` if the destination is congested and the policy
+       is ``RAISE``, or ``BLOCK`` and the send cannot block.
+    """
+    size = request_size(data)
+    limits = self.limits
+    dropped = 0
+    with self._condition:
+      if not self.congested and limits.exceeded(self.messages + 1, self.bytes + size):
+        self.congested = True
+
+      if self.congested:
+        if limits.policy == limits.BLOCK and block:
+          self.__wait_until_drained(limits.block_timeout)
+        elif limits.policy == limits.DROP_OLDEST:
+          dropped = self.__drop_oldest(size)
+          if limits.exceeded(self.messages + 1, self.bytes + size):
+            self.dropped += dropped + 1
+            return dropped + 1, False
+          self.dropped += dropped
+        elif limits.policy == limits.DROP_NEWEST:
+          self.dropped += 1
+          return 1, False
+        else:
+          raise self.QueueFull('Outbound queue to %s:%d is full (%d messages, %d bytes)' % (
+              self.endpoint + (self.messages, self.bytes)))
+
+      self._entries.append((pid, data, time.time()))
+      self.messages += 1
+      self.bytes += size
+      schedule, self._flush_scheduled = not self._flush_scheduled, True
+      return dropped, schedule
+
+  def take(self):
+    """Remove and return every unwritten (pid, data, enqueue time) entry."""
+    with self._condition:
+      entries, self._entries = self._entries, deque()
+      self._flush_scheduled = False
+      return entries
+
+  def restore(self, entries):
+    """Return unwritten entries to the front of the outbox, preserving their order."""
+    with self._condition:
+      self._entries.extendleft(reversed(entries))
+
+  def discard(self, pids=None):
+    """Discard the unwritten messages to ``pids``, or every unwritten message if None.
+
+    :returns: The number of messages discarded.
+    """
+    with self._condition:
+      kept = deque()
+      discarded = 0
+      for entry in self._entries:
+        if pids is None or entry[0] in pids:
+          self.__release(1, request_size(entry[1]))
+          discarded += 1
+        else:
+          kept.append(entry)
+      self._entries = kept
+      return discarded
+
+  def release(self, messages, bytes_):
+    """Account for messages that have left the outbox."""
+    with self._condition:
+      self.__release(messages, bytes_)
+
+
+class Connection(object):  # noqa
+  """A single outbound stream to a remote (ip, port) endpoint.
+
+  A connection is shared by every remote pid on its endpoint that has been
+  assigned to it.  Callbacks registered before the stream is established are
+  queued and dispatched once the connection completes.
+  """
+
+  def __init__(self, endpoint, stream, on_drained=None):
+    self.endpoint = endpoint
+    self.stream = stream
+    self.pids = set()
+    self.connected = False
+    self.evicted = False
+    self.close_reason = 'reached end of stream'
+    self.last_used = 0
+    self.last_received = 0
+    self.pending_bytes = 0
+    self.pending_messages = 0
+    self._callbacks = []
+    self._on_drained = on_drained or (lambda messages, bytes_: None)
+
+  @property
+  def load(self):
+    """The number of bytes and callbacks waiting on this connection."""
+    return self.pending_bytes + len(self._callbacks)
+
+  @property
+  def idle(self):
+    """Whether the connection is established with nothing waiting on it."""
+    return self.connected and not self.load and not self.closed()
+
+  def closed(self):
+    return self.stream.closed()
+
+  def close(self, reason):
+    """Close the stream, reporting ``reason`` when the close is handled."""
+    self.close_reason = reason
+    self.stream.close()
+
+  def write(self, data, messages=1):
+    """Write bytes to the stream, tracking them until the write buffer drains.
+
+    :returns: False if the stream is closed and the bytes were not written.
+    """
+    if self.closed():
+      log.warning('Dropping %d bytes to closed %s', len(data), self)
+      return False
+    self.pending_bytes += len(data)
+    self.pending_messages += messages
+    self.stream.write(data, callback=self.__on_drained)
+    return True
+
+  def heartbeat(self):
+    """Write a heartbeat request, which is not counted as a message written to the stream."""
+    # Without a callback the drain callback of ``write`` is kept, and the write returns a
+    # future.  It fails if the peer has gone away, which is handled once the stream closes.
+    future = self.stream.write(HEARTBEAT_REQUEST)
+    future.add_done_callback(lambda future: future.exception())
+
+  def __on_drained(self):
+    messages, bytes_ = self.pending_messages, self.pending_bytes
+    self.pending_messages = self.pending_bytes = 0
+    self._on_drained(messages, bytes_)
+
+  def __str__(self):
+    return 'Connection(%s:%d, pids=%d)' % (self.endpoint[0], self.endpoint[1], len(self.pids))
+
+
+class ConnectionPool(object):
+  """A pool of outbound connections keyed by remote (ip, port) endpoint.
+
+  Every pid on an endpoint shares the endpoint's connections.  Up to
+  ``max_per_endpoint`` sockets are opened to a single endpoint, and a new
+  socket is only opened once every existing one is busy.  A pid is pinned to
+  the connection it was first assigned so that messages to it stay ordered;
+  new pids are assigned using the ``selection`` strategy.
+
+  Requests sent to an endpoint are queued in its :class:`Outbox`, bounded by
+  ``queue_limits``.  Requests sent during one event loop iteration are
+  coalesced per connection and written together on the next iteration, at
+  most ``max_batch_bytes`` and ``max_batch_messages`` per write.
+
+  If a connection fails to connect within ``connect_timeout`` seconds, or
+  fails or is reset by the peer, the messages not yet written to it stay in
+  the endpoint's outbox.  They are written once a new connection is
+  established, which is attempted after a delay given by ``backoff``; no
+  other connection to the endpoint is opened in the meantime.
+
+  Connections that have been idle for ``idle_timeout`` seconds are closed,
+  and once ``max_connections`` are open the least recently used idle
+  connection is closed to make room for a new one.  Evicted connections are
+  not reported to ``on_close``, since their peers have not gone away, and
+  connections to pids that are pinned, such as linked pids, are never
+  evicted.  ``max_connections`` may therefore be exceeded when every open
+  connection is busy or pinned.
+
+  If ``heartbeat_interval`` is set, a heartbeat request is written every
+  ``heartbeat_interval`` seconds on each connection to a pinned pid.  Every
+  peer answers it, so a connection on which nothing has been received for
+  ``heartbeat_misses`` intervals is declared dead and closed, even if the
+  stream itself has not noticed that the peer is gone.  One heartbeat is sent
+  per connection regardless of how many pinned pids share it.
+
+  Metrics:
+
+  * ``connections/connect_failures``: connection attempts that failed or timed out.
+  * ``connections/reconnects``: connections reopened to write queued messages.
+  * ``connections/evictions``: idle connections closed by the pool.
+  * ``connections/reopens``: connections opened to endpoints whose connection was evicted.
+  * ``connections/heartbeats``: heartbeats sent.
+  * ``connections/heartbeat_failures``: connections closed for missing heartbeats.
+  * ``outbox/wait_time_secs``: time messages waited in their outbox to be written.
+  * ``connections/open``: open connections, computed when a snapshot is taken.
+  * ``outbox/messages``, ``outbox/bytes``: messages and bytes queued across every
+    outbox, computed when a snapshot is taken.
+  """
+
+  class Error(Exception): pass
+  class SocketError(Error): pass
+  QueueFull = Outbox.QueueFull
+
+  ROUND_ROBIN = 'round_robin'
+  LEAST_LOADED = 'least_loaded'
+  SELECTIONS = frozenset([ROUND_ROBIN, LEAST_LOADED])
+
+  DEFAULT_MAX_BATCH_BYTES = 256 * 1024
+  DEFAULT_MAX_BATCH_MESSAGES = 1024
+
+  # The number of evicted endpoints remembered to count reopened connections.
+  EVICTED_ENDPOINTS = 65536
+
+  DEFAULT_HEARTBEAT_MISSES = 3
+
+  def __init__(self, loop, on_close, max_per_endpoint=1, selection=ROUND_ROBIN,
+               max_batch_bytes=DEFAULT_MAX_BATCH_BYTES,
+               max_batch_messages=DEFAULT_MAX_BATCH_MESSAGES,
+               queue_limits=None,
+               metrics=None,
+               resolve=None,
+               connect_timeout=None,
+               backoff=None,
+               max_connections=None,
+               idle_timeout=None,
+               heartbeat_interval=None,
+               heartbeat_misses=DEFAULT_HEARTBEAT_MISSES,
+               instruments=None):
+    """Construct a connection pool.
+
+    :param loop: The event loop on which streams are created.
+    :type loop: :class:`tornado.ioloop.IOLoop`
+    :param on_close: Called with the :class:`Connection` and a reason when a
+       connection closes.
+    :type on_close: ``callable``
+    :keyword max_per_endpoint: The maximum number of sockets per endpoint.
+    :type max_per_endpoint: ``int``
+    :keyword selection: How pids are assigned to sockets on an endpoint, either
+       ``ROUND_ROBIN`` or ``LEAST_LOADED``.
+    :type selection: ``str``
+    :keyword max_batch_bytes: The maximum number of bytes coalesced into a single write.
+    :type max_batch_bytes: ``int``
+    :keyword max_batch_messages: The maximum number of requests coalesced into a single write.
+    :type max_batch_messages: ``int``
+    :keyword queue_limits: The watermarks and overflow policy applied to each endpoint.
+    :type queue_limits: :class:`QueueLimits` or None
+    :keyword metrics: The registry in which to record connection metrics.
+    :type metrics: :class:`compactor.metrics.Metrics` or None
+    :keyword resolve: Called with a pid to return the (ip, port) endpoint to connect to
+       for it.  Defaults to the pid's own ip and port.
+    :type resolve: ``callable`` or None
+    :keyword connect_timeout: The number of seconds after which a connection that has
+       not been established is abandoned, or None to wait indefinitely.
+    :type connect_timeout: ``float`` or None
+    :keyword backoff: The delays between attempts to reconnect to an endpoint.
+    :type backoff: :class:`Backoff` or None
+    :keyword max_connections: The number of open connections beyond which idle
+       connections are evicted, least recently used first.  Unbounded by default.
+    :type max_connections: ``int`` or None
+    :keyword idle_timeout: The number of seconds after which an idle connection is
+       evicted, or None to keep idle connections open.
+    :type idle_timeout: ``float`` or None
+    :keyword heartbeat_interval: The number of seconds between heartbeats on connections
+       to pinned pids, or None to send no heartbeats.
+    :type heartbeat_interval: ``float`` or None
+    :keyword heartbeat_misses: The number of heartbeat intervals without receiving
+       anything after which a connection is declared dead.
+    :type heartbeat_misses: ``int``
+    :keyword instruments: The instruments told when connections are established and closed.
+       The list may be modified after the pool is created.
+    :type instruments: ``list`` of :class:`compactor.instrumentation.Instrument` or None
+    """
+    if max_per_endpoint < 1:
+      raise ValueError('max_per_endpoint must be at least 1')
+    if max_batch_bytes < 1 or max_batch_messages < 1:
+      raise ValueError('Batch limits must be at least 1')
+    if selection not in self.SELECTIONS:
+      raise ValueError('Unknown connection selection %r' % (selection,))
+    if max_connections is not None and max_connections < 1:
+      raise ValueError('max_connections must be at least 1')
+    if idle_timeout is not None and idle_timeout <= 0:
+      raise ValueError('idle_timeout must be positive')
+    if heartbeat_interval is not None and heartbeat_interval <= 0:
+      raise ValueError('heartbeat_interval must be positive')
+    if heartbeat_misses < 1:
+      raise ValueError('heartbeat_misses must be at least 1')
+    self._loop = loop
+    self._on_close = on_close
+    self._instruments = instruments if instruments is not None else []
+    self._max_per_endpoint = max_per_endpoint
+    self._selection = selection
+    self._connections = {}  # endpoint => [Connection]
+    self._assignments = {}  # pid => Connection
+    self._lru = OrderedDict()  # Connection => True, least recently used first
+    self._pinned = set()
+    self._evicted = LRUCache(self.EVICTED_ENDPOINTS)  # endpoints whose connection was evicted
+    self._outboxes = {}  # endpoint => Outbox
+    self._queue_limits = queue_limits or QueueLimits()
+    self._resolve = resolve or (lambda pid: (pid.ip, pid.port))
+    self._next = {}  # endpoint => round robin index
+    self._lock = threading.Lock()
+    self._max_batch_bytes = max_batch_bytes
+    self._max_batch_messages = max_batch_messages
+    self._connect_timeout = connect_timeout
+    self._backoff = backoff or Backoff()
+    self._closing = False
+    self._max_connections = max_connections
+    self._idle_timeout = idle_timeout
+    self.metrics = metrics or Metrics()
+    self._flushes = self.metrics.counter('connections/flushes')
+    self._messages_per_flush = self.metrics.histogram('connections/messages_per_flush')
+    self._dropped = self.metrics.counter('outbox/dropped_messages')
+    self._connect_failures = self.metrics.counter('connections/connect_failures')
+    self._reconnects = self.metrics.counter('connections/reconnects')
+    self._wait_time = self.metrics.histogram('outbox/wait_time_secs')
+    self._evictions = self.metrics.counter('connections/evictions')
+    self._reopens = self.metrics.counter('connections/reopens')
+    self._heartbeats = self.metrics.counter('connections/heartbeats')
+    self._heartbeat_failures = self.metrics.counter('connections/heartbeat_failures')
+    self.metrics.callback('connections/open', self.__len__)
+    self.metrics.callback('outbox/messages', lambda: self.__total_depth()[0])
+    self.metrics.callback('outbox/bytes', lambda: self.__total_depth()[1])
+    self._heartbeat_deadline = None
+    self._timers = []
+    if idle_timeout is not None:
+      self._timers.append(PeriodicCallback(self._sweep, idle_timeout * 1000 / 2, io_loop=loop))
+    if heartbeat_interval is not None:
+      self._heartbeat_deadline = heartbeat_interval * heartbeat_misses
+      self._timers.append(
+          PeriodicCallback(self._heartbeat, heartbeat_interval * 1000, io_loop=loop))
+    for timer in self._timers:
+      timer.start()
+
+  def __len__(self):
+    with self._lock:
+      return sum(len(connections) for connections in self._connections.values())
+
+  def connections(self, endpoint):
+    """Return the live connections to an endpoint."""
+    with self._lock:
+      return list(self._connections.get(endpoint, ()))
+
+  def __get_outbox(self, endpoint):
+    # must be called with self._lock held
+    outbox = self._outboxes.get(endpoint)
+    if outbox is None:
+      outbox = self._outboxes[endpoint] = Outbox(endpoint, self._queue_limits)
+    return outbox
+
+  def _outbox(self, endpoint):
+    with self._lock:
+      return self.__get_outbox(endpoint)
+
+  def endpoint(self, pid):
+    """Return the (ip, port) endpoint that messages to ``pid`` are sent to."""
+    return self._resolve(pid)
+
+  def depth(self, endpoint):
+    """Return the (messages, bytes) queued to an endpoint."""
+    with self._lock:
+      outbox = self._outboxes.get(endpoint)
+    return outbox.depth if outbox else (0, 0)
+
+  def depths(self):
+    """Return a map of endpoint to the (messages, bytes) queued to it."""
+    with self._lock:
+      outboxes = list(self._outboxes.values())
+    return dict((outbox.endpoint, outbox.depth) for outbox in outboxes)
+
+  def __total_depth(self):
+    messages = bytes_ = 0
+    for depth in self.depths().values():
+      messages += depth[0]
+      bytes_ += depth[1]
+    return messages, bytes_
+
+  def _select(self, endpoint, connections):
+    if self._selection == self.LEAST_LOADED:
+      return min(connections, key=lambda connection: connection.load)
+    index = self._next.get(endpoint, 0) % len(connections)
+    self._next[endpoint] = index + 1
+    return connections[index]
+
+  def _assign(self, pid, may_open=True):
+    # must be called with self._lock held.  Returns (None, False) if the pid has no
+    # connection and one may not be opened.
+    endpoint = self._resolve(pid)
+    connection = self._assignments.get(pid)
+    if connection and not connection.closed():
+      return connection, False
+    connections = self._connections.setdefault(endpoint, [])
+    connections[:] = [connection for connection in connections if not connection.closed()]
+    if not connections and not may_open:
+      return None, False
+    if not connections or (may_open and len(connections) < self._max_per_endpoint and
+                           all(connection.load for connection in connections)):
+      connection = self._open(endpoint)
+      # opening may evict, and so forget, another connection to this endpoint
+      self._connections.setdefault(endpoint, []).append(connection)
+      created = True
+    else:
+      connection = self._select(endpoint, connections)
+      created = False
+    connection.pids.add(pid)
+    self._assignments[pid] = connection
+    return connection, created
+
+  def pin(self, pid):
+    """Never evict the connection to ``pid``, e.g. because it is linked."""
+    with self._lock:
+      self._pinned.add(pid)
+
+  def unpin(self, pid):
+    """Allow the connection to ``pid`` to be evicted once it is idle."""
+    with self._lock:
+      self._pinned.discard(pid)
+
+  def __evictable(self, connection):
+    # must be called with self._lock held
+    return connection.idle and self._pinned.isdisjoint(connection.pids)
+
+  def __touch(self, connection):
+    # must be called with self._lock held
+    connection.last_used = self._loop.time()
+    if self._lru.pop(connection, None):
+      self._lru[connection] = True
+
+  def __forget(self, connection):
+    # must be called with self._lock held
+    connections = self._connections.get(connection.endpoint, [])
+    if connection in connections:
+      connections.remove(connection)
+    if not connections:
+      self._connections.pop(connection.endpoint, None)
+      self._next.pop(connection.endpoint, None)
+    for pid in connection.pids:
+      if self._assignments.get(pid) is connection:
+        self._assignments.pop(pid)
+    self._lru.pop(connection, None)
+
+  def __evict(self, connection, reason):
+    # must be called with self._lock held.  The connection is forgotten at once, since its
+    # close callback runs on a later iteration.
+    log.info('Evicting %s (%s)', connection, reason)
+    connection.evicted = True
+    self.__forget(connection)
+    self._evicted.put(connection.endpoint, True)
+    self._evictions.increment()
+    connection.close('evicted')
+
+  def __make_room(self):
+    # must be called with self._lock held
+    for connection in list(self._lru):
+      if len(self._lru) < self._max_connections:
+        return
+      if self.__evictable(connection):
+        self.__evict(connection, 'least recently used')
+
+  def _sweep(self):
+    """Evict connections that have been idle for longer than the idle timeout."""
+    deadline = self._loop.time() - self._idle_timeout
+    with self._lock:
+      for connection in list(self._lru):
+        if connection.last_used > deadline:
+          break
+        if self.__evictable(connection):
+          self.__evict(connection, 'idle')
+
+  def _heartbeat(self):
+    """Send a heartbeat on each connection to a pinned pid, closing those that missed too many."""
+    now = self._loop.time()
+    dead, alive = [], []
+    with self._lock:
+      for connection in self._lru:
+        if not connection.connected or self._pinned.isdisjoint(connection.pids):
+          continue
+        if now - connection.last_received > self._heartbeat_deadline:
+          dead.append(connection)
+        else:
+          alive.append(connection)
+    for connection in dead:
+      log.warning('Declaring %s dead after %.1fs without a heartbeat', connection,
+                  now - connection.last_received)
+      self._heartbeat_failures.increment()
+      connection.close('missed heartbeats')
+    for connection in alive:
+      if not connection.closed():
+        self._heartbeats.increment()
+        connection.heartbeat()
+
+  def _open(self, endpoint):
+    # must be called with self._lock held
+    if self._max_connections is not None:
+      self.__make_room()
+    if self._evicted.pop(endpoint):
+      self._reopens.increment()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
+    if not sock:
+      raise self.SocketError('Failed opening socket')
+    stream = IOStream(sock, io_loop=self._loop)
+    stream.set_nodelay(True)
+    connection = Connection(endpoint, stream, on_drained=self.__get_outbox(endpoint).release)
+    stream.set_close_callback(lambda: self._close(connection, connection.close_reason))
+    connection.last_used = self._loop.time()
+    self._lru[connection] = True
+    return connection
+
+  def _connect(self, connection):
+    def streaming_callback(data):
+      # we are not guaranteed to get an acknowledgment, but log and discard bytes if we do.
+      # Anything received shows that the peer is alive.
+      connection.last_received = self._loop.time()
+      log.debug('Received %d bytes from %s, discarding.', len(data), connection)
+
+    def on_timeout():
+      if not connection.connected:
+        log.warning('Timed out connecting to %s:%d', *connection.endpoint)
+        connection.stream.close()
+
+    timeout = None
+    if self._connect_timeout is not None:
+      timeout = self._loop.add_timeout(self._loop.time() + self._connect_timeout, on_timeout)
+
+    def on_connect():
+      log.info('Connection to %s:%d established', *connection.endpoint)
+      if timeout is not None:
+        self._loop.remove_timeout(timeout)
+      connection.connected = True
+      connection.last_received = self._loop.time()
+      for instrument in self._instruments:
+        instrument.on_connect(connection.endpoint)
+      callbacks, connection._callbacks = connection._callbacks, []
+      for callback in callbacks:
+        self._loop.add_callback(callback, connection)
+      self._flush(self._outbox(connection.endpoint))
+      connection.stream.read_until_close(lambda data: None, streaming_callback=streaming_callback)
+
+    log.info('Establishing connection to %s:%d', *connection.endpoint)
+    connection.stream.connect(connection.endpoint, callback=on_connect)
+
+  def acquire(self, pid, callback):
+    """Call ``callback`` with the connection for ``pid`` once it is established.
+
+    This must be called on the event loop.
+    """
+    callback = stack_context.wrap(callback)
+    with self._lock:
+      connection, created = self._assign(pid)
+      if not connection.connected:
+        connection._callbacks.append(callback)
+    if created:
+      self._connect(connection)
+    elif connection.connected:
+      self._loop.add_callback(callback, connection)
+
+  def send(self, pid, data, block=True):
+    """Queue an encoded request to ``pid``, as bytes or a sequence of byte segments.
+
+    Requests are coalesced with any others queued to the same connection and
+    written on the next event loop iteration, or once the connection is
+    established.  This may be called from any thread, but ``block`` must be
+    False on the event loop thread.
+
+    :raises: ``ConnectionPool.QueueFull`` if the endpoint is congested and the
+       overflow policy does not drop messages.
+    """
+    outbox = self._outbox(self._resolve(pid))
+    dropped, schedule = outbox.put(pid, data, block=block)
+    if dropped:
+      self._dropped.increment(dropped)
+      log.debug('Dropped %d messages to congested %s:%d', dropped, *outbox.endpoint)
+    if schedule:
+      self._loop.add_callback(self._flush, outbox)
+
+  def broadcast(self, requests, block=True):
+    """Queue a sequence of (pid, data) requests.
+
+    Each outbox is flushed on a later loop iteration, so requests to pids on
+    the same endpoint are coalesced into the same writes.  Flushes are
+    scheduled as requests are queued rather than once all of them are, since
+    a blocked ``put`` waits for a flush of its own outbox.  See ``send``.
+    """
+    for pid, data in requests:
+      self.send(pid, data, block=block)
+
+  def _flush(self, outbox):
+    held, pending = [], OrderedDict()
+    backing_off = self._loop.time() < outbox.retry_at
+    now = time.time()
+    for entry in outbox.take():
+      with self._lock:
+        connection, created = self._assign(entry[0], may_open=not backing_off)
+      if created:
+        self._connect(connection)
+      if connection is not None and connection.connected:
+        self._wait_time.add(now - entry[2])
+        pending.setdefault(connection, []).append(entry[1])
+      else:
+        held.append(entry)
+    if held:
+      outbox.restore(held)
+      if backing_off:
+        self.__schedule_reconnect(outbox)
+    for connection, requests in pending.items():
+      for batch in iter_batches(requests, self._max_batch_bytes, self._max_batch_messages):
+        log.debug('Flushing %d requests to %s', len(batch), connection)
+        data = join_requests(batch)
+        if not connection.write(data, len(batch)):
+          outbox.release(len(batch), len(data))
+          continue
+        with self._lock:
+          self.__touch(connection)
+        self._flushes.increment()
+        self._messages_per_flush.add(len(batch))
+
+  def _close(self, connection, reason):
+    with self._lock:
+      self.__forget(connection)
+      outbox = self._outboxes.get(connection.endpoint)
+    for instrument in self._instruments:
+      instrument.on_disconnect(connection.endpoint, reason)
+    if connection.evicted:
+      # messages sent since the connection was chosen for eviction are written on a new one
+      if outbox and outbox.unwritten:
+        self._loop.add_callback(self._flush, outbox)
+      return
+    if outbox:
+      self.__on_close(outbox, connection)
+    self._on_close(connection, reason)
+
+  def __on_close(self, outbox, connection):
+    if connection.pending_messages:
+      log.warning('Lost %d messages in flight to %s', connection.pending_messages, connection)
+      outbox.release(connection.pending_messages, connection.pending_bytes)
+    if connection.connected:
+      outbox.failures = 0
+    else:
+      outbox.failures += 1
+      self._connect_failures.increment()
+      if self._backoff.exhausted(outbox.failures):
+        lost = outbox.discard()
+        if lost:
+          self._dropped.increment(lost)
+          log.warning('Discarded %d unsent messages to unreachable %s:%d after %d attempts',
+                      lost, outbox.endpoint[0], outbox.endpoint[1], outbox.failures)
+    outbox.retry_at = self._loop.time() + self._backoff.delay(outbox.failures)
+    if outbox.unwritten and not self._closing:
+      self.__schedule_reconnect(outbox)
+
+  def __schedule_reconnect(self, outbox):
+    if outbox.reconnect is not None:
+      return
+    log.debug('Reconnecting to %s:%d in %.3fs', outbox.endpoint[0], outbox.endpoint[1],
+              max(0, outbox.retry_at - self._loop.time()))
+    outbox.reconnect = self._loop.add_timeout(outbox.retry_at, self.__reconnect, outbox)
+
+  def __reconnect(self, outbox):
+    outbox.reconnect = None
+    if outbox.unwritten:
+      self._reconnects.increment()
+      self._flush(outbox)
+
+  def close(self):
+    """Close every connection in the pool."""
+    self._closing = True
+    for timer in self._timers:
+      timer.stop()
+    with self._lock:
+      connections = [connection for endpoint_connections in self._connections.values()
+                     for connection in endpoint_connections]
+    with self._lock:
+      outboxes = list(self._outboxes.values())
+    for outbox in outboxes:
+      if outbox.reconnect is not None:
+        self._loop.remove_timeout(outbox.reconnect)
+        outbox.reconnect = None
+    for connection in connections:
+      connection.stream.close()
@@ -10,13 +10,19 @@ except ImportError:
   import trollius as asyncio
 
 from collections import defaultdict
-from functools import partial
 
-from .httpd import HTTPD
-from .request import encode_request
+from .connection import ConnectionPool, request_size
+from .coroutines import CoroutineRunner, is_coroutine_function
+from .executor import BlockingPool, ComputePool
+from .httpd import HTTPD, JSONHandler
+from .instrumentation import FlightRecorder
+from .mailbox import Priority, Scheduler
+from .metrics import Metrics
+from .pid import PID
+from .profiler import Profiler, ProfileHandler
+from .request import encode_request_segments
+from .watchdog import LoopMonitor, Watchdog
 
-from tornado import stack_context
-from tornado.iostream import IOStream
 from tornado.netutil import bind_sockets
 from tornado.platform.asyncio import BaseAsyncIOLoop
 
@@ -29,18 +35,38 @@ class Context(threading.Thread):
   Compactor contexts control the routing and handling of messages between
   processes.  At its most basic level, a context is a listening (ip, port)
   pair and an event loop.
+
+  A JSON snapshot of the context's metrics is served at ``/metrics/snapshot``,
+  the lag of its loop and recent slow handlers at ``/loop/status`` and, if
+  enabled, its flight recorder at ``/flight_recorder/dump`` and a profiler at
+  ``/profiler/profile``.
+  Besides those of its connections, mailboxes and pools, the context counts:
+
+  * ``messages/local``: messages delivered to local processes without the wire.
+  * ``messages/remote``: messages sent to remote processes.
+  * ``messages/received``: messages received over the wire.
+  * ``bytes/sent``, ``bytes/received``: bytes of messages sent and received over the wire.
+  * ``processes``: processes bound to the context, computed when a snapshot is taken.
+  * ``<id>/messages/<name>/sent``, ``<id>/messages/<name>/received``: messages sent and
+    received by each process, local or remote, per message name.
   """
 
   class Error(Exception): pass
   class SocketError(Error): pass
   class InvalidProcess(Error): pass
   class InvalidMethod(Error): pass
+  class QueueFull(Error): pass
 
   _SINGLETON = None
   _LOCK = threading.Lock()
 
   CONNECT_TIMEOUT_SECS = 5
 
+  METRICS_PATH = '/metrics/snapshot'
+  LOOP_STATUS_PATH = '/loop/status'
+  FLIGHT_RECORDER_PATH = '/flight_recorder/dump'
+  PROFILER_PATH = '/profiler/profile'
+
   @classmethod
   def _make_socket(cls, ip, port):
     """Bind to a new socket.
@@ -48,8 +74,12 @@ class Context(threading.Thread):
     If LIBPROCESS_PORT or LIBPROCESS_IP are configured in the environment,
     these will be used for socket connectivity.
     """
-    bound_socket = bind_sockets(port, address=ip)[0]
-    ip, port = bound_socket.getsockname()
+    return cls._adopt_socket(bind_sockets(port, address=ip)[0])
+
+  @classmethod
+  def _adopt_socket(cls, bound_socket):
+    """Return a bound socket along with the (ip, port) at which it is reachable."""
+    ip, port = bound_socket.getsockname()[:2]
 
     if not ip or ip == '0.0.0.0':
       ip = socket.gethostbyname(socket.gethostname())
@@ -76,7 +106,19 @@ class Context(threading.Thread):
         cls._SINGLETON.start()
     return cls._SINGLETON
 
-  def __init__(self, delegate='', loop=None, ip=None, port=None):
+  def __init__(self, delegate='', loop=None, ip=None, port=None,
+               max_connections_per_endpoint=1, connection_selection=ConnectionPool.ROUND_ROBIN,
+               max_batch_bytes=ConnectionPool.DEFAULT_MAX_BATCH_BYTES,
+               max_batch_messages=ConnectionPool.DEFAULT_MAX_BATCH_MESSAGES,
+               queue_limits=None, wire_protocol_fast_path=False, sock=None, placement=None,
+               compute_workers=None, blocking_workers=None, max_coroutines_per_process=None,
+               scheduling=Scheduler.ROUND_ROBIN, mailbox_budget=Scheduler.DEFAULT_BUDGET,
+               starvation_limit=Scheduler.DEFAULT_STARVATION_LIMIT, reconnect_backoff=None,
+               max_connections=None, connection_idle_timeout=None, heartbeat_interval=None,
+               heartbeat_misses=ConnectionPool.DEFAULT_HEARTBEAT_MISSES,
+               loop_monitor_interval=LoopMonitor.DEFAULT_INTERVAL_SECS,
+               slow_handler_threshold=Watchdog.DEFAULT_THRESHOLD_SECS, capture_slow_stacks=False,
+               instruments=None, flight_recorder_size=None, profiling=False):
     """Construct a compactor context.
 
     Before any useful work can be done with a context, you must call
@@ -92,18 +134,157 @@ class Context(threading.Thread):
        environment variable.  If this variable is not set, it will bind to an ephemeral
        port.
     :type port: ``int`` or None
+    :keyword max_connections_per_endpoint: The maximum number of outbound sockets opened
+       to a single remote (ip, port).  Every remote pid on that endpoint shares them.
+    :type max_connections_per_endpoint: ``int``
+    :keyword connection_selection: How remote pids are assigned to the sockets of an
+       endpoint, either ``ConnectionPool.ROUND_ROBIN`` or ``ConnectionPool.LEAST_LOADED``.
+    :type connection_selection: ``str``
+    :keyword max_batch_bytes: Outbound messages queued to a connection during one event
+       loop iteration are coalesced into writes of at most this many bytes.
+    :type max_batch_bytes: ``int``
+    :keyword max_batch_messages: The maximum number of outbound messages coalesced into
+       a single write.
+    :type max_batch_messages: ``int``
+    :keyword queue_limits: High and low watermarks bounding the messages queued to each
+       remote (ip, port), and the policy to apply when they are exceeded.  By default
+       outbound queues are unbounded.
+    :type queue_limits: :class:`compactor.connection.QueueLimits` or None
+    :keyword reconnect_backoff: The delays between attempts to reconnect to a remote
+       (ip, port) whose connection failed, during which messages to it stay queued.
+       Connection attempts time out after ``CONNECT_TIMEOUT_SECS``.
+    :type reconnect_backoff: :class:`compactor.connection.Backoff` or None
+    :keyword max_connections: The number of open outbound sockets beyond which the least
+       recently used idle socket is closed.  Sockets to linked pids are never closed this
+       way, and closing an idle socket does not cause ``exited`` to be called.
+       Unbounded by default.
+    :type max_connections: ``int`` or None
+    :keyword connection_idle_timeout: The number of seconds after which an idle outbound
+       socket, other than one to a linked pid, is closed.  By default idle sockets stay open.
+    :type connection_idle_timeout: ``float`` or None
+    :keyword heartbeat_interval: If set, a heartbeat is sent every ``heartbeat_interval``
+       seconds on each outbound socket to a linked pid.  A socket on which nothing has been
+       received for ``heartbeat_misses`` intervals is closed, and processes linked to pids
+       on it are sent ``exited``.  One heartbeat is sent per remote (ip, port) no matter
+       how many links it carries.
+    :type heartbeat_interval: ``float`` or None
+    :keyword heartbeat_misses: The number of heartbeat intervals without a response after
+       which a linked socket is declared dead.
+    :type heartbeat_misses: ``int``
+    :keyword wire_protocol_fast_path: If True, inbound libprocess messages are parsed
+       directly off the socket and delivered without tornado's request handling.
+       Other requests, such as those to ``Process.route`` endpoints, are unaffected.
+    :type wire_protocol_fast_path: ``bool``
+    :keyword sock: A bound socket on which to listen instead of binding a new one.  When
+       provided, ``ip`` and ``port`` are ignored.
+    :type sock: ``socket.socket`` or None
+    :keyword placement: The placement of this context within a
+       :class:`compactor.cluster.ContextCluster`.  Only processes placed on this context
+       may be spawned on it, and messages for processes placed elsewhere in the cluster
+       are forwarded to their owners.  Implies ``wire_protocol_fast_path``.
+    :type placement: :class:`compactor.cluster.Placement` or None
+    :keyword compute_workers: The number of processes in the pool used by ``compute``
+       and ``Process.cpu_bound`` handlers.  Defaults to the number of CPUs.  The pool
+       is only started when work is first offloaded to it.
+    :type compute_workers: ``int`` or None
+    :keyword blocking_workers: The number of threads in the pool used by ``defer`` and
+       ``Process.blocking`` handlers.  Defaults to ``BlockingPool.DEFAULT_MAX_WORKERS``.
+    :type blocking_workers: ``int`` or None
+    :keyword max_coroutines_per_process: The maximum number of coroutine (``async def``)
+       handlers that may run at once for each process.  Further messages and requests for
+       coroutine handlers wait until one completes.  Unbounded by default.
+    :type max_coroutines_per_process: ``int`` or None
+    :keyword scheduling: How the mailboxes of processes with pending messages take turns,
+       either ``Scheduler.ROUND_ROBIN`` or ``Scheduler.WEIGHTED``, in which case each
+       process' turn is scaled by its ``Process.weight``.
+    :type scheduling: ``str``
+    :keyword mailbox_budget: The number of messages a process may handle per turn before
+       other processes with pending messages are serviced.
+    :type mailbox_budget: ``int``
+    :keyword starvation_limit: The number of consecutive turns that mailboxes with
+       messages of one priority may be passed over for higher priority messages.
+    :type starvation_limit: ``int``
+    :keyword loop_monitor_interval: The number of seconds between ticks of a timer whose
+       lateness measures how long the loop is held up, recorded as ``loop/lag_secs``.
+       None disables the monitor.
+    :type loop_monitor_interval: ``float`` or None
+    :keyword slow_handler_threshold: The number of seconds after which the invocation of a
+       mailbox or route handler is logged as holding up the loop, naming the process and
+       mailbox or route, and counted as ``loop/slow_handlers``.  None disables timing.
+    :type slow_handler_threshold: ``float`` or None
+    :keyword capture_slow_stacks: If True, the stack of the loop thread is captured while a
+       handler is over ``slow_handler_threshold``, to be served at ``/loop/status``.
+    :type capture_slow_stacks: ``bool``
+    :keyword instruments: Instruments to be told of every message sent, delivered and
+       handled, and of every outbound connection established and closed.  See
+       ``add_instrument``.
+    :type instruments: iterable of :class:`compactor.instrumentation.Instrument` or None
+    :keyword flight_recorder_size: If set, the metadata of this many of the most recent
+       messages and connection events is kept by ``flight_recorder`` and served at
+       ``/flight_recorder/dump``.
+    :type flight_recorder_size: ``int`` or None
+    :keyword profiling: If True, the context's loop may be profiled on demand with
+       ``profiler`` or at ``/profiler/profile``.  See :class:`compactor.profiler.ProfileHandler`.
+    :type profiling: ``bool``
     """
     self._processes = {}
-    self._links = defaultdict(set)
+    self._mailboxes = {}  # (pid, mailbox) => bound handler
+    self._links = defaultdict(set)  # pid => pids it is linked to
+    self._linked_by = defaultdict(set)  # pid => local pids linked to it
+    self._links_lock = threading.Lock()
     self.delegate = delegate
     self.__loop = self.http = None
     self.__event_loop = loop
     self._ip = None
-    ip, port = self.get_ip_port(ip, port)
-    self.__sock, self.ip, self.port = self._make_socket(ip, port)
-    self._connections = {}
-    self._connection_callbacks = defaultdict(list)
-    self._connection_callbacks_lock = threading.Lock()
+    if sock is None:
+      ip, port = self.get_ip_port(ip, port)
+      self.__sock, self.ip, self.port = self._make_socket(ip, port)
+    else:
+      self.__sock, self.ip, self.port = self._adopt_socket(sock)
+    self._connections = None
+    self.__max_connections_per_endpoint = max_connections_per_endpoint
+    self.__connection_selection = connection_selection
+    self.__max_batch_bytes = max_batch_bytes
+    self.__max_batch_messages = max_batch_messages
+    self.__queue_limits = queue_limits
+    self.__reconnect_backoff = reconnect_backoff
+    self.__max_connections = max_connections
+    self.__connection_idle_timeout = connection_idle_timeout
+    self.__heartbeat_interval = heartbeat_interval
+    self.__heartbeat_misses = heartbeat_misses
+    self.__wire_protocol_fast_path = wire_protocol_fast_path or placement is not None
+    self.__placement = placement
+    self.__compute_workers = compute_workers
+    self.__blocking_workers = blocking_workers
+    self.__max_coroutines_per_process = max_coroutines_per_process
+    self.__scheduling = scheduling
+    self.__mailbox_budget = mailbox_budget
+    self.__starvation_limit = starvation_limit
+    self.__monitor = None
+    if loop_monitor_interval is not None and loop_monitor_interval <= 0:
+      raise ValueError('loop_monitor_interval must be positive.')
+    self.__loop_monitor_interval = loop_monitor_interval
+    self._compute = self._blocking = self._coroutines = self._scheduler = None
+    self.metrics = Metrics()
+    self._message_counters = {}  # pid => {(message name, 'sent' or 'received'): Counter}
+    self._local_messages = self.metrics.counter('messages/local')
+    self._remote_messages = self.metrics.counter('messages/remote')
+    self._received_messages = self.metrics.counter('messages/received')
+    self._bytes_sent = self.metrics.counter('bytes/sent')
+    self._bytes_received = self.metrics.counter('bytes/received')
+    self.metrics.callback('processes', lambda: len(self._processes))
+    self._instruments = list(instruments or ())
+    self._watchdog = None
+    if slow_handler_threshold is not None:
+      self._watchdog = Watchdog(
+          slow_handler_threshold, capture_stacks=capture_slow_stacks, metrics=self.metrics)
+      self._instruments.append(self._watchdog)
+    self.flight_recorder = None
+    if flight_recorder_size is not None:
+      self.flight_recorder = FlightRecorder(flight_recorder_size)
+      self._instruments.append(self.flight_recorder)
+    self.__profiling = profiling
+    self.profiler = None
     self.__context_name = 'CompactorContext(%s:%d)' % (self.ip, self.port)
     super(Context, self).__init__(name=self.__context_name)
     self.daemon = True
@@ -134,13 +315,107 @@ class Context(threading.Thread):
         super(CustomIOLoop, self).initialize(loop, close_loop=False)
 
     self.__loop = CustomIOLoop()
-    self.http = HTTPD(self.__sock, self.__loop)
+    self._connections = ConnectionPool(
+        self.__loop,
+        self.__on_exit,
+        max_per_endpoint=self.__max_connections_per_endpoint,
+        selection=self.__connection_selection,
+        max_batch_bytes=self.__max_batch_bytes,
+        max_batch_messages=self.__max_batch_messages,
+        queue_limits=self.__queue_limits,
+        metrics=self.metrics,
+        resolve=self.__resolve,
+        connect_timeout=self.CONNECT_TIMEOUT_SECS,
+        backoff=self.__reconnect_backoff,
+        max_connections=self.__max_connections,
+        idle_timeout=self.__connection_idle_timeout,
+        heartbeat_interval=self.__heartbeat_interval,
+        heartbeat_misses=self.__heartbeat_misses,
+        instruments=self._instruments)
+    self._compute = ComputePool(
+        self.__loop, max_workers=self.__compute_workers, metrics=self.metrics)
+    self._blocking = BlockingPool(
+        self.__loop, max_workers=self.__blocking_workers, metrics=self.metrics)
+    self._scheduler = Scheduler(
+        self.__loop,
+        policy=self.__scheduling,
+        budget=self.__mailbox_budget,
+        starvation_limit=self.__starvation_limit,
+        metrics=self.metrics,
+        instruments=self._instruments)
+    self._coroutines = CoroutineRunner(
+        self.__loop.asyncio_loop,
+        max_in_flight=self.__max_coroutines_per_process,
+        metrics=self.metrics)
+    self.http = HTTPD(
+        self.__sock,
+        self.__loop,
+        fast_path=self.__wire_protocol_fast_path,
+        forward=self._forward if self.__placement else None,
+        instruments=self._instruments)
+    if self.__placement:
+      self.http.listen(self.__placement.sock)
+    self.http.mount(self.METRICS_PATH, JSONHandler, snapshot=self.metrics.snapshot)
+    self.http.mount(self.LOOP_STATUS_PATH, JSONHandler, snapshot=self.__loop_status)
+    if self.flight_recorder is not None:
+      self.http.mount(self.FLIGHT_RECORDER_PATH, JSONHandler, snapshot=self.flight_recorder.dump)
+    if self.__profiling:
+      self.profiler = Profiler(self.__loop, self._instruments)
+      self.http.mount(self.PROFILER_PATH, ProfileHandler, profiler=self.profiler)
+    if self.__loop_monitor_interval is not None:
+      self.__monitor = LoopMonitor(
+          self.__loop, interval=self.__loop_monitor_interval, metrics=self.metrics)
+      self.__monitor.start()
+    if self._watchdog is not None:
+      self._watchdog.start()
 
     self.__loop_started.set()
 
     self.__loop.start()
     self.__loop.close()
 
+  def add_instrument(self, instrument):
+    """Tell ``instrument`` of every message and connection event from now on.
+
+    :param instrument: The instrument.
+    :type instrument: :class:`compactor.instrumentation.Instrument`
+    """
+    self._instruments.append(instrument)
+
+  def remove_instrument(self, instrument):
+    """Stop telling ``instrument`` of events.
+
+    :param instrument: An instrument previously passed to ``add_instrument``.
+    :type instrument: :class:`compactor.instrumentation.Instrument`
+    """
+    self._instruments.remove(instrument)
+
+  def __loop_status(self):
+    return {
+      'monitor': self.__monitor.status() if self.__monitor else None,
+      'slow_handlers': self._watchdog.status() if self._watchdog else None,
+    }
+
+  def __resolve(self, pid):
+    # Processes placed on another worker of our cluster share our public endpoint,
+    # so connect to their worker's private forwarding endpoint instead.
+    if (self.__placement is not None and pid.port == self.port and pid.ip == self.ip and
+        not self.__placement.owns(pid.id)):
+      return self.__placement.forward_endpoint(pid.id)
+    return pid.ip, pid.port
+
+  def _forward(self, from_pid, to_id, method, body):
+    """Forward a message that arrived for a process placed on another worker.
+
+    :returns: False if the process is placed on this context, True otherwise.
+    """
+    if self.__placement is None or self.__placement.owns(to_id):
+      return False
+    to_pid = PID.intern(self.ip, self.port, to_id)
+    self._connections.send(
+        to_pid, encode_request_segments(from_pid, to_pid, method, body=body), block=False)
+    return True
+
   def _is_local(self, pid):
     return pid in self._processes
 
@@ -159,11 +434,13 @@ class Context(threading.Thread):
     for pid in pids:
       self.terminate(pid)
 
-    while self._connections:
-      pid = next(iter(self._connections))
-      conn = self._connections.pop(pid, None)
-      if conn:
-        conn.close()
+    self._connections.close()
+    if self.__monitor is not None:
+      self.__monitor.stop()
+    if self._watchdog is not None:
+      self._watchdog.stop()
+    self._compute.shutdown()
+    self._blocking.shutdown()
 
     self.__loop.stop()
 
@@ -181,8 +458,15 @@ class Context(threading.Thread):
     :rtype: :class:`PID`
     """
     self._assert_started()
+    if self.__placement is not None and not self.__placement.owns(process.name):
+      raise self.InvalidProcess('%s is placed on worker %d' % (
+          process.name, self.__placement.worker_for(process.name)))
     process.bind(self)
+    self._scheduler.add(process.pid, weight=process.weight)
     self.http.mount_process(process)
+    for mailbox, handler in process.message_handlers:
+      self._mailboxes[(process.pid, mailbox)] = handler
+    self._message_counters[process.pid] = {}
     self._processes[process.pid] = process
     process.initialize()
     return process.pid
@@ -213,7 +497,10 @@ class Context(threading.Thread):
     self._assert_started()
     self._assert_local_pid(pid)
     function = self._get_dispatch_method(pid, method)
-    self.__loop.add_callback(function, *args)
+    if is_coroutine_function(function):
+      self.__loop.add_callback(self.run_coroutine, pid, function, *args)
+    else:
+      self.__loop.add_callback(function, *args)
 
   def delay(self, amount, pid, method, *args):
     """Call a method on another process after a specified delay.
@@ -234,79 +521,146 @@ class Context(threading.Thread):
     self._assert_started()
     self._assert_local_pid(pid)
     function = self._get_dispatch_method(pid, method)
-    self.__loop.add_timeout(self.__loop.time() + amount, function, *args)
+    if is_coroutine_function(function):
+      self.__loop.add_timeout(
+          self.__loop.time() + amount, self.run_coroutine, pid, function, *args)
+    else:
+      self.__loop.add_timeout(self.__loop.time() + amount, function, *args)
 
-  def __dispatch_on_connect_callbacks(self, to_pid, stream):
-    with self._connection_callbacks_lock:
-      callbacks = self._connection_callbacks.pop(to_pid, [])
-    for callback in callbacks:
-      log.debug('Dispatching connection callback %s for %s:%s -> %s' % (
-          callback, self.ip, self.port, to_pid))
-      self.__loop.add_callback(callback, stream)
+  def deliver(self, pid, handler, *args, **kw):
+    """Queue a call to a handler in the mailbox of a local process.
 
-  def _maybe_connect(self, to_pid, callback=None):
-    """Asynchronously establish a connection to the remote pid."""
-
-    callback = stack_context.wrap(callback or (lambda stream: None))
-
-    def streaming_callback(data):
-      # we are not guaranteed to get an acknowledgment, but log and discard bytes if we do.
-      log.info('Received %d bytes from %s, discarding.' % (len(data), to_pid))
-      log.debug('  data: %r' % (data,))
-
-    def on_connect(exit_cb, stream):
-      log.info('Connection to %s established' % to_pid)
-      with self._connection_callbacks_lock:
-        self._connections[to_pid] = stream
-      self.__dispatch_on_connect_callbacks(to_pid, stream)
-      self.__loop.add_callback(
-          stream.read_until_close,
-          exit_cb,
-          streaming_callback=streaming_callback)
-
-    create = False
-    with self._connection_callbacks_lock:
-      stream = self._connections.get(to_pid)
-      callbacks = self._connection_callbacks.get(to_pid)
-
-      if not stream:
-        self._connection_callbacks[to_pid].append(callback)
-
-        if not callbacks:
-          create = True
-
-    if stream:
-      self.__loop.add_callback(callback, stream)
-      return
+    The call is made on the context's loop on the process' turn, in order
+    with every other message of the same priority delivered to the process.
+    See the context's ``scheduling``, ``mailbox_budget`` and
+    ``starvation_limit`` options.
+
+    This method returns immediately and may be called from any thread.
+
+    :param pid: The pid of the process.
+    :type pid: :class:`PID`
+    :param handler: The handler to call with ``args``.
+    :type handler: ``callable``
+    :keyword priority: The priority of the call, by default the priority with which
+       ``handler`` was installed.
+    :type priority: One of ``Priority.ALL`` or None
+    :return: False if the process is not bound to this context, True otherwise.
+    """
+    priority = kw.pop('priority', None)
+    if kw:
+      raise TypeError('Unexpected keyword arguments: %s' % ', '.join(kw))
+    return self._scheduler.deliver(pid, handler, *args, priority=priority)
 
-    if not create:
+  def receive(self, pid, name, from_pid, body):
+    """Deliver a message that arrived over the wire to the mailbox of a local process.
+
+    :param pid: The pid of the destination process.
+    :type pid: :class:`PID`
+    :param name: The name of the message.
+    :type name: ``str``
+    :param from_pid: The pid of the sending process.
+    :type from_pid: :class:`PID`
+    :param body: The body of the message.
+    :type body: ``bytes``
+    :return: False if the process has no handler for ``name``, True otherwise.
+    """
+    handler = self._mailboxes.get((pid, name))
+    if handler is None:
+      return False
+    self._received_messages.increment()
+    self._bytes_received.increment(len(body))
+    self.__count(pid, name, 'received')
+    for instrument in self._instruments:
+      instrument.on_deliver(pid, name, from_pid, len(body))
+    return self._scheduler.deliver(pid, handler, from_pid, body)
+
+  def __count(self, pid, name, direction, amount=1):
+    # Count messages named ``name`` sent or received, per ``direction``, by a local process.
+    counters = self._message_counters.get(pid)
+    if counters is None:
       return
+    counter = counters.get((name, direction))
+    if counter is None:
+      counter = counters[(name, direction)] = self.metrics.counter(
+          '%s/messages/%s/%s' % (pid.id, name, direction))
+    counter.increment(amount)
+
+  def mailbox_depth(self, pid):
+    """Return the number of messages waiting in the mailbox of a local process.
+
+    :param pid: The pid of the process.
+    :type pid: :class:`PID`
+    """
+    self._assert_started()
+    return self._scheduler.depth(pid)
 
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
-    if not sock:
-      raise self.SocketError('Failed opening socket')
+  def run_coroutine(self, pid, fn, *args):
+    """Run a coroutine on the context's asyncio loop on behalf of a process.
 
-    stream = IOStream(sock, io_loop=self.__loop)
-    stream.set_nodelay(True)
-    stream.set_close_callback(partial(self.__on_exit, to_pid, b'reached end of stream'))
+    The coroutine ``fn(*args)`` is run as an asyncio task, subject to the
+    context's ``max_coroutines_per_process``.  This must be called from the
+    context's loop, as coroutine handlers are.
 
-    connect_callback = partial(on_connect, partial(self.__on_exit, to_pid), stream)
+    :param pid: The pid of the process running the coroutine.
+    :type pid: :class:`PID`
+    :param fn: A coroutine function, such as an ``async def`` method.
+    :type fn: ``callable``
+    :return: A future resolved with the result of the coroutine.
+    :rtype: ``tornado.concurrent.Future``
+    """
+    self._assert_started()
+    return self._coroutines.run(pid, fn, *args)
+
+  def compute(self, fn, *args):
+    """Call a function in the context's process pool.
+
+    Use this for CPU-bound work that would otherwise stall every process on
+    the context's event loop.  ``fn`` must be picklable, i.e. a module level
+    function, as must its arguments and return value.
 
-    log.info('Establishing connection to %s' % to_pid)
+    This function returns immediately.
 
-    stream.connect((to_pid.ip, to_pid.port), callback=connect_callback)
+    :param fn: The function to call.
+    :type fn: ``callable``
+    :return: A future resolved with the result of ``fn(*args)`` on the context's loop.
+    :rtype: ``tornado.concurrent.Future``
+    """
+    self._assert_started()
+    return self._compute.submit(fn, *args)
 
-    if stream.closed():
-      raise self.SocketError('Failed to initiate stream connection')
+  def defer(self, pid, fn, *args):
+    """Call a blocking function in the context's thread pool on behalf of a process.
 
-    log.info('Maybe connected to %s' % to_pid)
+    Use this for blocking I/O, such as disk or database calls, that would
+    otherwise stall every process on the context's event loop.  The results
+    of calls deferred by the same pid are resolved on the loop in the order
+    the calls were made.
+
+    This function returns immediately.
+
+    :param pid: The pid of the process making the call.
+    :type pid: :class:`PID`
+    :param fn: The function to call.
+    :type fn: ``callable``
+    :return: A future resolved with the result of ``fn(*args)`` on the context's loop.
+    :rtype: ``tornado.concurrent.Future``
+    """
+    self._assert_started()
+    return self._blocking.submit_ordered(pid, fn, *args)
+
+  def _maybe_connect(self, to_pid, callback=None):
+    """Asynchronously establish a connection to the remote pid.
+
+    Connections are pooled by endpoint, so every pid on the same (ip, port)
+    shares the same sockets.
+    """
+
+    self._connections.acquire(to_pid, callback or (lambda connection: None))
 
   def _get_local_mailbox(self, pid, method):
-    for mailbox, callable in self._processes[pid].iter_handlers():
-      if method == mailbox:
-        return callable
+    return self._mailboxes.get((pid, method))
 
-  def send(self, from_pid, to_pid, method, body=None):
+  def send(self, from_pid, to_pid, method, body=None, priority=None):
     """Send a message method from one pid to another with an optional body.
 
     Note: It is more idiomatic to send directly from a bound process rather than
@@ -326,6 +680,12 @@ class Context(threading.Thread):
     :type method: ``str``
     :keyword body: Optional content to send along with the message.
     :type body: ``bytes`` or None
+    :keyword priority: The priority with which a local destination handles the message,
+       by default the priority with which its handler was installed.  Remote
+       destinations always use the priority of their installed handler.
+    :type priority: One of ``Priority.ALL`` or None
+    :raises: ``Context.QueueFull`` if the destination's outbound queue is congested
+       and the context's ``queue_limits`` policy is to raise or to block.
     :return: Nothing
     """
 
@@ -335,41 +695,171 @@ class Context(threading.Thread):
     if self._is_local(to_pid):
       local_method = self._get_local_mailbox(to_pid, method)
       if local_method:
-        log.info('Doing local dispatch of %s => %s (method: %s)' % (from_pid, to_pid, local_method))
-        self.__loop.add_callback(local_method, from_pid, body or b'')
+        body = body or b''
+        self._local_messages.increment()
+        self.__count(from_pid, method, 'sent')
+        self.__count(to_pid, method, 'received')
+        for instrument in self._instruments:
+          instrument.on_send(from_pid, to_pid, method, len(body))
+          instrument.on_deliver(to_pid, method, from_pid, len(body))
+        self._scheduler.deliver(to_pid, local_method, from_pid, body, priority=priority)
         return
       else:
         # TODO(wickman) Consider failing hard if no local method is detected, otherwise we're
         # just going to do a POST and have it dropped on the floor.
         pass
 
-    request_data = encode_request(from_pid, to_pid, method, body=body)
+    request_data = encode_request_segments(from_pid, to_pid, method, body=body)
+    size = request_size(request_data)
+    self._remote_messages.increment()
+    self._bytes_sent.increment(size)
+    self.__count(from_pid, method, 'sent')
+    for instrument in self._instruments:
+      instrument.on_send(from_pid, to_pid, method, size)
+
+    try:
+      self._connections.send(to_pid, request_data, block=threading.current_thread() is not self)
+    except ConnectionPool.QueueFull as e:
+      raise self.QueueFull(str(e))
+
+  def broadcast(self, from_pid, to_pids, method, body=None, priority=None):
+    """Send the same message method and body from one pid to many others.
 
-    log.info('Sending POST %s => %s (payload: %d bytes)' % (
-             from_pid, to_pid.as_url(method), len(request_data)))
+    The body is validated once and shared by the request to every
+    destination without being copied.  Messages to destinations on the same remote endpoint are
+    queued together and coalesced into the same writes.
 
-    def on_connect(stream):
-      log.info('Writing %s from %s to %s' % (len(request_data), from_pid, to_pid))
-      stream.write(request_data)
-      log.info('Wrote %s from %s to %s' % (len(request_data), from_pid, to_pid))
+    This method returns immediately.
 
-    self.__loop.add_callback(self._maybe_connect, to_pid, on_connect)
+    :param from_pid: The pid of the sending process.
+    :type from_pid: :class:`PID`
+    :param to_pids: The pids of the destination processes.
+    :type to_pids: iterable of :class:`PID`
+    :param method: The method name of the destination processes.
+    :type method: ``str``
+    :keyword body: Optional content to send along with the message.
+    :type body: ``bytes`` or None
+    :keyword priority: The priority with which local destinations handle the message.
+       See ``send``.
+    :type priority: One of ``Priority.ALL`` or None
+    :raises: ``Context.QueueFull`` if a destination's outbound queue is congested
+       and the context's ``queue_limits`` policy is to raise or to block.
+    :return: Nothing
+    """
 
-  def __erase_link(self, to_pid):
-    for pid, links in self._links.items():
+    self._assert_started()
+    self._assert_local_pid(from_pid)
+
+    if body is None:
+      body = b''
+
+    if not isinstance(body, (bytes, bytearray)):
+      raise TypeError('Body must be a sequence of bytes.')
+
+    requests = []
+    delivered = 0
+    for to_pid in to_pids:
+      if self._is_local(to_pid):
+        local_method = self._get_local_mailbox(to_pid, method)
+        if local_method:
+          self._local_messages.increment()
+          self.__count(to_pid, method, 'received')
+          for instrument in self._instruments:
+            instrument.on_send(from_pid, to_pid, method, len(body))
+            instrument.on_deliver(to_pid, method, from_pid, len(body))
+          self._scheduler.deliver(to_pid, local_method, from_pid, body, priority=priority)
+          delivered += 1
+          continue
+      request_data = encode_request_segments(from_pid, to_pid, method, body=body)
+      size = request_size(request_data)
+      self._bytes_sent.increment(size)
+      for instrument in self._instruments:
+        instrument.on_send(from_pid, to_pid, method, size)
+      requests.append((to_pid, request_data))
+
+    self.__count(from_pid, method, 'sent', delivered + len(requests))
+    if not requests:
+      return
+    self._remote_messages.increment(len(requests))
+
+    log.debug('Broadcasting POST %s => %d remote pids (method: %s, payload: %d bytes)',
+              from_pid, len(requests), method, len(body))
+
+    try:
+      self._connections.broadcast(requests, block=threading.current_thread() is not self)
+    except ConnectionPool.QueueFull as e:
+      raise self.QueueFull(str(e))
+
+  def queue_depth(self, pid):
+    """Return the number of messages and bytes queued to the endpoint of a remote pid.
+
+    Messages count toward the depth of their destination from the time they
+    are sent until they have been written to its socket.
+
+    :param pid: The remote pid.
+    :type pid: :class:`PID`
+    :return: A (messages, bytes) tuple.
+    """
+    self._assert_started()
+    return self._connections.depth(self._connections.endpoint(pid))
+
+  def queue_depths(self):
+    """Return the outbound queue depth of every remote endpoint.
+
+    :return: A dictionary mapping (ip, port) tuples to (messages, bytes) tuples.
+    """
+    self._assert_started()
+    return self._connections.depths()
+
+  @staticmethod
+  def _notify_exited(process, to_pids):
+    for to_pid in to_pids:
       try:
-        links.remove(to_pid)
-        log.debug('PID link from %s <- %s exited.' % (pid, to_pid))
-        self._processes[pid].exited(to_pid)
-      except KeyError:
+        process.exited(to_pid)
+      except Exception:
+        log.exception('%s failed to handle the exit of %s', process.pid, to_pid)
+
+  def __erase_links(self, to_pids):
+    # Only the processes linked to ``to_pids`` are visited, and each is sent a single
+    # message that calls ``exited`` for every one of them it was linked to.
+    exits = defaultdict(list)
+    with self._links_lock:
+      for to_pid in to_pids:
+        for pid in self._linked_by.pop(to_pid, ()):
+          links = self._links.get(pid)
+          if links is not None:
+            links.discard(to_pid)
+            if not links:
+              del self._links[pid]
+          exits[pid].append(to_pid)
+    for to_pid in to_pids:
+      self._connections.unpin(to_pid)
+    for pid, exited_pids in exits.items():
+      process = self._processes.get(pid)
+      if process is None:
         continue
-
-  def __on_exit(self, to_pid, body):
-    log.info('Disconnected from %s (%s)', to_pid, body)
-    stream = self._connections.pop(to_pid, None)
-    if stream is None:
-      log.error('Received disconnection from %s but no stream found.' % to_pid)
-    self.__erase_link(to_pid)
+      log.debug('PID links from %s <- %s exited.', pid, exited_pids)
+      self._scheduler.deliver(
+          pid, self._notify_exited, process, exited_pids, priority=Priority.HIGH)
+
+  def __unlink_all(self, pid):
+    # Remove the links of a terminated process so it is no longer notified of exits.
+    unpinned = []
+    with self._links_lock:
+      for to_pid in self._links.pop(pid, ()):
+        linked_by = self._linked_by.get(to_pid)
+        if linked_by is None:
+          continue
+        linked_by.discard(pid)
+        if not linked_by:
+          del self._linked_by[to_pid]
+          unpinned.append(to_pid)
+    for to_pid in unpinned:
+      self._connections.unpin(to_pid)
+
+  def __on_exit(self, connection, body):
+    log.info('Disconnected from %s (%s)', connection, body)
+    self.__erase_links(connection.pids)
 
   def link(self, pid, to):
     """Link a local process to a possibly remote process.
@@ -393,15 +883,18 @@ class Context(threading.Thread):
     self._assert_started()
 
     def really_link():
-      self._links[pid].add(to)
-      log.info('Added link from %s to %s' % (pid, to))
+      with self._links_lock:
+        self._links[pid].add(to)
+        self._linked_by[to].add(pid)
+      log.info('Added link from %s to %s', pid, to)
 
-    def on_connect(stream):
+    def on_connect(connection):
       really_link()
 
-    if self._is_local(pid):
+    if self._is_local(to):
       really_link()
     else:
+      self._connections.pin(to)
       self.__loop.add_callback(self._maybe_connect, to, on_connect)
 
   def terminate(self, pid):
@@ -419,12 +912,19 @@ class Context(threading.Thread):
     """
     self._assert_started()
 
-    log.info('Terminating %s' % pid)
+    log.info('Terminating %s', pid)
     process = self._processes.pop(pid, None)
     if process:
-      log.info('Unmounting %s' % process)
+      log.info('Unmounting %s', process)
       self.http.unmount_process(process)
-    self.__erase_link(pid)
+      for mailbox in process.message_names:
+        self._mailboxes.pop((pid, mailbox), None)
+      for counter in list(self._message_counters.pop(pid, {}).values()):
+        self.metrics.remove(counter.name)
+      self._scheduler.remove(pid)
+      self.__loop.add_callback(self._coroutines.cancel, pid)
+      self.__unlink_all(pid)
+    self.__erase_links([pid])
 
   def __str__(self):
     return 'Context(%s:%s)' % (self.ip, self.port)
@@ -0,0 +1,155 @@
+"""Schedule native coroutine handlers on a context's asyncio loop."""
+
+import inspect
+import logging
+from collections import deque
+
+try:
+  import asyncio
+except ImportError:
+  import trollius as asyncio
+
+from tornado.concurrent import Future
+
+log = logging.getLogger(__name__)
+
+_ensure_future = getattr(asyncio, 'ensure_future', None) or getattr(asyncio, 'async')
+_iscoroutinefunction = getattr(inspect, 'iscoroutinefunction', lambda fn: False)
+
+
+COROUTINE_ATTRIBUTE = '__coroutine__'
+
+
+def is_coroutine_function(fn):
+  """Whether calling ``fn`` returns a coroutine to be scheduled, e.g. an ``async def`` method."""
+  return getattr(fn, COROUTINE_ATTRIBUTE, False) or _iscoroutinefunction(fn)
+
+
+def mark_coroutine_function(fn):
+  """Mark a wrapper of a coroutine function as returning a coroutine."""
+  setattr(fn, COROUTINE_ATTRIBUTE, True)
+  return fn
+
+
+class _Slots(object):  # noqa
+  __slots__ = ('in_flight', 'pending', 'tasks')
+
+  def __init__(self):
+    self.in_flight = 0
+    self.pending = deque()  # (future, coroutine function, args)
+    self.tasks = set()
+
+
+class CoroutineRunner(object):  # noqa
+  """Run coroutines as asyncio tasks, with an optional cap on those in flight per key.
+
+  Coroutines beyond the cap are not created until a running coroutine for the
+  same key completes.  All methods must be called on the loop.
+
+  Metrics:
+
+  * ``coroutines/in_flight``: coroutines currently running.
+  * ``coroutines/queued``: coroutines waiting for one of their key's slots.
+  """
+
+  def __init__(self, asyncio_loop, max_in_flight=None, metrics=None):
+    """
+    :param asyncio_loop: The asyncio event loop on which to run coroutines.
+    :keyword max_in_flight: The maximum number of coroutines running at once per key.
+       Unbounded by default.
+    :type max_in_flight: ``int`` or None
+    :keyword metrics: The registry in which to record metrics.
+    :type metrics: :class:`compactor.metrics.Metrics` or None
+    """
+    if max_in_flight is not None and max_in_flight < 1:
+      raise ValueError('max_in_flight must be at least 1.')
+    self._loop = asyncio_loop
+    self._max_in_flight = max_in_flight
+    self._slots = {}
+    if metrics is not None:
+      self._in_flight = metrics.gauge('coroutines/in_flight')
+      self._queued = metrics.gauge('coroutines/queued')
+    else:
+      self._in_flight = self._queued = None
+
+  def in_flight(self, key):
+    """The number of coroutines running for ``key``."""
+    slots = self._slots.get(key)
+    return slots.in_flight if slots else 0
+
+  def run(self, key, fn, *args):
+    """Run the coroutine ``fn(*args)`` on behalf of ``key``.
+
+    :return: A future resolved with the result of the coroutine.
+    :rtype: ``tornado.concurrent.Future``
+    """
+    future = Future()
+    slots = self._slots.get(key)
+    if slots is None:
+      slots = self._slots[key] = _Slots()
+    if self._max_in_flight is not None and slots.in_flight >= self._max_in_flight:
+      slots.pending.append((future, fn, args))
+      if self._queued:
+        self._queued.increment()
+    else:
+      self.__start(key, slots, future, fn, args)
+    return future
+
+  def __start(self, key, slots, future, fn, args):
+    try:
+      task = _ensure_future(fn(*args), loop=self._loop)
+    except Exception as e:
+      future.set_exception(e)
+      self.__next(key, slots)
+      return
+    slots.in_flight += 1
+    slots.tasks.add(task)
+    if self._in_flight:
+      self._in_flight.increment()
+    task.add_done_callback(lambda task: self.__done(key, slots, future, task))
+
+  def __done(self, key, slots, future, task):
+    slots.in_flight -= 1
+    slots.tasks.discard(task)
+    if self._in_flight:
+      self._in_flight.decrement()
+    try:
+      if task.cancelled():
+        future.set_exception(asyncio.CancelledError())
+      elif task.exception() is not None:
+        future.set_exception(task.exception())
+      else:
+        future.set_result(task.result())
+    finally:
+      self.__next(key, slots)
+
+  def __next(self, key, slots):
+    if slots.pending:
+      future, fn, args = slots.pending.popleft()
+      if self._queued:
+        self._queued.decrement()
+      self.__start(key, slots, future, fn, args)
+    elif not slots.in_flight and self._slots.get(key) is slots:
+      del self._slots[key]
+
+  def cancel(self, key):
+    """Cancel every running and queued coroutine for ``key``.
+
+    The futures of queued coroutines are resolved with ``CancelledError``.
+    """
+    slots = self._slots.pop(key, None)
+    if slots is None:
+      return
+    pending = list(slots.pending)
+    slots.pending.clear()
+    if self._queued:
+      self._queued.decrement(len(pending))
+    for task in list(slots.tasks):
+      task.cancel()
+    for future, _, _ in pending:
+      try:
+        future.set_exception(asyncio.CancelledError())
+      except asyncio.CancelledError:
+        # Since Python 3.8 this is a BaseException, which tornado lets callbacks raise, and it
+        # must not leave the remaining futures unresolved.
+        log.debug('A callback of a cancelled coroutine raised CancelledError.')
@@ -0,0 +1,240 @@
+"""Run CPU-bound or blocking work on worker pools and resolve the results on a context's loop."""
+
+import importlib
+import logging
+import threading
+import time
+
+from collections import deque
+
+try:
+  from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+except ImportError:
+  # Python 2 requires the ``futures`` backport.
+  ProcessPoolExecutor = ThreadPoolExecutor = None
+
+from tornado.concurrent import Future
+
+log = logging.getLogger(__name__)
+
+
+_REGISTRY = {}
+
+
+class Registered(object):  # noqa
+  """A picklable reference to a function registered with :func:`register`.
+
+  Functions decorated inside a class body cannot be pickled by name since
+  the class attribute is replaced by a wrapper.  A registered function is
+  instead looked up by its module and qualified name, importing the module
+  in the pool process if necessary.
+  """
+
+  __slots__ = ('module', 'name')
+
+  def __init__(self, module, name):
+    self.module = module
+    self.name = name
+
+  def __getstate__(self):
+    return self.module, self.name
+
+  def __setstate__(self, state):
+    self.module, self.name = state
+
+  def __call__(self, *args):
+    key = (self.module, self.name)
+    if key not in _REGISTRY:
+      importlib.import_module(self.module)
+    return _REGISTRY[key](*args)
+
+  def __repr__(self):
+    return 'Registered(%s.%s)' % (self.module, self.name)
+
+
+def _origin(fn):
+  code = getattr(fn, '__code__', None)
+  return (code.co_filename, code.co_firstlineno) if code is not None else fn
+
+
+def register(fn):
+  """Register ``fn`` so it may be called in a pool process.
+
+  Functions are registered by module and qualified name.  Python 2 has no
+  qualified names, so on Python 2 two functions of the same name in one
+  module, e.g. methods of different classes, cannot both be registered.
+
+  :param fn: A function defined at module or class scope.
+  :return: A picklable :class:`Registered` reference to ``fn``.
+  :raises: ``ValueError`` if another function is registered under the same name.
+  """
+  name = getattr(fn, '__qualname__', fn.__name__)
+  key = (fn.__module__, name)
+  registered = _REGISTRY.get(key)
+  # A function defined again by the same code, e.g. in a class created by a function, replaces it.
+  if registered is not None and _origin(registered) != _origin(fn):
+    raise ValueError('Another function is already registered as %s.%s' % key)
+  _REGISTRY[key] = fn
+  return Registered(fn.__module__, name)
+
+
+def _timed(fn, args):
+  # Runs in the pool worker, so the execution time excludes time spent queued.
+  start = time.time()
+  result = fn(*args)
+  return time.time() - start, result
+
+
+class LoopExecutor(object):  # noqa
+  """A pool of workers whose results are delivered on an event loop.
+
+  The underlying executor is only created when work is first submitted.
+  Calls submitted with the same ``key`` through ``submit_ordered`` are
+  resolved on the loop in the order they were submitted, even if they
+  complete out of order.
+
+  Subclasses define ``NAME``, the prefix of their metrics.  Metrics:
+
+  * ``<name>/queue_depth``: calls submitted but not yet resolved.
+  * ``<name>/execution_time_secs``: time spent running each call in the pool.
+  * ``<name>/failures``: calls that raised an exception.
+  """
+
+  class Error(Exception): pass
+
+  NAME = None
+
+  def __init__(self, loop, executor_factory, max_workers=None, metrics=None):
+    """
+    :param loop: The tornado IOLoop on which results are delivered.
+    :param executor_factory: Called with ``max_workers`` to create the
+       ``concurrent.futures`` executor when work is first submitted.
+    :keyword max_workers: The number of pool workers.
+    :type max_workers: ``int`` or None
+    :keyword metrics: The registry in which to record pool metrics.
+    :type metrics: :class:`compactor.metrics.Metrics` or None
+    """
+    if max_workers is not None and max_workers < 1:
+      raise ValueError('max_workers must be at least 1.')
+    self._loop = loop
+    self._executor_factory = executor_factory
+    self._max_workers = max_workers
+    self._executor = None
+    self._ordered = {}  # key => deque of (future, pool future)
+    self._lock = threading.Lock()
+    if metrics is not None:
+      self._queue_depth = metrics.gauge('%s/queue_depth' % self.NAME)
+      self._execution_time = metrics.histogram('%s/execution_time_secs' % self.NAME)
+      self._failures = metrics.counter('%s/failures' % self.NAME)
+    else:
+      self._queue_depth = self._execution_time = self._failures = None
+
+  def __get_executor(self):
+    # Called with the lock held.
+    if self._executor is None:
+      self._executor = self._executor_factory(self._max_workers)
+    return self._executor
+
+  def submit(self, fn, *args):
+    """Call ``fn(*args)`` in the pool.
+
+    :return: A future resolved with the result on the loop.
+    :rtype: ``tornado.concurrent.Future``
+    """
+    future = Future()
+    with self._lock:
+      pool_future = self.__get_executor().submit(_timed, fn, args)
+    if self._queue_depth:
+      self._queue_depth.increment()
+    pool_future.add_done_callback(
+        lambda pool_future: self._loop.add_callback(self.__resolve, future, pool_future))
+    return future
+
+  def submit_ordered(self, key, fn, *args):
+    """Call ``fn(*args)`` in the pool, resolving in order with other calls for ``key``.
+
+    :return: A future resolved with the result on the loop.
+    :rtype: ``tornado.concurrent.Future``
+    """
+    future = Future()
+    with self._lock:
+      pool_future = self.__get_executor().submit(_timed, fn, args)
+      self._ordered.setdefault(key, deque()).append((future, pool_future))
+    if self._queue_depth:
+      self._queue_depth.increment()
+    pool_future.add_done_callback(
+        lambda pool_future: self._loop.add_callback(self.__drain, key))
+    return future
+
+  def __drain(self, key):
+    resolved = []
+    with self._lock:
+      pending = self._ordered.get(key)
+      while pending and pending[0][1].done():
+        resolved.append(pending.popleft())
+      if pending is not None and not pending:
+        del self._ordered[key]
+    for future, pool_future in resolved:
+      self.__resolve(future, pool_future)
+
+  def __resolve(self, future, pool_future):
+    if self._queue_depth:
+      self._queue_depth.decrement()
+    try:
+      elapsed, result = pool_future.result()
+    except Exception as e:
+      if self._failures:
+        self._failures.increment()
+      future.set_exception(e)
+      return
+    if self._execution_time:
+      self._execution_time.add(elapsed)
+    future.set_result(result)
+
+  def shutdown(self):
+    """Shut down the pool without waiting for outstanding calls."""
+    with self._lock:
+      executor, self._executor = self._executor, None
+    if executor is not None:
+      executor.shutdown(wait=False)
+
+
+class ComputePool(LoopExecutor):
+  """A process pool for CPU-bound work.
+
+  Functions, their arguments and their results must be picklable.  The pool
+  defaults to one process per CPU and contexts that never offload work to it
+  never fork.
+  """
+
+  NAME = 'compute'
+
+  @classmethod
+  def create_executor(cls, max_workers):
+    if ProcessPoolExecutor is None:
+      raise cls.Error('Offloading work to a process pool requires concurrent.futures.')
+    return ProcessPoolExecutor(max_workers=max_workers)
+
+  def __init__(self, loop, max_workers=None, metrics=None):
+    """See :class:`LoopExecutor`.  ``max_workers`` defaults to the number of CPUs."""
+    super(ComputePool, self).__init__(
+        loop, self.create_executor, max_workers=max_workers, metrics=metrics)
+
+
+class BlockingPool(LoopExecutor):
+  """A bounded thread pool for blocking calls such as disk or database I/O."""
+
+  NAME = 'blocking'
+
+  DEFAULT_MAX_WORKERS = 8
+
+  @classmethod
+  def create_executor(cls, max_workers):
+    if ThreadPoolExecutor is None:
+      raise cls.Error('Offloading work to a thread pool requires concurrent.futures.')
+    return ThreadPoolExecutor(max_workers=max_workers or cls.DEFAULT_MAX_WORKERS)
+
+  def __init__(self, loop, max_workers=None, metrics=None):
+    """See :class:`LoopExecutor`.  ``max_workers`` defaults to ``DEFAULT_MAX_WORKERS``."""
+    super(BlockingPool, self).__init__(
+        loop, self.create_executor, max_workers=max_workers, metrics=metrics)
@@ -1,16 +1,19 @@
 from __future__ import absolute_import
 
+import json
 import logging
 import re
 import types
 import time
 
 from .pid import PID
+from .request import HEARTBEAT_PATH
 
 from tornado import gen
 from tornado import httputil
+from tornado.concurrent import is_future
 from tornado.httpserver import HTTPServer
-from tornado.web import RequestHandler, Application, HTTPError
+from tornado.web import Application, HTTPError, RequestHandler, URLSpec
 
 log = logging.getLogger(__name__)
 
@@ -48,17 +51,12 @@ class WireProtocolMessageHandler(ProcessBaseHandler):
     })
 
   def post(self, *args, **kw):
-    log.info('Handling %s for %s' % (self.__name, self.process.pid))
-
     process, legacy = self.detect_process(self.request.headers)
 
     if process is None:
       self.set_status(404)
       return
 
-    log.debug('Delivering %s to %s from %s' % (self.__name, self.process.pid, process))
-    log.debug('Request body length: %s' % len(self.request.body))
-
     # Handle the message
     self.process.handle_message(self.__name, process, self.request.body)
 
@@ -71,15 +69,52 @@ class RoutedRequestHandler(ProcessBaseHandler):
 
   def initialize(self, **kw):
     self.__path = kw.pop('path')
+    self.__instruments = kw.pop('instruments', None)
     super(RoutedRequestHandler, self).initialize(**kw)
 
-  @gen.engine
+  def __handle(self, *args, **kw):
+    if not self.__instruments:
+      return self.process.handle_http(self.__path, self, *args, **kw)
+    pid, started = self.process.pid, time.time()
+    for instrument in self.__instruments:
+      instrument.on_handler_start(pid, self.__path, started)
+    try:
+      return self.process.handle_http(self.__path, self, *args, **kw)
+    finally:
+      elapsed = time.time() - started
+      for instrument in self.__instruments:
+        instrument.on_handler_end(pid, self.__path, elapsed)
+
+  @gen.coroutine
   def get(self, *args, **kw):
-    log.info('Handling %s for %s' % (self.__path, self.process.pid))
-    handle = self.process.handle_http(self.__path, self, *args, **kw)
+    handle = self.__handle(*args, **kw)
     if isinstance(handle, types.GeneratorType):
+      # Legacy generator routes yielding gen.Task and friends.
       for stuff in handle:
         yield stuff
+    elif is_future(handle):
+      # Coroutine routes, which the process runs on the context's asyncio loop.
+      yield handle
+    self.finish()
+
+
+class HeartbeatHandler(RequestHandler):
+  """Answers the heartbeats sent on the outbound connections of linked processes."""
+
+  def get(self):
+    self.set_status(200)
+    self.finish()
+
+
+class JSONHandler(RequestHandler):
+  """Serves the JSON encoding of what ``snapshot`` returns, e.g. ``/metrics/snapshot``."""
+
+  def initialize(self, snapshot=None):
+    self.snapshot = snapshot
+
+  def get(self):
+    self.set_header('Content-Type', 'application/json')
+    self.write(json.dumps(self.snapshot(), sort_keys=True))
     self.finish()
 
 
@@ -89,31 +124,350 @@ class Blackhole(RequestHandler):
     raise HTTPError(404)
 
 
+class LiteralURLSpec(URLSpec):
+  """A tornado ``URLSpec`` for a literal path, which compiles no regular expression.
+
+  The :class:`Router` only offers it for requests to exactly its path, so its
+  regex matches anything and captures no arguments.  Compiling a regular
+  expression per mailbox and route would otherwise dominate spawning a process.
+  """
+
+  MATCH_ANY = re.compile(r'.*$', re.DOTALL)
+
+  def __init__(self, path, handler_class, kwargs=None, name=None):
+    self.path = path
+    self.regex = self.MATCH_ANY
+    self.handler_class = handler_class
+    self.kwargs = kwargs or {}
+    self.name = name
+    self._path, self._group_count = path.replace('%', '%%'), 0
+
+  def __repr__(self):
+    return '%s(%r, %s, kwargs=%r, name=%r)' % (
+        self.__class__.__name__, self.path, self.handler_class, self.kwargs, self.name)
+
+
+class Router(object):  # noqa
+  """A route table mapping request paths to tornado ``URLSpec`` objects.
+
+  Literal paths, which covers every mailbox and most routes, are resolved
+  with a single dictionary lookup.  Paths that contain regular expression
+  groups are kept per owning process, keyed by its pid id, and only those of
+  the process named by the first segment of a request path are matched by
+  scanning, and only if no literal path matches.  Requests that match nothing
+  go to the ``default`` handler.
+  """
+
+  def __init__(self, default):
+    self._literals = {}
+    self._patterns = {}
+    self._default = [URLSpec(r'/.*$', default)]
+
+  @classmethod
+  def is_pattern(cls, path):
+    """Whether ``path`` contains regular expression groups."""
+    try:
+      return re.compile(path).groups > 0
+    except re.error:
+      return False
+
+  @classmethod
+  def owner(cls, path):
+    """The first segment of a request path, which is the pid id of the process it is for."""
+    end = path.find('/', 1)
+    return path[1:end] if end > 0 else path[1:]
+
+  def add(self, path, handler_class, kwargs):
+    """Route requests for the literal ``path``."""
+    self._literals[path] = LiteralURLSpec(path, handler_class, kwargs)
+
+  def add_pattern(self, owner, pattern, handler_class, kwargs):
+    """Route requests matching the regular expression ``pattern``.
+
+    :param owner: The pid id that is the first segment of every path ``pattern`` matches.
+    """
+    self._patterns.setdefault(owner, []).append(URLSpec(pattern, handler_class, kwargs))
+
+  def remove(self, process):
+    """Remove every route owned by ``process``."""
+    for route_path in process.route_paths:
+      route = '/%s%s' % (process.pid.id, route_path)
+      spec = self._literals.get(route)
+      if spec is not None and spec.kwargs.get('process') == process:
+        del self._literals[route]
+    for message_name in process.message_names:
+      route = '/%s/%s' % (process.pid.id, message_name)
+      spec = self._literals.get(route)
+      if spec is not None and spec.kwargs.get('process') == process:
+        del self._literals[route]
+    patterns = self._patterns.get(process.pid.id)
+    if patterns is not None:
+      patterns = [spec for spec in patterns if spec.kwargs.get('process') != process]
+      if patterns:
+        self._patterns[process.pid.id] = patterns
+      else:
+        del self._patterns[process.pid.id]
+
+  def lookup(self, path):
+    """Return the ``URLSpec`` for the literal ``path``, or None."""
+    return self._literals.get(path)
+
+  def find(self, path):
+    """Return the candidate ``URLSpec`` objects for a request path, in order."""
+    spec = self._literals.get(path)
+    if spec is not None:
+      return [spec]
+    patterns = self._patterns.get(self.owner(path))
+    if patterns is not None:
+      return patterns + self._default
+    return self._default
+
+
+class RoutedApplication(Application):
+  """A tornado Application that resolves handlers through a :class:`Router`."""
+
+  def __init__(self, router, **settings):
+    super(RoutedApplication, self).__init__(**settings)
+    self.router = router
+
+  def _get_host_handlers(self, request):
+    # Compactor does not do virtual hosting, so skip host matching and let the
+    # router pick the candidate handlers for the path.
+    return self.router.find(request.path)
+
+
+class WireProtocolConnection(object):  # noqa
+  """A server connection that parses libprocess messages directly off its stream.
+
+  Each request's header block is read and, if it is a libprocess message
+  (``POST /<pid-id>/<mailbox>`` with a ``Libprocess-From`` or libprocess
+  ``User-Agent`` header) for a mounted mailbox, its body is read and
+  delivered straight to the process without constructing a tornado request
+  or handler.  Any other request, and everything after it on the same
+  connection, is handed over to tornado.
+
+  If the server has a ``forward`` callable, messages for mailboxes that are
+  not mounted are passed to it as ``forward(from_pid, to_id, method, body)``
+  instead; it returns False if it cannot forward them.
+
+  Heartbeat requests are answered directly as well, so that they do not
+  hand the connection over to tornado.
+  """
+
+  MAX_HEADER_SIZE = 64 * 1024
+  MAX_BODY_SIZE = 100 * 1024 * 1024
+  HEADER_DELIMITER = br'\r?\n\r?\n'
+  HEARTBEAT_PREFIX = ('GET %s ' % HEARTBEAT_PATH).encode('ascii')
+
+  def __init__(self, server, stream, address):
+    self.server = server
+    self.stream = stream
+    self.address = address
+
+  def start(self):
+    self.stream.read_until_regex(
+        self.HEADER_DELIMITER, self._on_headers, max_bytes=self.MAX_HEADER_SIZE)
+
+  def _parse(self, data):
+    """Return (target, from pid, content length, keep alive) or None if not a message.
+
+    The target is the mailbox spec, or a (pid id, method) tuple for a message to be forwarded.
+    """
+
+    lines = [line.rstrip('\r') for line in data.decode('latin1').split('\n')]
+    try:
+      method, path, version = lines[0].split(' ')
+    except ValueError:
+      return None
+    if method != 'POST' or version not in ('HTTP/1.0', 'HTTP/1.1'):
+      return None
+    target = self.server.router.lookup(path)
+    if target is None and self.server.forward is not None:
+      target = self._forward_target(path)
+      if target is None:
+        return None
+    elif target is None or target.handler_class is not WireProtocolMessageHandler:
+      return None
+
+    headers = {}
+    for line in lines[1:]:
+      if not line:
+        continue
+      name, sep, value = line.partition(':')
+      if not sep or line[0] in ' \t':
+        return None
+      headers[name.strip().title()] = value.strip()
+
+    if 'Transfer-Encoding' in headers or 'Expect' in headers:
+      return None
+    from_pid, _ = WireProtocolMessageHandler.detect_process(headers)
+    if from_pid is None:
+      return None
+    try:
+      content_length = int(headers.get('Content-Length', 0))
+    except ValueError:
+      return None
+    if not 0 <= content_length <= self.MAX_BODY_SIZE:
+      return None
+
+    connection = headers.get('Connection', '').lower()
+    if version == 'HTTP/1.1':
+      keep_alive = connection != 'close'
+    else:
+      keep_alive = connection == 'keep-alive'
+    return target, from_pid, content_length, keep_alive
+
+  @classmethod
+  def _forward_target(cls, path):
+    try:
+      _, to_id, method = path.split('/')
+    except ValueError:
+      return None
+    if not to_id or not method:
+      return None
+    return to_id, method
+
+  def _on_headers(self, data):
+    if data.startswith(self.HEARTBEAT_PREFIX):
+      self.stream.write(self.server.HEARTBEAT_RESPONSE)
+      self.start()
+      return
+    message = self._parse(data)
+    if message is None:
+      self._fallback(data)
+      return
+    target, from_pid, content_length, keep_alive = message
+    if content_length:
+      self.stream.read_bytes(
+          content_length, lambda body: self._on_body(target, from_pid, keep_alive, body))
+    else:
+      self._on_body(target, from_pid, keep_alive, b'')
+
+  def _deliver(self, target, from_pid, body):
+    if isinstance(target, tuple):
+      to_id, name = target
+      log.debug('Forwarding %s for %s from %s', name, to_id, from_pid)
+      return self.server.forward(from_pid, to_id, name, body)
+    process, name = target.kwargs['process'], target.kwargs['name']
+    process.handle_message(name, from_pid, body)
+    return True
+
+  def _on_body(self, target, from_pid, keep_alive, body):
+    try:
+      if self._deliver(target, from_pid, body):
+        response = self.server.ACCEPTED_KEEP_ALIVE if keep_alive else self.server.ACCEPTED
+      else:
+        response, keep_alive = self.server.NOT_FOUND, False
+    except Exception:
+      log.exception('Failed to deliver message for %s from %s', self.address, from_pid)
+      response, keep_alive = self.server.INTERNAL_ERROR, False
+    if self.stream.closed():
+      return
+    if keep_alive:
+      self.stream.write(response)
+      self.start()
+    else:
+      self.stream.write(response, callback=self.stream.close)
+
+  def _fallback(self, data):
+    # Return the header block we consumed to the front of the stream's read
+    # buffer and let tornado serve this request and the rest of the connection.
+    self.stream._read_buffer.appendleft(data)
+    self.stream._read_buffer_size += len(data)
+    self.server.serve_with_tornado(self.stream, self.address)
+
+
+class WireProtocolServer(HTTPServer):
+  """An HTTPServer that delivers libprocess messages without tornado's request handling.
+
+  See :class:`WireProtocolConnection`.  Requests that are not libprocess
+  messages, such as ``Process.route`` requests, are served by the
+  :class:`RoutedApplication` as usual.
+  """
+
+  ACCEPTED = b'HTTP/1.1 202 Accepted\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+  ACCEPTED_KEEP_ALIVE = (
+      b'HTTP/1.1 202 Accepted\r\nContent-Length: 0\r\nConnection: Keep-Alive\r\n\r\n')
+  NOT_FOUND = b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+  HEARTBEAT_RESPONSE = b'HTTP/1.1 200 OK\r\nContent-Length: 0\r\nConnection: Keep-Alive\r\n\r\n'
+  INTERNAL_ERROR = (
+      b'HTTP/1.1 500 Internal Server Error\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+
+  def __init__(self, app, forward=None, **kw):
+    super(WireProtocolServer, self).__init__(app, **kw)
+    self.router = app.router
+    self.forward = forward
+    self._streams = set()
+
+  def handle_stream(self, stream, address):
+    self._streams.add(stream)
+    stream.set_close_callback(lambda: self._streams.discard(stream))
+    WireProtocolConnection(self, stream, address).start()
+
+  def serve_with_tornado(self, stream, address):
+    self._streams.discard(stream)
+    stream.set_close_callback(None)
+    super(WireProtocolServer, self).handle_stream(stream, address)
+
+  def close_all_connections(self):
+    for stream in list(self._streams):
+      stream.close()
+    return super(WireProtocolServer, self).close_all_connections()
+
+
 class HTTPD(object):  # noqa
   """
   HTTP Server implementation that attaches to an event loop and socket, and
   is capable of handling mesos wire protocol messages.
   """
 
-  def __init__(self, sock, loop):
+  def __init__(self, sock, loop, fast_path=False, forward=None, instruments=None):
     """
     Construct an HTTP server on a socket given an ioloop.
+
+    If ``fast_path`` is True, libprocess messages are parsed and delivered
+    by a :class:`WireProtocolServer` rather than by tornado's request handling.
+    Messages for unmounted mailboxes are passed to ``forward``, which implies
+    ``fast_path``.  ``instruments`` are told when each route handler starts and
+    finishes.
     """
 
     self.loop = loop
+    self.instruments = instruments if instruments is not None else []
     self.sock = sock
-
-    self.app = Application(handlers=[(r'/.*$', Blackhole)])
-    self.server = HTTPServer(self.app, io_loop=self.loop)
+    self.socks = []
+
+    self.router = Router(default=Blackhole)
+    self.router.add(HEARTBEAT_PATH, HeartbeatHandler, {})
+    self.app = RoutedApplication(self.router)
+    if fast_path or forward is not None:
+      self.server = WireProtocolServer(self.app, forward=forward, io_loop=self.loop)
+    else:
+      self.server = HTTPServer(self.app, io_loop=self.loop)
+    self.listen(sock)
+
+  def listen(self, sock):
+    """Also accept connections on the bound socket ``sock``."""
     self.server.add_sockets([sock])
-
-    self.sock.listen(1024)
+    sock.listen(1024)
+    self.socks.append(sock)
 
   def terminate(self):
     log.info('Terminating HTTP server and all connections')
 
     self.server.close_all_connections()
-    self.sock.close()
+    for sock in self.socks:
+      sock.close()
+
+  def mount(self, path, handler_class, **kwargs):
+    """
+    Route requests for the literal ``path`` to a tornado ``RequestHandler``
+    constructed with ``kwargs``, for endpoints that belong to the context
+    rather than to a process.
+    """
+
+    log.info('Mounting route %s' % path)
+    self.router.add(path, handler_class, kwargs)
 
   def mount_process(self, process):
     """
@@ -122,21 +476,18 @@ class HTTPD(object):  # noqa
 
     for route_path in process.route_paths:
       route = '/%s%s' % (process.pid.id, route_path)
-      log.info('Mounting route %s' % route)
-      self.app.add_handlers('.*$', [(
-          re.escape(route),
-          RoutedRequestHandler,
-          dict(process=process, path=route_path)
-      )])
+      log.info('Mounting route %s', route)
+      kwargs = dict(process=process, path=route_path, instruments=self.instruments)
+      if self.router.is_pattern(route_path):
+        self.router.add_pattern(process.pid.id, re.escape('/%s' % process.pid.id) + route_path,
+                                RoutedRequestHandler, kwargs)
+      else:
+        self.router.add(route, RoutedRequestHandler, kwargs)
 
     for message_name in process.message_names:
       route = '/%s/%s' % (process.pid.id, message_name)
-      log.info('Mounting message handler %s' % route)
-      self.app.add_handlers('.*$', [(
-          re.escape(route),
-          WireProtocolMessageHandler,
-          dict(process=process, name=message_name)
-      )])
+      log.info('Mounting message handler %s', route)
+      self.router.add(route, WireProtocolMessageHandler, dict(process=process, name=message_name))
 
   def unmount_process(self, process):
     """
@@ -144,14 +495,4 @@ class HTTPD(object):  # noqa
     callbacks.
     """
 
-    # There is no remove_handlers, but .handlers is public so why not.  server.handlers is a list of
-    # 2-tuples of the form (host_pattern, [list of RequestHandler]) objects.  We filter out all
-    # handlers matching our process from the RequestHandler list for each host pattern.
-    def nonmatching(handler):
-      return 'process' not in handler.kwargs or handler.kwargs['process'] != process
-
-    def filter_handlers(handlers):
-      host_pattern, handlers = handlers
-      return (host_pattern, list(filter(nonmatching, handlers)))
-
-    self.app.handlers = [filter_handlers(handlers) for handlers in self.app.handlers]
+    self.router.remove(process)
@@ -0,0 +1,167 @@
+"""Hooks for observing the messages, handlers and connections of a context."""
+
+import logging
+import signal
+import sys
+import time
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+
+def handler_name(handler):
+  """The mailbox or route a handler was installed for, or else its function name."""
+  if isinstance(handler, str):
+    return handler
+  for attribute in ('__mailbox__', '__route__', '__name__'):
+    name = getattr(handler, attribute, None)
+    if name is not None:
+      return name
+  return repr(handler)
+
+
+class Instrument(object):  # noqa
+  """The events of a context that may be observed, each of which does nothing by default.
+
+  Subclass this and override the events of interest, then pass instances
+  to a :class:`compactor.context.Context` as ``instruments`` or to
+  ``Context.add_instrument``.  Events are called synchronously on the hot
+  paths of the context, on whichever thread sent or handled the message, so
+  instruments should be quick and must not raise.
+
+  When a context has no instruments, none of these are called.
+  """
+
+  def on_send(self, from_pid, to_pid, method, size):
+    """Called when ``from_pid`` sends a message of ``size`` bytes to ``to_pid``.
+
+    ``size`` is the length of the body of local messages and of the encoded
+    request of remote messages.
+    """
+
+  def on_deliver(self, pid, name, from_pid, size):
+    """Called when a message is queued in the mailbox of the local process ``pid``."""
+
+  def on_handler_start(self, pid, handler, started):
+    """Called on the loop when ``handler`` starts handling a message or request for ``pid``.
+
+    ``handler`` is the handler method, or the path of a route.
+    """
+
+  def on_handler_end(self, pid, handler, elapsed):
+    """Called on the loop when ``handler`` returns after ``elapsed`` seconds."""
+
+  def on_connect(self, endpoint):
+    """Called on the loop when an outbound connection to ``(ip, port)`` is established."""
+
+  def on_disconnect(self, endpoint, reason):
+    """Called on the loop when an outbound connection to ``(ip, port)`` is closed."""
+
+
+class LoggingInstrument(Instrument):
+  """Logs every message and connection at ``level``."""
+
+  def __init__(self, level=logging.DEBUG, logger=log):
+    self.level = level
+    self.logger = logger
+
+  def on_send(self, from_pid, to_pid, method, size):
+    self.logger.log(self.level, 'Sending %s => %s (method: %s, %d bytes)',
+                    from_pid, to_pid, method, size)
+
+  def on_deliver(self, pid, name, from_pid, size):
+    self.logger.log(self.level, 'Delivering %s to %s from %s (%d bytes)', name, pid, from_pid, size)
+
+  def on_connect(self, endpoint):
+    self.logger.log(self.level, 'Connected to %s:%d', *endpoint)
+
+  def on_disconnect(self, endpoint, reason):
+    self.logger.log(self.level, 'Disconnected from %s:%d (%s)', endpoint[0], endpoint[1], reason)
+
+
+class FlightRecorder(Instrument):
+  """Records the metadata of the most recent messages and connection events in a ring buffer.
+
+  Each event costs a tuple appended to a bounded deque.  Pids are only
+  formatted when the recording is dumped, which may be done with ``dump``,
+  over HTTP at ``/flight_recorder/dump`` on a context created with a
+  ``flight_recorder_size``, or on a signal with ``dump_on_signal``.
+  """
+
+  SEND = 'send'
+  DELIVER = 'deliver'
+  HANDLED = 'handled'
+  CONNECT = 'connect'
+  DISCONNECT = 'disconnect'
+
+  DEFAULT_SIZE = 4096
+
+  def __init__(self, size=DEFAULT_SIZE):
+    """
+    :keyword size: The number of events to keep.
+    :type size: ``int``
+    """
+    if size < 1:
+      raise ValueError('size must be at least 1.')
+    self._events = deque(maxlen=size)  # (time, event, *fields)
+
+  def on_send(self, from_pid, to_pid, method, size):
+    self._events.append((time.time(), self.SEND, from_pid, to_pid, method, size))
+
+  def on_deliver(self, pid, name, from_pid, size):
+    self._events.append((time.time(), self.DELIVER, from_pid, pid, name, size))
+
+  def on_handler_end(self, pid, handler, elapsed):
+    self._events.append((time.time(), self.HANDLED, pid, handler, elapsed))
+
+  def on_connect(self, endpoint):
+    self._events.append((time.time(), self.CONNECT, endpoint))
+
+  def on_disconnect(self, endpoint, reason):
+    self._events.append((time.time(), self.DISCONNECT, endpoint, reason))
+
+  def __len__(self):
+    return len(self._events)
+
+  @classmethod
+  def _format(cls, event):
+    timestamp, kind = event[:2]
+    record = {'time': timestamp, 'event': kind}
+    if kind in (cls.SEND, cls.DELIVER):
+      from_pid, to_pid, method, size = event[2:]
+      record.update({'from': str(from_pid), 'to': str(to_pid), 'method': method, 'size': size})
+    elif kind == cls.HANDLED:
+      pid, handler, elapsed = event[2:]
+      record.update({'pid': str(pid), 'handler': handler_name(handler), 'elapsed_secs': elapsed})
+    else:
+      record['endpoint'] = '%s:%d' % event[2]
+      if kind == cls.DISCONNECT:
+        record['reason'] = event[3]
+    return record
+
+  def dump(self):
+    """Return the recorded events, oldest first, as dictionaries."""
+    while True:
+      try:
+        events = list(self._events)
+        break
+      except RuntimeError:
+        # the deque was appended to by another thread while being copied
+        continue
+    return [self._format(event) for event in events]
+
+  def dump_on_signal(self, signum=getattr(signal, 'SIGUSR2', None), stream=None):
+    """Write the recorded events to ``stream``, by default stderr, on the signal ``signum``.
+
+    This must be called from the main thread.
+    """
+    def handler(signum, frame):
+      out = stream or sys.stderr
+      for record in self.dump():
+        out.write('%(time).6f %(event)s %(rest)s\n' % dict(
+            time=record.pop('time'),
+            event=record.pop('event'),
+            rest=' '.join('%s=%s' % item for item in sorted(record.items()))))
+      out.flush()
+
+    signal.signal(signum, handler)
@@ -0,0 +1,273 @@
+"""Per-process mailboxes and the scheduler that services them on a context's loop."""
+
+import logging
+import threading
+import time
+from collections import deque
+
+from .instrumentation import handler_name
+
+log = logging.getLogger(__name__)
+
+
+class Priority(object):  # noqa
+  """Priority classes for messages, from highest to lowest."""
+
+  HIGH = 0
+  NORMAL = 1
+  LOW = 2
+  ALL = (HIGH, NORMAL, LOW)
+
+  ATTRIBUTE = '__priority__'
+
+  @classmethod
+  def of(cls, handler):
+    """The priority with which a handler was installed, ``NORMAL`` by default."""
+    return getattr(handler, cls.ATTRIBUTE, cls.NORMAL)
+
+  @classmethod
+  def validate(cls, priority):
+    if priority not in cls.ALL:
+      raise ValueError('Unknown priority %r' % (priority,))
+    return priority
+
+
+class Mailbox(object):  # noqa
+  """The queues of messages, one per priority, waiting to be handled by one process."""
+
+  __slots__ = ('pid', 'weight', 'lanes', 'ready', 'closed', 'metrics', 'depth_gauge', 'wait_time',
+               'handler_times')
+
+  METRICS = ('depth', 'wait_time_secs')
+
+  def __init__(self, pid, weight=1, metrics=None):
+    self.pid = pid
+    self.weight = weight
+    self.lanes = [deque() for _ in Priority.ALL]  # (enqueue time, handler, args)
+    self.ready = [False for _ in Priority.ALL]
+    self.closed = False
+    self.metrics = metrics
+    if metrics is not None:
+      self.depth_gauge = metrics.gauge(self.metric_name(pid, 'depth'))
+      self.wait_time = metrics.histogram(self.metric_name(pid, 'wait_time_secs'))
+      self.handler_times = {}  # handler name => Histogram
+    else:
+      self.depth_gauge = self.wait_time = self.handler_times = None
+
+  @classmethod
+  def metric_name(cls, pid, name):
+    return '%s/mailbox/%s' % (pid.id, name)
+
+  def handler_time(self, handler):
+    """The histogram of the time spent in the mailbox or route ``handler`` was installed for."""
+    name = handler_name(handler)
+    histogram = self.handler_times.get(name)
+    if histogram is None:
+      histogram = self.handler_times[name] = self.metrics.histogram(
+          self.metric_name(self.pid, '%s/handler_time_secs' % name))
+    return histogram
+
+  def __len__(self):
+    return sum(len(lane) for lane in self.lanes)
+
+
+class Scheduler(object):  # noqa
+  """Services the mailboxes of a context's processes in turns.
+
+  Messages are appended to the mailbox of their destination process, in the
+  lane of their priority, and mailboxes with messages take turns in
+  round-robin order.  On its turn a mailbox may handle up to ``budget``
+  messages of one priority, or ``budget`` times the process' weight when
+  scheduling is ``WEIGHTED``, before the next mailbox is serviced.  After
+  every mailbox that was ready has had a turn, the scheduler yields to the
+  event loop so I/O is not starved either.
+
+  A process flooded with messages therefore only delays others by its
+  budget per turn, rather than by the length of its backlog.
+
+  Turns go to mailboxes with higher priority messages first, so messages
+  may overtake lower priority messages to the same process.  To keep lower
+  priorities moving, a priority that has been passed over for
+  ``starvation_limit`` consecutive turns is given the next turn.
+
+  Metrics, for each process:
+
+  * ``<id>/mailbox/depth``: messages waiting to be handled.
+  * ``<id>/mailbox/wait_time_secs``: time messages waited in the mailbox.
+  * ``<id>/mailbox/<name>/handler_time_secs``: time spent handling each message, per mailbox
+    or, for other handlers, function name.
+  """
+
+  ROUND_ROBIN = 'round_robin'
+  WEIGHTED = 'weighted'
+  POLICIES = (ROUND_ROBIN, WEIGHTED)
+
+  DEFAULT_BUDGET = 16
+  DEFAULT_STARVATION_LIMIT = 8
+
+  def __init__(self, loop, policy=ROUND_ROBIN, budget=DEFAULT_BUDGET,
+               starvation_limit=DEFAULT_STARVATION_LIMIT, metrics=None, instruments=None):
+    """
+    :param loop: The tornado IOLoop on which messages are handled.
+    :keyword policy: ``Scheduler.ROUND_ROBIN`` or ``Scheduler.WEIGHTED``.
+    :type policy: ``str``
+    :keyword budget: The number of messages a mailbox may handle per turn.
+    :type budget: ``int``
+    :keyword starvation_limit: The number of consecutive turns a priority with messages
+       may be passed over for higher priorities.
+    :type starvation_limit: ``int``
+    :keyword metrics: The registry in which to record mailbox metrics.
+    :type metrics: :class:`compactor.metrics.Metrics` or None
+    :keyword instruments: The instruments told when each message starts and finishes being
+       handled.  The list may be modified after the scheduler is created.
+    :type instruments: ``list`` of :class:`compactor.instrumentation.Instrument` or None
+    """
+    if policy not in self.POLICIES:
+      raise ValueError('Unknown scheduling policy %r' % (policy,))
+    if budget < 1:
+      raise ValueError('budget must be at least 1.')
+    if starvation_limit < 1:
+      raise ValueError('starvation_limit must be at least 1.')
+    self._loop = loop
+    self._policy = policy
+    self._budget = budget
+    self._starvation_limit = starvation_limit
+    self._metrics = metrics
+    self._instruments = instruments if instruments is not None else []
+    self._mailboxes = {}  # pid => Mailbox
+    self._ready = [deque() for _ in Priority.ALL]
+    self._passed_over = [0 for _ in Priority.ALL]
+    self._scheduled = False
+    self._lock = threading.Lock()
+
+  def add(self, pid, weight=1):
+    """Create the mailbox of a process.
+
+    :param pid: The pid of the process.
+    :type pid: :class:`PID`
+    :keyword weight: The relative share of turns the process receives under
+       ``WEIGHTED`` scheduling.
+    :type weight: ``int``
+    """
+    if weight < 1:
+      raise ValueError('weight must be at least 1.')
+    with self._lock:
+      self._mailboxes[pid] = Mailbox(pid, weight=weight, metrics=self._metrics)
+
+  def remove(self, pid):
+    """Remove the mailbox of a process, discarding any messages in it."""
+    with self._lock:
+      mailbox = self._mailboxes.pop(pid, None)
+      if mailbox is None:
+        return
+      mailbox.closed = True
+      for lane in mailbox.lanes:
+        lane.clear()
+    if self._metrics is not None:
+      for name in Mailbox.METRICS:
+        self._metrics.remove(Mailbox.metric_name(pid, name))
+      for histogram in list(mailbox.handler_times.values()):
+        self._metrics.remove(histogram.name)
+
+  def depth(self, pid):
+    """The number of messages waiting in the mailbox of ``pid``."""
+    mailbox = self._mailboxes.get(pid)
+    return len(mailbox) if mailbox else 0
+
+  def deliver(self, pid, handler, *args, **kw):
+    """Queue ``handler(*args)`` to run on the turn of the process ``pid``.
+
+    This may be called from any thread.
+
+    :keyword priority: The priority of the message, by default the priority with
+       which ``handler`` was installed.
+    :type priority: One of ``Priority.ALL``
+    :returns: False if ``pid`` has no mailbox, True otherwise.
+    """
+    priority = kw.pop('priority', None)
+    if priority is None:
+      priority = Priority.of(handler)
+    with self._lock:
+      mailbox = self._mailboxes.get(pid)
+      if mailbox is None:
+        return False
+      mailbox.lanes[priority].append((time.time(), handler, args))
+      if mailbox.depth_gauge:
+        mailbox.depth_gauge.increment()
+      if not mailbox.ready[priority]:
+        mailbox.ready[priority] = True
+        self._ready[priority].append(mailbox)
+      schedule, self._scheduled = not self._scheduled, True
+    if schedule:
+      self._loop.add_callback(self._run)
+    return True
+
+  def __quota(self, mailbox):
+    if self._policy == self.WEIGHTED:
+      return self._budget * mailbox.weight
+    return self._budget
+
+  def __next_priority(self):
+    # Called with the lock held.  Returns the priority to be given the next turn.
+    chosen = None
+    for priority in Priority.ALL:
+      if not self._ready[priority]:
+        self._passed_over[priority] = 0
+      elif chosen is None:
+        chosen = priority
+      elif self._passed_over[priority] >= self._starvation_limit:
+        chosen = priority
+        break
+    if chosen is not None:
+      self._passed_over[chosen] = 0
+      for priority in Priority.ALL:
+        if priority != chosen and self._ready[priority]:
+          self._passed_over[priority] += 1
+    return chosen
+
+  def __take(self, priority):
+    # Called with the lock held.
+    mailbox = self._ready[priority].popleft()
+    lane = mailbox.lanes[priority]
+    batch = [lane.popleft() for _ in range(min(self.__quota(mailbox), len(lane)))]
+    if mailbox.depth_gauge:
+      mailbox.depth_gauge.decrement(len(batch))
+    if lane:
+      self._ready[priority].append(mailbox)
+    else:
+      mailbox.ready[priority] = False
+    return mailbox, batch
+
+  def _run(self):
+    with self._lock:
+      turns = sum(len(ready) for ready in self._ready)
+    instruments = self._instruments
+    for _ in range(turns):
+      with self._lock:
+        priority = self.__next_priority()
+        if priority is None:
+          break
+        mailbox, batch = self.__take(priority)
+      for enqueued, handler, args in batch:
+        if mailbox.closed:
+          break
+        started = time.time()
+        if mailbox.wait_time:
+          mailbox.wait_time.add(started - enqueued)
+        for instrument in instruments:
+          instrument.on_handler_start(mailbox.pid, handler, started)
+        try:
+          handler(*args)
+        except Exception:
+          log.exception('Failed to handle message for %s', mailbox.pid)
+        elapsed = time.time() - started
+        # a handler may have terminated its own process, whose metrics are then removed
+        if mailbox.handler_times is not None and not mailbox.closed:
+          mailbox.handler_time(handler).add(elapsed)
+        for instrument in instruments:
+          instrument.on_handler_end(mailbox.pid, handler, elapsed)
+    with self._lock:
+      self._scheduled = any(self._ready)
+      schedule = self._scheduled
+    if schedule:
+      self._loop.add_callback(self._run)
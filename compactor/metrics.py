@@ -0,0 +1,154 @@
+"""Lightweight counters, gauges and histograms for instrumenting compactor internals."""
+
+import threading
+from collections import deque
+
+
+class Counter(object):  # noqa
+  """A monotonically increasing count, which may be incremented from any thread."""
+
+  __slots__ = ('name', 'value', '_lock')
+
+  def __init__(self, name):
+    self.name = name
+    self.value = 0
+    self._lock = threading.Lock()
+
+  def increment(self, amount=1):
+    with self._lock:
+      self.value += amount
+
+  def snapshot(self):
+    return {self.name: self.value}
+
+
+class Gauge(object):  # noqa
+  """A value that may go up and down, such as the depth of a queue."""
+
+  __slots__ = ('name', 'value', '_lock')
+
+  def __init__(self, name):
+    self.name = name
+    self.value = 0
+    self._lock = threading.Lock()
+
+  def set(self, value):
+    self.value = value
+
+  def increment(self, amount=1):
+    with self._lock:
+      self.value += amount
+
+  def decrement(self, amount=1):
+    with self._lock:
+      self.value -= amount
+
+  def snapshot(self):
+    return {self.name: self.value}
+
+
+class Callback(object):  # noqa
+  """A value computed when a snapshot is taken, such as the number of open connections.
+
+  This costs nothing until a snapshot is taken, so it suits values that are
+  already tracked elsewhere.
+  """
+
+  __slots__ = ('name', 'fn')
+
+  def __init__(self, name, fn):
+    self.name = name
+    self.fn = fn
+
+  def snapshot(self):
+    return {self.name: self.fn()}
+
+
+class Histogram(object):  # noqa
+  """A distribution of samples.
+
+  The count, sum, min and max are exact over the lifetime of the histogram,
+  while percentiles are computed over a window of the most recent samples.
+  """
+
+  __slots__ = ('name', 'count', 'sum', 'min', 'max', '_window')
+
+  PERCENTILES = (50, 90, 99)
+
+  def __init__(self, name, window=1024):
+    self.name = name
+    self.count = 0
+    self.sum = 0
+    self.min = None
+    self.max = None
+    self._window = deque(maxlen=window)
+
+  def add(self, value):
+    self.count += 1
+    self.sum += value
+    if self.min is None or value < self.min:
+      self.min = value
+    if self.max is None or value > self.max:
+      self.max = value
+    self._window.append(value)
+
+  def snapshot(self):
+    snapshot = {
+      self.name + '/count': self.count,
+      self.name + '/sum': self.sum,
+    }
+    if self.count:
+      samples = sorted(self._window)
+      snapshot[self.name + '/min'] = self.min
+      snapshot[self.name + '/max'] = self.max
+      for percentile in self.PERCENTILES:
+        index = min(len(samples) - 1, len(samples) * percentile // 100)
+        snapshot['%s/p%d' % (self.name, percentile)] = samples[index]
+    return snapshot
+
+
+class Metrics(object):  # noqa
+  """A registry of named metrics."""
+
+  def __init__(self):
+    self._metrics = {}
+    self._lock = threading.Lock()
+
+  def __get_or_create(self, name, factory):
+    with self._lock:
+      metric = self._metrics.get(name)
+      if metric is None:
+        metric = self._metrics[name] = factory(name)
+      return metric
+
+  def counter(self, name):
+    """Return the counter named ``name``, creating it if necessary."""
+    return self.__get_or_create(name, Counter)
+
+  def gauge(self, name):
+    """Return the gauge named ``name``, creating it if necessary."""
+    return self.__get_or_create(name, Gauge)
+
+  def histogram(self, name):
+    """Return the histogram named ``name``, creating it if necessary."""
+    return self.__get_or_create(name, Histogram)
+
+  def callback(self, name, fn):
+    """Register ``fn`` to be called for the value of ``name`` in each snapshot."""
+    with self._lock:
+      metric = self._metrics[name] = Callback(name, fn)
+    return metric
+
+  def remove(self, name):
+    """Remove the metric named ``name``, if any."""
+    with self._lock:
+      self._metrics.pop(name, None)
+
+  def snapshot(self):
+    """Return a flat dictionary of metric names to values."""
+    with self._lock:
+      metrics = list(self._metrics.values())
+    snapshot = {}
+    for metric in metrics:
+      snapshot.update(metric.snapshot())
+    return snapshot
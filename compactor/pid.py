@@ -1,5 +1,47 @@
+import threading
+import weakref
+
+
 class PID(object):  # noqa
-  __slots__ = ('ip', 'port', 'id')
+  """The address of a process: its id and the ip and port of its context.
+
+  PIDs are immutable.  Their hash and string form are computed once, and
+  ``intern`` and ``from_string`` return a canonical instance for each
+  address, so the pids of live processes and of their peers compare and
+  hash as cheaply as possible wherever they are used as keys.
+  """
+
+  __slots__ = ('ip', 'port', 'id', '_hash', '_str', '__weakref__')
+
+  # Canonical pids, held only for as long as they are referenced elsewhere.
+  _INTERNED = weakref.WeakValueDictionary()
+  _INTERN_LOCK = threading.Lock()
+
+  # Pids parsed by ``from_string``, e.g. from the Libprocess-From header of every inbound
+  # message.  The cache is emptied once it reaches ``PARSE_CACHE_SIZE`` entries.
+  PARSE_CACHE_SIZE = 4096
+  _PARSED = {}
+
+  @classmethod
+  def intern(cls, ip, port, id_):
+    """Return the canonical pid for an address.
+
+    :param ip: An IP address in string form.
+    :type ip: ``str``
+    :param port: The port of this pid.
+    :type port: ``int``
+    :param id_: The name of the process.
+    :type id_: ``str``
+    :rtype: :class:`PID`
+    """
+    key = (ip, port, id_)
+    pid = cls._INTERNED.get(key)
+    if pid is None:
+      with cls._INTERN_LOCK:
+        pid = cls._INTERNED.get(key)
+        if pid is None:
+          pid = cls._INTERNED[key] = cls(ip, port, id_)
+    return pid
 
   @classmethod
   def from_string(cls, pid):
@@ -11,19 +53,28 @@ class PID(object):  # noqa
 
         pid = PID.from_string('master(1)@192.168.33.2:5051')
 
+    The result is the canonical pid, per ``intern``.
+
     :param pid: A string representation of a pid.
     :type pid: ``str``
     :return: The parsed pid.
     :rtype: :class:`PID`
     :raises: ``ValueError`` should the string not be of the correct syntax.
     """
+    parsed = cls._PARSED.get(pid)
+    if parsed is not None:
+      return parsed
     try:
       id_, ip_port = pid.split('@')
       ip, port = ip_port.split(':')
       port = int(port)
     except ValueError:
       raise ValueError('Invalid PID: %s' % pid)
-    return cls(ip, port, id_)
+    parsed = cls.intern(ip, port, id_)
+    if len(cls._PARSED) >= cls.PARSE_CACHE_SIZE:
+      cls._PARSED.clear()
+    cls._PARSED[pid] = parsed
+    return parsed
 
   def __init__(self, ip, port, id_):
     """Construct a pid.
@@ -38,12 +89,19 @@ class PID(object):  # noqa
     self.ip = ip
     self.port = port
     self.id = id_
+    self._hash = hash((ip, port, id_))
+    self._str = '%s@%s:%d' % (id_, ip, port)
+
+  def __reduce__(self):
+    # The hash of a string differs between interpreters, so recompute it when unpickling.
+    return _intern, (self.ip, self.port, self.id)
 
   def __hash__(self):
-    return hash((self.ip, self.port, self.id))
+    return self._hash
 
   def __eq__(self, other):
-    return isinstance(other, PID) and (
+    return self is other or isinstance(other, PID) and (
+      self._hash == other._hash and
       self.ip == other.ip and
       self.port == other.port and
       self.id == other.id
@@ -59,7 +117,12 @@ class PID(object):  # noqa
     return url
 
   def __str__(self):
-    return '%s@%s:%d' % (self.id, self.ip, self.port)
+    return self._str
 
   def __repr__(self):
     return 'PID(%s, %d, %s)' % (self.ip, self.port, self.id)
+
+
+def _intern(ip, port, id_):
+  # Python 2 cannot pickle classmethods, so ``PID.__reduce__`` refers to this function instead.
+  return PID.intern(ip, port, id_)
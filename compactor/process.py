@@ -1,8 +1,57 @@
 import functools
+import logging
+try:
+  import asyncio
+except ImportError:
+  import trollius as asyncio
 
 from .context import Context
+from .coroutines import is_coroutine_function, mark_coroutine_function
+from .executor import register
+from .mailbox import Priority
 from .pid import PID
 
+log = logging.getLogger(__name__)
+
+
+class HandlerTable(object):  # noqa
+  """The routes and mailboxes of a :class:`Process` class.
+
+  ``routes`` and ``mailboxes`` map each path and mailbox name to the function
+  that handles it and whether that function is a coroutine.
+  """
+
+  __slots__ = ('routes', 'mailboxes')
+
+  @classmethod
+  def resolve(cls, process_class):
+    """Find the handlers of ``process_class`` and its base classes.
+
+    Methods are resolved as attribute lookup would, so a subclass may override
+    an inherited handler, or hide it by overriding it with an undecorated method.
+    If methods of different names handle the same route or mailbox, the one
+    defined in the most derived class wins.
+    """
+    seen, table = set(), cls()
+    for klass in process_class.__mro__:
+      for name, method in klass.__dict__.items():
+        if name in seen:
+          continue
+        seen.add(name)
+        if not callable(method):
+          continue
+        route = getattr(method, process_class.ROUTE_ATTRIBUTE, None)
+        if route is not None and route not in table.routes:
+          table.routes[route] = (method, is_coroutine_function(method))
+        mailbox = getattr(method, process_class.INSTALL_ATTRIBUTE, None)
+        if mailbox is not None and mailbox not in table.mailboxes:
+          table.mailboxes[mailbox] = (method, is_coroutine_function(method))
+    return table
+
+  def __init__(self):
+    self.routes = {}
+    self.mailboxes = {}
+
 
 class Process(object):
   class Error(Exception): pass
@@ -11,6 +60,10 @@ class Process(object):
   ROUTE_ATTRIBUTE = '__route__'
   INSTALL_ATTRIBUTE = '__mailbox__'
 
+  #: The relative share of its context's message handling this process
+  #: receives when the context uses ``Scheduler.WEIGHTED`` scheduling.
+  weight = 1
+
   @classmethod
   def route(cls, path):
     """A decorator to indicate that a method should be a routable HTTP endpoint.
@@ -24,7 +77,22 @@ class Process(object):
           def hello_world(self, handler):
             return handler.write('<html><title>hello world</title></html>')
 
-    The handler passed to the method is a tornado RequestHandler.
+    The handler passed to the method is a tornado RequestHandler.  The method
+    may be a coroutine, i.e. ``async def``, in which case the response is
+    finished once the coroutine completes.
+
+    Routes are matched literally unless they contain regular expression
+    groups, in which case the matched groups are passed to the method as
+    additional positional arguments:
+
+    .. code-block:: python
+
+        class TaskProcess(Process):
+          @Process.route('/tasks/([0-9]+)')
+          def task(self, handler, task_id):
+            return handler.write(self.tasks[int(task_id)])
+
+    Literal routes are resolved with a single lookup, so prefer them where possible.
 
     WARNING: This interface is alpha and may change in the future if or when
     we remove tornado as a compactor dependency.
@@ -46,7 +114,7 @@ class Process(object):
   # TODO(wickman) Make INSTALL_ATTRIBUTE a defaultdict(list) so that we can
   # route multiple endpoints to a single method.
   @classmethod
-  def install(cls, mbox):
+  def install(cls, mbox, priority=None):
     """A decorator to indicate a remotely callable method on a process.
 
     .. code-block:: python
@@ -62,14 +130,114 @@ class Process(object):
     ``from_pid`` is the process calling the method.  ``body`` is a ``bytes``
     stream that was delivered with the message, possibly empty.
 
+    The method may be a coroutine, i.e. ``async def``, in which case it is run
+    as a task on the context's asyncio loop and may await I/O without blocking
+    other processes.  See the context's ``max_coroutines_per_process`` option.
+
+    Messages are handled in order of ``priority`` and then of arrival, so
+    control messages may be installed with ``Priority.HIGH`` to overtake bulk
+    traffic installed with ``Priority.NORMAL`` or ``Priority.LOW``:
+
+    .. code-block:: python
+
+        from compactor.mailbox import Priority
+
+        class MasterProcess(Process):
+          @Process.install('reregister', priority=Priority.HIGH)
+          def reregister(self, from_pid, body):
+            # do something
+
     :param mbox: Incoming messages to this "mailbox" will be dispatched to this method.
     :type mbox: ``str``
+    :keyword priority: The priority of messages to this mailbox, ``Priority.NORMAL``
+       by default.
+    :type priority: One of ``Priority.ALL`` or None
     """
+    if priority is not None:
+      Priority.validate(priority)
+
     def wrap(fn):
       setattr(fn, cls.INSTALL_ATTRIBUTE, mbox)
+      if priority is not None:
+        setattr(fn, Priority.ATTRIBUTE, priority)
       return fn
     return wrap
 
+  @classmethod
+  def cpu_bound(cls, callback):
+    """A decorator to run an installed method in the context's process pool.
+
+    Use this for handlers that do enough work to stall every other process on
+    the context's event loop.  The decorated function does not take ``self``,
+    since it runs in another process, and its return value is passed to the
+    ``callback`` method on the event loop, from which the process may send
+    messages as usual:
+
+    .. code-block:: python
+
+        class OfferProcess(Process):
+          @Process.install('offers')
+          @Process.cpu_bound('offers_computed')
+          def offers(from_pid, body):
+            return compute_offers(body)
+
+          def offers_computed(self, from_pid, offers):
+            self.send(from_pid, 'offers', offers)
+
+    The body, the return value and any exception raised must be picklable.
+    Exceptions are logged and the callback is not called.
+
+    :param callback: The name of the method called with ``from_pid`` and the result.
+    :type callback: ``str``
+    """
+    def wrap(fn):
+      target = register(fn)
+
+      @functools.wraps(fn)
+      def wrapped_fn(self, from_pid, body):
+        future = self.compute(target, from_pid, body)
+        future.add_done_callback(
+            lambda future: self._on_completed(fn.__name__, callback, from_pid, future))
+      return wrapped_fn
+    return wrap
+
+  @classmethod
+  def blocking(cls, callback=None):
+    """A decorator to run an installed method in the context's thread pool.
+
+    Use this for handlers that make blocking calls, such as disk or database
+    I/O, so that they do not stall every other process on the context's
+    event loop.  If ``callback`` is given, the return value of the method is
+    passed to the ``callback`` method on the event loop:
+
+    .. code-block:: python
+
+        class StoreProcess(Process):
+          @Process.install('fetch')
+          @Process.blocking('fetched')
+          def fetch(self, from_pid, body):
+            return self.database.get(body)
+
+          def fetched(self, from_pid, value):
+            self.send(from_pid, 'value', value)
+
+    Callbacks for messages to the same process are called in the order the
+    messages were delivered.  Since the method runs on another thread, it
+    should leave the process' state to the callback.  Exceptions are logged
+    and the callback is not called.
+
+    :keyword callback: The name of the method called with ``from_pid`` and the result.
+    :type callback: ``str`` or None
+    """
+    def wrap(fn):
+      @functools.wraps(fn)
+      def wrapped_fn(self, from_pid, body):
+        future = self.defer(fn, self, from_pid, body)
+        future.add_done_callback(
+            lambda future: self._on_completed(fn.__name__, callback, from_pid, future))
+      return wrapped_fn
+    return wrap
+
   def __init__(self, name):
     """Create a process with a given name.
 
@@ -82,30 +250,49 @@ class Process(object):
 
     self.name = name
     self._delegates = {}
-    self._http_handlers = dict(self.iter_routes())
-    self._message_handlers = dict(self.iter_handlers())
+    self._handlers = self.handler_table()
     self._context = None
+    self._pid = None
 
-  def __iter_callables(self):
-    # iterate over the methods in a way where we can differentiate methods from descriptors
-    for method in type(self).__dict__.values():
-      if callable(method):
-        # 'method' is the unbound method on the class -- we want to return the bound instancemethod
-        try:
-          yield getattr(self, method.__name__)
-        except AttributeError:
-          # This is possible for __name_mangled_attributes.
-          continue
+  @classmethod
+  def handler_table(cls):
+    """The routes and mailboxes of this class, including those of its base classes.
+
+    The table is resolved the first time a class is instantiated and cached
+    on the class, so that creating a process does no reflection.  The handlers
+    of mailboxes are bound when a process is spawned, and those of routes for
+    each request.
+
+    :rtype: :class:`HandlerTable`
+    """
+    table = cls.__dict__.get('_handler_table')
+    if table is None:
+      table = cls._handler_table = HandlerTable.resolve(cls)
+    return table
+
+  def __bind(self, method, coroutine, log_errors):
+    # Bind the method itself rather than looking it up, since instance attributes may shadow it.
+    handler = method.__get__(self, type(self))
+    if not coroutine:
+      return handler
+
+    # Wrap a coroutine handler so that calling it schedules it on the context's loop.
+    @functools.wraps(handler)
+    def run_coroutine(*args):
+      future = self._context.run_coroutine(self.pid, handler, *args)
+      if log_errors:
+        future.add_done_callback(
+            lambda future: self._on_completed(handler.__name__, None, None, future))
+      return future
+    return run_coroutine
 
   def iter_routes(self):
-    for function in self.__iter_callables():
-      if hasattr(function, self.ROUTE_ATTRIBUTE):
-        yield getattr(function, self.ROUTE_ATTRIBUTE), function
+    for path, (method, _) in self._handlers.routes.items():
+      yield path, method.__get__(self, type(self))
 
   def iter_handlers(self):
-    for function in self.__iter_callables():
-      if hasattr(function, self.INSTALL_ATTRIBUTE):
-        yield getattr(function, self.INSTALL_ATTRIBUTE), function
+    for name, (method, _) in self._handlers.mailboxes.items():
+      yield name, method.__get__(self, type(self))
 
   def _assert_bound(self):
     if not self._context:
@@ -115,6 +302,7 @@ class Process(object):
     if not isinstance(context, Context):
       raise TypeError('Can only bind to a Context, got %s' % type(context))
     self._context = context
+    self._pid = PID.intern(context.ip, context.port, self.name)
 
   @property
   def pid(self):
@@ -124,7 +312,7 @@ class Process(object):
              process is not bound to a context.
     """
     self._assert_bound()
-    return PID(self._context.ip, self._context.port, self.name)
+    return self._pid
 
   @property
   def context(self):
@@ -138,24 +326,32 @@ class Process(object):
 
   @property
   def route_paths(self):
-    return self._http_handlers.keys()
+    return self._handlers.routes.keys()
 
   @property
   def message_names(self):
-    return self._message_handlers.keys()
+    return self._handlers.mailboxes.keys()
+
+  @property
+  def message_handlers(self):
+    return [
+      (name, self.__bind(method, coroutine, log_errors=True))
+      for name, (method, coroutine) in self._handlers.mailboxes.items()
+    ]
 
   def delegate(self, name, pid):
     self._delegates[name] = pid
 
   def handle_message(self, name, from_pid, body):
-    if name in self._message_handlers:
-      self._message_handlers[name](from_pid, body)
+    if name in self._handlers.mailboxes:
+      self._context.receive(self.pid, name, from_pid, body)
     elif name in self._delegates:
       to = self._delegates[name]
       self._context.transport(to, name, body, from_pid)
 
   def handle_http(self, route, handler, *args, **kw):
-    return self._http_handlers[route](handler, *args, **kw)
+    method, coroutine = self._handlers.routes[route]
+    return self.__bind(method, coroutine, log_errors=False)(handler, *args, **kw)
 
   def initialize(self):
     """Called when this process is spawned.
@@ -172,7 +368,7 @@ class Process(object):
     :type pid: :class:`PID`
     """
 
-  def send(self, to, method, body=None):
+  def send(self, to, method, body=None, priority=None):
     """Send a message to another process.
 
     Sending messages is done asynchronously and is not guaranteed to succeed.
@@ -185,12 +381,95 @@ class Process(object):
     :type method: ``str``
     :keyword body: The optional content to send with the message.
     :type body: ``bytes`` or None
+    :keyword priority: Overrides the priority with which a local destination
+       handles the message.  See ``Context.send``.
+    :type priority: One of ``Priority.ALL`` or None
     :raises: Will raise a ``Process.UnboundProcess`` exception if the
-             process is not bound to a context.
+             process is not bound to a context, or ``Context.QueueFull`` if the
+             destination is congested and the context's queue limits are exceeded.
     :return: Nothing
     """
     self._assert_bound()
-    self._context.send(self.pid, to, method, body)
+    if priority is not None:
+      Priority.validate(priority)
+    self._context.send(self.pid, to, method, body, priority=priority)
+
+  def broadcast(self, pids, method, body=None, priority=None):
+    """Send the same message to many processes.
+
+    The body is encoded once for all destinations, and messages to processes
+    on the same remote endpoint are coalesced into the same writes.
+
+    Returns immediately.
+
+    :param pids: The pids of the processes to send the message.
+    :type pids: iterable of :class:`PID`
+    :param method: The method/mailbox name of the remote method.
+    :type method: ``str``
+    :keyword body: The optional content to send with the message.
+    :type body: ``bytes`` or None
+    :keyword priority: See ``Process.send``.
+    :type priority: One of ``Priority.ALL`` or None
+    :raises: Will raise a ``Process.UnboundProcess`` exception if the
+             process is not bound to a context, or ``Context.QueueFull`` if a
+             destination is congested and the context's queue limits are exceeded.
+    :return: Nothing
+    """
+    self._assert_bound()
+    if priority is not None:
+      Priority.validate(priority)
+    self._context.broadcast(self.pid, pids, method, body, priority=priority)
+
+  def compute(self, fn, *args):
+    """Call a function in the process pool of the bound context.
+
+    See ``Context.compute``.
+
+    :param fn: A picklable function.
+    :type fn: ``callable``
+    :raises: Will raise a ``Process.UnboundProcess`` exception if the
+             process is not bound to a context.
+    :return: A future resolved with the result of ``fn(*args)`` on the context's loop.
+    :rtype: ``tornado.concurrent.Future``
+    """
+    self._assert_bound()
+    return self._context.compute(fn, *args)
+
+  def defer(self, fn, *args):
+    """Call a blocking function in the thread pool of the bound context.
+
+    See ``Context.defer``.  Results of calls deferred by this process are
+    resolved on the context's loop in the order the calls were made, so the
+    continuation may safely update the process' state and send messages:
+
+    .. code-block:: python
+
+        @Process.install('ping')
+        def ping(self, from_pid, body):
+          self.defer(time.sleep, 0.5).add_done_callback(
+              lambda future: self.send(from_pid, 'pong'))
+
+    :param fn: The function to call.
+    :type fn: ``callable``
+    :raises: Will raise a ``Process.UnboundProcess`` exception if the
+             process is not bound to a context.
+    :return: A future resolved with the result of ``fn(*args)`` on the context's loop.
+    :rtype: ``tornado.concurrent.Future``
+    """
+    self._assert_bound()
+    return self._context.defer(self.pid, fn, *args)
+
+  def _on_completed(self, name, callback, from_pid, future):
+    try:
+      result = future.result()
+    except asyncio.CancelledError:
+      # The process was terminated.  Since Python 3.8 this is not an Exception.
+      return
+    except Exception as e:
+      log.error('%s failed for %s: %r', name, self.pid, e)
+      return
+    if callback is not None:
+      getattr(self, callback)(from_pid, result)
 
   def link(self, to):
     """Link to another process.
@@ -224,7 +503,7 @@ class Process(object):
 
 class ProtobufProcess(Process):
   @classmethod
-  def install(cls, message_type):
+  def install(cls, message_type, priority=None):
     """A decorator to indicate a remotely callable method on a process using protocol buffers.
 
     .. code-block:: python
@@ -246,6 +525,8 @@ class ProtobufProcess(Process):
 
     :param message_type: Incoming messages to this message_type will be dispatched to this method.
     :type message_type: A generated protocol buffer stub
+    :keyword priority: The priority of messages of this type.  See ``Process.install``.
+    :type priority: One of ``Priority.ALL`` or None
     """
     def wrap(fn):
       @functools.wraps(fn)
@@ -253,10 +534,12 @@ class ProtobufProcess(Process):
         message = message_type()
         message.MergeFromString(message_str)
         return fn(self, from_pid, message)
-      return Process.install(message_type.DESCRIPTOR.full_name)(wrapped_fn)
+      if is_coroutine_function(fn):
+        mark_coroutine_function(wrapped_fn)
+      return Process.install(message_type.DESCRIPTOR.full_name, priority=priority)(wrapped_fn)
     return wrap
 
-  def send(self, to, message):
+  def send(self, to, message, priority=None):
     """Send a message to another process.
 
     Same as ``Process.send`` except that ``message`` is a protocol buffer.
@@ -267,8 +550,30 @@ class ProtobufProcess(Process):
     :type to: :class:`PID`
     :param message: The message to send
     :type method: A protocol buffer instance.
+    :keyword priority: See ``Process.send``.
+    :type priority: One of ``Priority.ALL`` or None
+    :raises: Will raise a ``Process.UnboundProcess`` exception if the
+             process is not bound to a context.
+    :return: Nothing
+    """
+    super(ProtobufProcess, self).send(
+        to, message.DESCRIPTOR.full_name, message.SerializeToString(), priority=priority)
+
+  def broadcast(self, pids, message, priority=None):
+    """Send the same message to many processes.
+
+    Same as ``Process.broadcast`` except that ``message`` is a protocol buffer,
+    which is serialized once for all destinations.
+
+    :param pids: The pids of the processes to send the message.
+    :type pids: iterable of :class:`PID`
+    :param message: The message to send
+    :type message: A protocol buffer instance.
+    :keyword priority: See ``Process.send``.
+    :type priority: One of ``Priority.ALL`` or None
     :raises: Will raise a ``Process.UnboundProcess`` exception if the
              process is not bound to a context.
     :return: Nothing
     """
-    super(ProtobufProcess, self).send(to, message.DESCRIPTOR.full_name, message.SerializeToString())
+    super(ProtobufProcess, self).broadcast(
+        pids, message.DESCRIPTOR.full_name, message.SerializeToString(), priority=priority)
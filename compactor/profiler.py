@@ -0,0 +1,274 @@
+"""Profile a context's loop on demand, attributing its time to processes and mailboxes."""
+
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+
+from .instrumentation import handler_name, Instrument
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.web import HTTPError, RequestHandler
+
+log = logging.getLogger(__name__)
+
+# CPU time of the calling thread where available, else wall time.
+_thread_time = getattr(time, 'thread_time', time.time)
+
+
+class HandlerTimes(Instrument):
+  """Accumulates the number of invocations and the CPU and wall time of every handler.
+
+  Times are keyed by the pid of the process and the mailbox or route of the
+  handler.  CPU time is that of the loop thread, where the platform
+  provides it.
+  """
+
+  def __init__(self):
+    self.current = None  # (pid, name, cpu time at start)
+    self.times = {}  # (pid, name) => [invocations, cpu secs, wall secs]
+
+  def on_handler_start(self, pid, handler, started):
+    self.current = (pid, handler_name(handler), _thread_time())
+
+  def on_handler_end(self, pid, handler, elapsed):
+    current, self.current = self.current, None
+    if current is None:
+      return
+    pid, name, cpu_started = current
+    times = self.times.get((pid, name))
+    if times is None:
+      times = self.times[(pid, name)] = [0, 0.0, 0.0]
+    times[0] += 1
+    times[1] += _thread_time() - cpu_started
+    times[2] += elapsed
+
+  def as_list(self):
+    """Return the times of every handler, most CPU time first."""
+    return [
+      {'pid': str(pid), 'name': name, 'invocations': times[0], 'cpu_secs': times[1],
+       'wall_secs': times[2]}
+      for (pid, name), times in sorted(self.times.items(), key=lambda item: -item[1][1])
+    ]
+
+
+class Profile(object):  # noqa
+  """The result of profiling a loop.
+
+  ``text`` is the output of ``pstats`` for ``cprofile`` profiles, or one
+  line of semicolon separated frames and a sample count per stack for
+  ``sample`` profiles, i.e. the collapsed stacks taken by flame graph tools.
+  Sampled stacks are rooted at the pid and mailbox whose handler was running,
+  if any.
+  """
+
+  def __init__(self, mode, duration, text, handlers):
+    self.mode = mode
+    self.duration = duration
+    self.text = text
+    self.handlers = handlers
+
+  def as_dict(self):
+    return {
+      'mode': self.mode,
+      'duration_secs': self.duration,
+      'profile': self.text,
+      'handlers': self.handlers.as_list(),
+    }
+
+
+class Profiler(object):  # noqa
+  """Profiles the loop of a context for a number of seconds at a time.
+
+  In ``SAMPLE`` mode, a thread records the stack of the loop thread every
+  ``interval`` seconds, which costs the loop little beyond the GIL the
+  sampler takes.  In ``CPROFILE`` mode, ``cProfile`` traces every call on
+  the loop thread, which is exact but can slow the loop down several times.
+  Either way the handlers that run are timed, and only one profile is taken
+  at a time.
+  """
+
+  class Error(Exception): pass
+  class Busy(Error): pass
+
+  SAMPLE = 'sample'
+  CPROFILE = 'cprofile'
+  MODES = (SAMPLE, CPROFILE)
+
+  DEFAULT_INTERVAL_SECS = 0.005
+  MAX_DURATION_SECS = 60
+
+  def __init__(self, loop, instruments, thread_ident=None):
+    """
+    :param loop: The tornado IOLoop to profile.
+    :param instruments: The instruments of the loop's context, to which handler timing
+       is added while profiling.
+    :type instruments: ``list``
+    :keyword thread_ident: The ident of the thread running the loop, by default the
+       calling thread.
+    """
+    self._loop = loop
+    self._instruments = instruments
+    self._thread_ident = thread_ident or threading.current_thread().ident
+    self._running = False
+    self._lock = threading.Lock()
+
+  def profile(self, duration, mode=SAMPLE, interval=DEFAULT_INTERVAL_SECS, sort='cumulative'):
+    """Profile the loop for ``duration`` seconds.
+
+    :param duration: The number of seconds to profile for, at most ``MAX_DURATION_SECS``.
+    :type duration: ``float``
+    :keyword mode: ``Profiler.SAMPLE`` or ``Profiler.CPROFILE``.
+    :keyword interval: The number of seconds between samples.
+    :type interval: ``float``
+    :keyword sort: The ``pstats`` sort key of ``CPROFILE`` output.
+    :type sort: ``str``
+    :raises: ``Profiler.Busy`` if a profile is already being taken.
+    :return: A future resolved on the loop with a :class:`Profile`.
+    :rtype: ``tornado.concurrent.Future``
+    """
+    if mode not in self.MODES:
+      raise ValueError('Unknown profiling mode %r' % (mode,))
+    if not 0 < duration <= self.MAX_DURATION_SECS:
+      raise ValueError('duration must be positive and at most %d seconds.' % self.MAX_DURATION_SECS)
+    if interval <= 0:
+      raise ValueError('interval must be positive.')
+    if mode == self.CPROFILE and sort not in pstats.Stats.sort_arg_dict_default:
+      raise ValueError('Unknown sort key %r' % (sort,))
+    with self._lock:
+      if self._running:
+        raise self.Busy('A profile is already being taken.')
+      self._running = True
+
+    future = Future()
+    handlers = HandlerTimes()
+    self._instruments.append(handlers)
+
+    def finish(text, exc_info=None):
+      # Always allow the next profile, whether or not this one succeeded.
+      try:
+        self._instruments.remove(handlers)
+      except Exception:
+        exc_info = exc_info or sys.exc_info()
+      finally:
+        with self._lock:
+          self._running = False
+      if exc_info is not None:
+        future.set_exc_info(exc_info)
+      else:
+        future.set_result(Profile(mode, duration, text, handlers))
+
+    try:
+      if mode == self.SAMPLE:
+        sampler = threading.Thread(
+            target=self.__sample,
+            args=(handlers, duration, interval, finish),
+            name='CompactorProfiler')
+        sampler.daemon = True
+        sampler.start()
+      else:
+        self._loop.add_callback(self.__trace, duration, sort, finish)
+    except Exception:
+      finish(None, sys.exc_info())
+    return future
+
+  def __trace(self, duration, sort, finish):
+    # cProfile traces the thread that enables it, so this runs on the loop.
+    profile = cProfile.Profile()
+
+    def stop():
+      text, exc_info = None, None
+      try:
+        profile.disable()
+        out = io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO()
+        pstats.Stats(profile, stream=out).sort_stats(sort).print_stats()
+        text = out.getvalue()
+      except Exception:
+        exc_info = sys.exc_info()
+      finally:
+        finish(text, exc_info)
+
+    timeout = self._loop.add_timeout(self._loop.time() + duration, stop)
+    try:
+      profile.enable()
+    except Exception:
+      self._loop.remove_timeout(timeout)
+      finish(None, sys.exc_info())
+
+  @classmethod
+  def _collapse(cls, frame):
+    stack = []
+    while frame is not None:
+      code = frame.f_code
+      stack.append('%s:%s' % (os.path.basename(code.co_filename), code.co_name))
+      frame = frame.f_back
+    stack.reverse()
+    return stack
+
+  def __sample(self, handlers, duration, interval, finish):
+    text, exc_info = None, None
+    try:
+      counts = {}
+      deadline = time.time() + duration
+      while time.time() < deadline:
+        frame = sys._current_frames().get(self._thread_ident)
+        if frame is not None:
+          stack = self._collapse(frame)
+          current = handlers.current
+          if current is not None:
+            stack[:0] = [str(current[0]), current[1]]
+          key = ';'.join(stack)
+          counts[key] = counts.get(key, 0) + 1
+        del frame
+        time.sleep(interval)
+      text = ''.join('%s %d\n' % item for item in sorted(counts.items()))
+    except Exception:
+      exc_info = sys.exc_info()
+    finally:
+      self._loop.add_callback(finish, text, exc_info)
+
+
+class ProfileHandler(RequestHandler):
+  """Profiles the loop of a context for the duration of a request.
+
+  Query arguments are ``duration`` in seconds, ``mode`` (``sample`` or
+  ``cprofile``), ``interval`` between samples in seconds, ``sort`` for
+  ``cprofile`` output and ``format``.  The response is the text of the
+  profile unless ``format`` is ``json``, in which case it also includes the
+  time spent in the handler of each process and mailbox.  Requests made
+  while a profile is being taken are answered with 409.
+  """
+
+  DEFAULT_DURATION_SECS = 5
+
+  def initialize(self, profiler=None):
+    self.profiler = profiler
+
+  @gen.coroutine
+  def get(self):
+    try:
+      duration = float(self.get_argument('duration', self.DEFAULT_DURATION_SECS))
+      interval = float(self.get_argument('interval', Profiler.DEFAULT_INTERVAL_SECS))
+      future = self.profiler.profile(
+          duration,
+          mode=self.get_argument('mode', Profiler.SAMPLE),
+          interval=interval,
+          sort=self.get_argument('sort', 'cumulative'))
+    except ValueError as e:
+      raise HTTPError(400, str(e))
+    except Profiler.Busy:
+      raise HTTPError(409)
+    profile = yield future
+    if self.get_argument('format', 'text') == 'json':
+      self.set_header('Content-Type', 'application/json')
+      self.write(json.dumps(profile.as_dict(), sort_keys=True))
+    else:
+      self.set_header('Content-Type', 'text/plain')
+      self.write(profile.text)
+    self.finish()
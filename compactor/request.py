@@ -1,27 +1,34 @@
+from .cache import LRUCache
 
 CRLF = b'\r\n'
 
 
-def encode_request(from_pid, to_pid, method, body=None, content_type=None, legacy=False):
-  """
-  Encode a request into a raw HTTP request. This function returns a string
-  of bytes that represent a valid HTTP/1.0 request, including any libprocess
-  headers required for communication.
+_PREFIX_CACHE = LRUCache(4096)
 
-  Use the `legacy` option (set to True) to use the legacy User-Agent based
-  libprocess identification.
-  """
 
-  if body is None:
-    body = b''
+HEARTBEAT_PATH = '/__heartbeat__'
 
-  if not isinstance(body, (bytes, bytearray)):
-    raise TypeError('Body must be a sequence of bytes.')
+# A plain HTTP request, rather than a libprocess message, so that every peer answers it.
+HEARTBEAT_REQUEST = (
+    'GET {path} HTTP/1.0\r\nConnection: Keep-Alive\r\n\r\n'.format(path=HEARTBEAT_PATH)
+).encode('ascii')
+
+
+def encode_request_prefix(from_pid, to_pid, method, content_type=None, legacy=False):
+  """
+  Encode the HTTP request line and every header of a request except its
+  Content-Length.  The prefix only depends upon its arguments, so it is
+  cached for the most recently used combinations.
+  """
+
+  key = (from_pid, to_pid, method, legacy, content_type)
+  prefix = _PREFIX_CACHE.get(key)
+  if prefix is not None:
+    return prefix
 
   headers = [
     'POST /{process}/{method} HTTP/1.0'.format(process=to_pid.id, method=method),
     'Connection: Keep-Alive',
-    'Content-Length: %d' % len(body)
   ]
 
   if legacy:
@@ -32,14 +39,54 @@ def encode_request(from_pid, to_pid, method, body=None, content_type=None, legac
   if content_type is not None:
     headers.append('Content-Type: {content_type}'.format(content_type=content_type))
 
-  headers = [header.encode('utf8') for header in headers]
+  prefix = ''.join(header + '\r\n' for header in headers).encode('utf8')
+  _PREFIX_CACHE.put(key, prefix)
+  return prefix
+
+
+def encode_content_length(content_length):
+  """Encode the Content-Length header and the blank line that ends the request headers."""
+  return b'Content-Length: ' + str(content_length).encode('ascii') + CRLF + CRLF
+
+
+def encode_request_segments(from_pid, to_pid, method, body=None, content_type=None,
+                            legacy=False):
+  """
+  Encode a request into a list of byte segments: the cached header prefix,
+  the Content-Length line and, if the body is not empty, the body.  A
+  ``bytes`` body is not copied.
+
+  See ``encode_request`` for the arguments.
+  """
+
+  if body is None:
+    body = b''
+
+  if not isinstance(body, (bytes, bytearray)):
+    raise TypeError('Body must be a sequence of bytes.')
+
+  segments = [
+    encode_request_prefix(from_pid, to_pid, method, content_type=content_type, legacy=legacy),
+    encode_content_length(len(body)),
+  ]
+
+  if body:
+    # bytes(), as every segment is written or joined as bytes, and on Python 2 a memoryview
+    # or bytearray can be neither.
+    segments.append(body if isinstance(body, bytes) else bytes(body))
 
-  def iter_fragments():
-    for fragment in headers:
-      yield fragment
-      yield CRLF
-    yield CRLF
-    if body:
-      yield body
+  return segments
+
+
+def encode_request(from_pid, to_pid, method, body=None, content_type=None, legacy=False):
+  """
+  Encode a request into a raw HTTP request. This function returns a string
+  of bytes that represent a valid HTTP/1.0 request, including any libprocess
+  headers required for communication.
+
+  Use the `legacy` option (set to True) to use the legacy User-Agent based
+  libprocess identification.
+  """
 
-  return b''.join(iter_fragments())
+  return b''.join(encode_request_segments(
+      from_pid, to_pid, method, body=body, content_type=content_type, legacy=legacy))
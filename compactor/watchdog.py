@@ -0,0 +1,214 @@
+"""Monitor the responsiveness of a context's loop and the handlers that run on it."""
+
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+from .instrumentation import handler_name, Instrument
+
+log = logging.getLogger(__name__)
+
+
+class LoopMonitor(object):  # noqa
+  """Measures how late a timer scheduled every ``interval`` seconds fires on a loop.
+
+  Every process on a context shares its loop, so the lag of the timer is
+  the time a message or request arriving at that moment would have waited
+  behind whatever was running.
+
+  Metrics:
+
+  * ``loop/lag_secs``: how late each tick ran.
+  """
+
+  DEFAULT_INTERVAL_SECS = 1.0
+
+  def __init__(self, loop, interval=DEFAULT_INTERVAL_SECS, metrics=None):
+    """
+    :param loop: The tornado IOLoop to monitor.
+    :keyword interval: The number of seconds between ticks.
+    :type interval: ``float``
+    :keyword metrics: The registry in which to record metrics.
+    :type metrics: :class:`compactor.metrics.Metrics` or None
+    """
+    if interval <= 0:
+      raise ValueError('interval must be positive.')
+    self._loop = loop
+    self._interval = interval
+    self._lag = metrics.histogram('loop/lag_secs') if metrics is not None else None
+    self._deadline = None
+    self._timeout = None
+    self.lag = self.max_lag = 0.0
+
+  def start(self):
+    """Start ticking.  This must be called on the loop."""
+    self.__schedule()
+
+  def stop(self):
+    if self._timeout is not None:
+      self._loop.remove_timeout(self._timeout)
+      self._timeout = None
+
+  def __schedule(self):
+    self._deadline = self._loop.time() + self._interval
+    self._timeout = self._loop.add_timeout(self._deadline, self._tick)
+
+  def _tick(self):
+    self.lag = max(0.0, self._loop.time() - self._deadline)
+    self.max_lag = max(self.max_lag, self.lag)
+    if self._lag:
+      self._lag.add(self.lag)
+    self.__schedule()
+
+  def status(self):
+    """Return the lag of the most recent tick and the largest lag seen."""
+    return {
+      'interval_secs': self._interval,
+      'lag_secs': self.lag,
+      'max_lag_secs': self.max_lag,
+    }
+
+
+class SlowInvocation(object):  # noqa
+  """A handler invocation that ran for longer than a :class:`Watchdog`'s threshold."""
+
+  __slots__ = ('pid', 'name', 'started', 'elapsed', 'stack')
+
+  def __init__(self, pid, name, started, elapsed=None, stack=None):
+    self.pid = pid
+    self.name = name
+    self.started = started
+    self.elapsed = elapsed
+    self.stack = stack
+
+  def as_dict(self):
+    return {
+      'pid': str(self.pid),
+      'name': self.name,
+      'started': self.started,
+      'elapsed_secs': self.elapsed,
+      'stack': self.stack,
+    }
+
+
+class Watchdog(Instrument):
+  """Reports handler invocations that hold a context's loop for longer than a threshold.
+
+  As an instrument, the watchdog is told by the context when each handler
+  starts and ends on the loop.  Invocations that run for
+  longer than ``threshold`` seconds are logged and counted, naming the
+  process and the mailbox or route, and the most recent are kept for
+  ``status``.
+
+  If ``capture_stacks`` is True, a thread checks on the running invocation
+  every half ``threshold`` and records the stack of the loop thread the
+  first time it finds an invocation over the threshold, i.e. where the
+  handler was stuck rather than where it finished.
+
+  Metrics:
+
+  * ``loop/slow_handlers``: handler invocations over the threshold.
+  """
+
+  DEFAULT_THRESHOLD_SECS = 1.0
+  DEFAULT_HISTORY = 64
+
+  def __init__(self, threshold=DEFAULT_THRESHOLD_SECS, capture_stacks=False,
+               history=DEFAULT_HISTORY, metrics=None):
+    """
+    :keyword threshold: The number of seconds after which an invocation is slow.
+    :type threshold: ``float``
+    :keyword capture_stacks: Whether to record the stack of slow invocations.
+    :type capture_stacks: ``bool``
+    :keyword history: The number of recent slow invocations to keep.
+    :type history: ``int``
+    :keyword metrics: The registry in which to record metrics.
+    :type metrics: :class:`compactor.metrics.Metrics` or None
+    """
+    if threshold <= 0:
+      raise ValueError('threshold must be positive.')
+    if history < 1:
+      raise ValueError('history must be at least 1.')
+    self.threshold = threshold
+    self._capture_stacks = capture_stacks
+    self._slow = metrics.counter('loop/slow_handlers') if metrics is not None else None
+    self._recent = deque(maxlen=history)
+    self._current = None  # (pid, handler, started)
+    self._captured = None  # SlowInvocation captured for the current invocation
+    self._lock = threading.Lock()
+    self._stopped = threading.Event()
+    self._thread_ident = None
+
+  def start(self, thread_ident=None):
+    """Start capturing stacks, if enabled, of the loop running on the thread ``thread_ident``.
+
+    :keyword thread_ident: The ident of the thread running the loop, by default the
+       calling thread.
+    """
+    if not self._capture_stacks:
+      return
+    self._thread_ident = thread_ident or threading.current_thread().ident
+    thread = threading.Thread(target=self.__watch, name='CompactorWatchdog')
+    thread.daemon = True
+    thread.start()
+
+  def stop(self):
+    self._stopped.set()
+
+  def on_handler_start(self, pid, handler, started):
+    self._current = (pid, handler, started)
+
+  def on_handler_end(self, pid, handler, elapsed):
+    current, self._current = self._current, None
+    if elapsed < self.threshold or current is None:
+      self._captured = None
+      return
+    pid, handler, started = current
+    with self._lock:
+      invocation, self._captured = self._captured, None
+    if invocation is None or invocation.started != started:
+      invocation = SlowInvocation(pid, handler_name(handler), started)
+    invocation.elapsed = elapsed
+    self._recent.append(invocation)
+    if self._slow:
+      self._slow.increment()
+    log.warning('%s held the loop for %.3fs handling %s', pid, elapsed, invocation.name)
+
+  def __watch(self):
+    interval = self.threshold / 2.0
+    while not self._stopped.wait(interval):
+      current = self._current
+      if current is None:
+        continue
+      pid, handler, started = current
+      if time.time() - started < self.threshold:
+        continue
+      with self._lock:
+        if self._captured is not None and self._captured.started == started:
+          continue
+        frame = sys._current_frames().get(self._thread_ident)
+        if frame is None:
+          continue
+        self._captured = SlowInvocation(
+            pid, handler_name(handler), started, stack=''.join(traceback.format_stack(frame)))
+
+  def status(self):
+    """Return the running invocation, if it is slow, and the most recent slow invocations."""
+    running = None
+    current = self._current
+    if current is not None:
+      pid, handler, started = current
+      elapsed = time.time() - started
+      if elapsed >= self.threshold:
+        running = SlowInvocation(pid, handler_name(handler), started, elapsed).as_dict()
+        with self._lock:
+          if self._captured is not None and self._captured.started == started:
+            running['stack'] = self._captured.stack
+    return {
+      'threshold_secs': self.threshold,
+      'running': running,
+      'recent': [invocation.as_dict() for invocation in self._recent],
+    }
@@ -0,0 +1,7 @@
+import sys
+
+collect_ignore = []
+
+# async def is a syntax error before Python 3.5.
+if sys.version_info < (3, 5):
+  collect_ignore.append('test_coroutines.py')
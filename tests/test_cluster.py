@@ -0,0 +1,102 @@
+import os
+import threading
+
+from compactor.cluster import ContextCluster, place, Placement
+from compactor.pid import PID
+from compactor.process import Process
+from compactor.testing import ephemeral_context
+
+import pytest
+
+
+pytestmark = pytest.mark.skipif(not hasattr(os, 'fork'), reason='requires os.fork')
+
+
+class EchoProcess(Process):
+  @Process.install('ping')
+  def ping(self, from_pid, body):
+    self.send(from_pid, 'pong', body)
+
+
+class RelayProcess(Process):
+  def __init__(self, name, to):
+    self.to = to
+    super(RelayProcess, self).__init__(name)
+
+  @Process.install('relay')
+  def relay(self, from_pid, body):
+    self.reply_to = from_pid
+    self.send(self.to, 'ping', body)
+
+  @Process.install('pong')
+  def pong(self, from_pid, body):
+    self.send(self.reply_to, 'pong', body)
+
+
+class CollectorProcess(Process):
+  def __init__(self, name, expected):
+    self.expected = expected
+    self.received = set()
+    self.done = threading.Event()
+    super(CollectorProcess, self).__init__(name)
+
+  @Process.install('pong')
+  def pong(self, from_pid, body):
+    self.received.add(body)
+    if len(self.received) == self.expected:
+      self.done.set()
+
+
+def test_placement():
+  assert place('echo(1)', 1) == 0
+  assert place('echo(1)', 4) == place('echo(1)', 4)
+  assert set(place('echo(%d)' % k, 2) for k in range(16)) == set([0, 1])
+
+  endpoints = [('127.0.0.1', 1), ('127.0.0.1', 2)]
+  placements = [Placement(index, endpoints) for index in range(2)]
+  for name in ('echo(%d)' % k for k in range(8)):
+    owners = [placement for placement in placements if placement.owns(name)]
+    assert len(owners) == 1
+    assert placements[0].forward_endpoint(name) == endpoints[owners[0].index]
+
+
+@pytest.mark.parametrize('reuse_port', [False, True])
+def test_cluster_delivery(reuse_port):
+  if reuse_port and not ContextCluster.supports_reuse_port():
+    pytest.skip('SO_REUSEPORT is not supported')
+
+  cluster = ContextCluster(workers=2, reuse_port=reuse_port)
+  echoes = [cluster.spawn(EchoProcess('echo(%d)' % k)) for k in range(8)]
+  assert set(cluster.worker_for(pid) for pid in echoes) == set([0, 1])
+  assert all(pid == PID(cluster.ip, cluster.port, pid.id) for pid in echoes)
+
+  # relays reach echoes placed on the other worker through its forwarding endpoint
+  relays = [cluster.spawn(RelayProcess('relay(%d)' % k, echo)) for k, echo in enumerate(echoes)]
+
+  cluster.start()
+  try:
+    with ephemeral_context() as context:
+      collector = CollectorProcess('collector', 2 * len(echoes))
+      context.spawn(collector)
+      for k, pid in enumerate(echoes):
+        collector.send(pid, 'ping', ('echo %d' % k).encode('utf8'))
+      for k, pid in enumerate(relays):
+        collector.send(pid, 'relay', ('relay %d' % k).encode('utf8'))
+
+      collector.done.wait(timeout=10)
+      assert collector.done.is_set()
+  finally:
+    cluster.stop()
+
+
+def test_cluster_spawn_after_start():
+  cluster = ContextCluster(workers=1)
+  cluster.spawn(EchoProcess('echo'))
+  with pytest.raises(ContextCluster.InvalidProcess):
+    cluster.spawn(EchoProcess('echo'))
+  cluster.start()
+  try:
+    with pytest.raises(ContextCluster.Error):
+      cluster.spawn(EchoProcess('other'))
+  finally:
+    cluster.stop()
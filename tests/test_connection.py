@@ -0,0 +1,487 @@
+import socket
+import threading
+import time
+from collections import deque
+
+from compactor.connection import (
+    Backoff,
+    ConnectionPool,
+    iter_batches,
+    join_requests,
+    Outbox,
+    QueueLimits,
+)
+from compactor.context import Context
+from compactor.pid import PID
+from compactor.process import Process
+from compactor.testing import ephemeral_context
+
+import pytest
+
+
+class CountingProcess(Process):
+  def __init__(self, name, expected):
+    self.expected = expected
+    self.received = []
+    self.done = threading.Event()
+    super(CountingProcess, self).__init__(name)
+
+  @Process.install('count')
+  def count(self, from_pid, body):
+    self.received.append(body)
+    if len(self.received) == self.expected:
+      self.done.set()
+
+
+class SenderProcess(Process):
+  pass
+
+
+def test_pids_on_one_endpoint_share_a_connection():
+  with ephemeral_context() as receiver_context:
+    with ephemeral_context() as sender_context:
+      receivers = [CountingProcess('receiver(%d)' % k, 2) for k in range(3)]
+      for receiver in receivers:
+        receiver_context.spawn(receiver)
+
+      sender = SenderProcess('sender')
+      sender_context.spawn(sender)
+
+      for k in range(2):
+        for receiver in receivers:
+          sender.send(receiver.pid, 'count', b'hello')
+
+      for receiver in receivers:
+        receiver.done.wait(timeout=5)
+        assert receiver.done.is_set()
+
+      endpoint = (receiver_context.ip, receiver_context.port)
+      connections = sender_context._connections.connections(endpoint)
+      assert len(connections) == 1
+      assert connections[0].pids == set(receiver.pid for receiver in receivers)
+
+
+def test_max_connections_per_endpoint():
+  with ephemeral_context() as receiver_context:
+    with ephemeral_context(max_connections_per_endpoint=2,
+                           connection_selection=ConnectionPool.LEAST_LOADED) as sender_context:
+      receivers = [CountingProcess('receiver(%d)' % k, 1) for k in range(4)]
+      for receiver in receivers:
+        receiver_context.spawn(receiver)
+
+      sender = SenderProcess('sender')
+      sender_context.spawn(sender)
+
+      for receiver in receivers:
+        sender.send(receiver.pid, 'count', b'hello')
+
+      for receiver in receivers:
+        receiver.done.wait(timeout=5)
+        assert receiver.done.is_set()
+
+      endpoint = (receiver_context.ip, receiver_context.port)
+      assert 1 <= len(sender_context._connections.connections(endpoint)) <= 2
+
+
+def test_invalid_pool_configuration():
+  with pytest.raises(ValueError):
+    ConnectionPool(None, None, max_per_endpoint=0)
+  with pytest.raises(ValueError):
+    ConnectionPool(None, None, selection='random')
+  with pytest.raises(ValueError):
+    ConnectionPool(None, None, max_connections=0)
+  with pytest.raises(ValueError):
+    ConnectionPool(None, None, idle_timeout=0)
+  with pytest.raises(ValueError):
+    ConnectionPool(None, None, heartbeat_interval=0)
+  with pytest.raises(ValueError):
+    ConnectionPool(None, None, heartbeat_misses=0)
+
+
+class BurstProcess(Process):
+  def __init__(self, name, to, count):
+    self.to = to
+    self.count = count
+    super(BurstProcess, self).__init__(name)
+
+  @Process.install('burst')
+  def burst(self, from_pid, body):
+    for k in range(self.count):
+      self.send(self.to, 'count', b'hello')
+
+
+def test_sends_in_one_iteration_are_coalesced():
+  with ephemeral_context() as receiver_context:
+    with ephemeral_context() as sender_context:
+      receiver = CountingProcess('receiver', 10)
+      receiver_context.spawn(receiver)
+
+      burster = BurstProcess('burster', receiver.pid, 10)
+      sender_context.spawn(burster)
+      sender_context.dispatch(burster.pid, 'burst', burster.pid, b'')
+
+      receiver.done.wait(timeout=5)
+      assert receiver.done.is_set()
+
+      snapshot = sender_context.metrics.snapshot()
+      assert snapshot['connections/messages_per_flush/sum'] == 10
+      assert snapshot['connections/messages_per_flush/max'] == 10
+      assert snapshot['connections/flushes'] == 1
+
+
+def test_iter_batches():
+  requests = [b'a' * 4, b'b' * 4, b'c' * 10, b'd', b'e', b'f']
+  batches = list(iter_batches(requests, max_bytes=8, max_messages=2))
+  assert batches == [[b'a' * 4, b'b' * 4], [b'c' * 10], [b'd', b'e'], [b'f']]
+
+
+def test_segmented_requests():
+  requests = [(b'aa', b'bb'), b'cccc', [b'd', b'e']]
+  batches = list(iter_batches(requests, max_bytes=8, max_messages=8))
+  assert batches == [[(b'aa', b'bb'), b'cccc'], [[b'd', b'e']]]
+  assert join_requests(batches[0]) == b'aabbcccc'
+
+  outbox = Outbox(('127.0.0.1', 1), QueueLimits(high_bytes=4, policy=QueueLimits.DROP_NEWEST))
+  outbox.put('pid', (b'11', b'22'))
+  assert outbox.depth == (1, 4)
+  outbox.put('pid', (b'3',))
+  assert outbox.dropped == 1
+
+
+def test_broadcast_is_coalesced():
+  with ephemeral_context() as receiver_context:
+    with ephemeral_context() as sender_context:
+      receivers = [CountingProcess('receiver(%d)' % k, 1) for k in range(5)]
+      for receiver in receivers:
+        receiver_context.spawn(receiver)
+      local_receiver = CountingProcess('local', 1)
+      sender_context.spawn(local_receiver)
+
+      sender = SenderProcess('sender')
+      sender_context.spawn(sender)
+      pids = [receiver.pid for receiver in receivers] + [local_receiver.pid]
+      sender_context.dispatch(sender.pid, 'broadcast', pids, 'count', b'hello')
+
+      for receiver in receivers + [local_receiver]:
+        receiver.done.wait(timeout=5)
+        assert receiver.done.is_set()
+        assert receiver.received == [b'hello']
+
+      snapshot = sender_context.metrics.snapshot()
+      assert snapshot['connections/messages_per_flush/sum'] == 5
+      assert snapshot['connections/flushes'] == 1
+
+
+def test_large_bodies_are_delivered_intact():
+  with ephemeral_context() as receiver_context:
+    with ephemeral_context() as sender_context:
+      receiver = CountingProcess('receiver', 3)
+      receiver_context.spawn(receiver)
+      sender = SenderProcess('sender')
+      sender_context.spawn(sender)
+
+      bodies = [bytes(bytearray(k % 256 for k in range(size))) for size in (10, 100000, 1000000)]
+      for body in bodies:
+        sender.send(receiver.pid, 'count', body)
+
+      receiver.done.wait(timeout=10)
+      assert receiver.received == bodies
+
+
+def test_outbox_drop_newest():
+  outbox = Outbox(('127.0.0.1', 1), QueueLimits(
+      high_messages=2, low_messages=0, policy=QueueLimits.DROP_NEWEST))
+  assert outbox.put('pid', b'1') == (0, True)
+  assert outbox.put('pid', b'2') == (0, False)
+  assert outbox.put('pid', b'3') == (1, False)
+  assert outbox.dropped == 1
+  assert outbox.congested
+  assert [data for _, data, _ in outbox.take()] == [b'1', b'2']
+  assert outbox.depth == (2, 2)
+
+  # the outbox stays congested until it falls to the low watermark
+  outbox.release(1, 1)
+  assert outbox.congested
+  outbox.release(1, 1)
+  assert not outbox.congested
+  assert outbox.depth == (0, 0)
+
+
+def test_outbox_drop_oldest():
+  outbox = Outbox(('127.0.0.1', 1), QueueLimits(high_bytes=4, policy=QueueLimits.DROP_OLDEST))
+  for data in (b'11', b'22', b'33'):
+    outbox.put('pid', data)
+  assert outbox.dropped == 1
+  assert [data for _, data, _ in outbox.take()] == [b'22', b'33']
+  assert outbox.depth == (2, 4)
+
+  # taken messages are in flight and cannot be dropped, so the newest is dropped instead
+  outbox.put('pid', b'44')
+  assert outbox.dropped == 2
+  assert outbox.take() == deque()
+
+
+def test_outbox_raise_and_block():
+  outbox = Outbox(('127.0.0.1', 1), QueueLimits(high_messages=1, policy=QueueLimits.RAISE))
+  outbox.put('pid', b'1')
+  with pytest.raises(Outbox.QueueFull):
+    outbox.put('pid', b'2')
+
+  outbox = Outbox(('127.0.0.1', 1), QueueLimits(
+      high_messages=1, policy=QueueLimits.BLOCK, block_timeout=0.01))
+  outbox.put('pid', b'1')
+  with pytest.raises(Outbox.QueueFull):
+    outbox.put('pid', b'2', block=False)
+  with pytest.raises(Outbox.QueueFull):
+    outbox.put('pid', b'2')
+
+  outbox.limits.block_timeout = None
+  timer = threading.Timer(0.05, outbox.release, args=(1, 1))
+  timer.start()
+  outbox.put('pid', b'2')
+  timer.join()
+  assert outbox.depth == (1, 1)
+
+
+def test_queue_depth_and_limits():
+  limits = QueueLimits(high_messages=2, policy=QueueLimits.RAISE)
+  with ephemeral_context(queue_limits=limits) as context:
+    sender = SenderProcess('sender')
+    context.spawn(sender)
+
+    # nothing listens on this endpoint, so messages stay queued until the connect fails
+    unreachable = PID('127.0.0.1', 1, 'nobody')
+    sender.send(unreachable, 'count')
+    sender.send(unreachable, 'count')
+    assert context.queue_depth(unreachable)[0] <= 2
+    assert set(context.queue_depths()) == set([('127.0.0.1', 1)])
+
+
+@pytest.mark.parametrize('policy', [QueueLimits.BLOCK, QueueLimits.RAISE])
+def test_broadcast_with_queue_limits(policy):
+  limits = QueueLimits(high_messages=2, policy=policy, block_timeout=5)
+  with ephemeral_context() as receiver_context:
+    with ephemeral_context(queue_limits=limits) as sender_context:
+      receivers = [CountingProcess('receiver(%d)' % k, 1) for k in range(5)]
+      late = CountingProcess('late', 1)
+      for receiver in receivers + [late]:
+        receiver_context.spawn(receiver)
+      sender = SenderProcess('sender')
+      sender_context.spawn(sender)
+
+      pids = [receiver.pid for receiver in receivers]
+      if policy == QueueLimits.BLOCK:
+        # each full outbox is drained by a flush scheduled as its messages were queued
+        sender.broadcast(pids, 'count', b'hello')
+        for receiver in receivers:
+          receiver.done.wait(timeout=5)
+          assert receiver.done.is_set()
+      else:
+        try:
+          sender.broadcast(pids, 'count', b'hello')
+        except Context.QueueFull:
+          pass
+
+      # whatever was queued is flushed, so the endpoint accepts messages again
+      deadline = time.time() + 5
+      while sender_context.queue_depth(late.pid) != (0, 0) and time.time() < deadline:
+        time.sleep(0.01)
+      sender.send(late.pid, 'count', b'hello')
+      late.done.wait(timeout=5)
+      assert late.done.is_set()
+
+
+def test_backoff():
+  backoff = Backoff(initial_secs=1, max_secs=5, multiplier=2, jitter=0, max_failures=3)
+  assert [backoff.delay(failures) for failures in range(6)] == [0, 1, 2, 4, 5, 5]
+  assert not backoff.exhausted(2)
+  assert backoff.exhausted(3)
+  assert backoff.delay(10000) == 5
+
+  backoff = Backoff(initial_secs=1, jitter=0.5)
+  for _ in range(100):
+    assert 0.5 <= backoff.delay(1) <= 1
+
+  with pytest.raises(ValueError):
+    Backoff(initial_secs=2, max_secs=1)
+  with pytest.raises(ValueError):
+    Backoff(jitter=2)
+  with pytest.raises(ValueError):
+    Backoff(max_failures=0)
+
+
+def unused_port():
+  sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  sock.bind(('127.0.0.1', 0))
+  port = sock.getsockname()[1]
+  sock.close()
+  return port
+
+
+def test_outbox_survives_reconnects():
+  port = unused_port()
+  backoff = Backoff(initial_secs=0.05, max_secs=0.1, max_failures=None)
+  with ephemeral_context(reconnect_backoff=backoff) as sender_context:
+    sender = SenderProcess('sender')
+    sender_context.spawn(sender)
+
+    # the receiver is not yet listening, so these are held while the sender backs off
+    receiver_pid = PID('127.0.0.1', port, 'receiver')
+    for k in range(5):
+      sender.send(receiver_pid, 'count', str(k).encode('ascii'))
+
+    deadline = time.time() + 5
+    while not sender_context.metrics.snapshot()['connections/connect_failures']:
+      assert time.time() < deadline
+      time.sleep(0.01)
+    assert sender_context.queue_depth(receiver_pid)[0] == 5
+
+    with ephemeral_context(ip='127.0.0.1', port=port) as receiver_context:
+      receiver = CountingProcess('receiver', 5)
+      receiver_context.spawn(receiver)
+      receiver.done.wait(timeout=5)
+      assert receiver.received == [str(k).encode('ascii') for k in range(5)]
+
+    snapshot = sender_context.metrics.snapshot()
+    assert snapshot['connections/reconnects'] >= 1
+    assert snapshot['outbox/wait_time_secs/count'] == 5
+
+
+def test_outbox_discarded_after_max_failures():
+  backoff = Backoff(initial_secs=0.01, max_secs=0.01, max_failures=2)
+  with ephemeral_context(reconnect_backoff=backoff) as context:
+    sender = SenderProcess('sender')
+    context.spawn(sender)
+
+    unreachable = PID('127.0.0.1', unused_port(), 'nobody')
+    sender.send(unreachable, 'count')
+
+    deadline = time.time() + 5
+    while context.queue_depth(unreachable) != (0, 0):
+      assert time.time() < deadline
+      time.sleep(0.01)
+    snapshot = context.metrics.snapshot()
+    assert snapshot['connections/connect_failures'] == 2
+    assert snapshot['outbox/dropped_messages'] == 1
+
+
+def wait_for(predicate, timeout=5):
+  deadline = time.time() + timeout
+  while not predicate():
+    assert time.time() < deadline
+    time.sleep(0.01)
+
+
+class LinkingProcess(Process):
+  def __init__(self, name):
+    self.exits = []
+    super(LinkingProcess, self).__init__(name)
+
+  def exited(self, pid):
+    self.exits.append(pid)
+
+
+def test_idle_connections_are_evicted():
+  with ephemeral_context() as linked_context:
+    with ephemeral_context() as receiver_context:
+      with ephemeral_context(connection_idle_timeout=0.1) as sender_context:
+        linked = CountingProcess('linked', 1)
+        linked_context.spawn(linked)
+        receiver = CountingProcess('receiver', 2)
+        receiver_context.spawn(receiver)
+        sender = LinkingProcess('sender')
+        sender_context.spawn(sender)
+
+        sender.link(linked.pid)
+        sender.send(linked.pid, 'count')
+        sender.send(receiver.pid, 'count')
+        linked.done.wait(timeout=5)
+
+        pool = sender_context._connections
+        wait_for(lambda: sender_context.metrics.snapshot()['connections/evictions'] == 1)
+        assert pool.connections((receiver_context.ip, receiver_context.port)) == []
+        assert len(pool) == 1
+
+        # the linked connection is pinned, and eviction is not reported as an exit
+        assert len(pool.connections((linked_context.ip, linked_context.port))) == 1
+        assert sender.exits == []
+
+        sender.send(receiver.pid, 'count')
+        receiver.done.wait(timeout=5)
+        assert receiver.done.is_set()
+        assert sender_context.metrics.snapshot()['connections/reopens'] == 1
+
+
+def test_max_connections():
+  with ephemeral_context() as context1:
+    with ephemeral_context() as context2:
+      with ephemeral_context(max_connections=1) as sender_context:
+        receiver1 = CountingProcess('receiver', 1)
+        context1.spawn(receiver1)
+        receiver2 = CountingProcess('receiver', 1)
+        context2.spawn(receiver2)
+        sender = SenderProcess('sender')
+        sender_context.spawn(sender)
+
+        sender.send(receiver1.pid, 'count')
+        receiver1.done.wait(timeout=5)
+        wait_for(lambda: sender_context._connections.connections(
+            (context1.ip, context1.port))[0].idle)
+
+        sender.send(receiver2.pid, 'count')
+        receiver2.done.wait(timeout=5)
+        assert receiver2.done.is_set()
+        assert sender_context.metrics.snapshot()['connections/evictions'] == 1
+        wait_for(lambda: len(sender_context._connections) == 1)
+
+
+class ExitProcess(LinkingProcess):
+  def __init__(self, name):
+    self.exited_event = threading.Event()
+    super(ExitProcess, self).__init__(name)
+
+  def exited(self, pid):
+    super(ExitProcess, self).exited(pid)
+    self.exited_event.set()
+
+
+def test_heartbeats_keep_live_links():
+  with ephemeral_context(wire_protocol_fast_path=True) as fast_context:
+    with ephemeral_context() as tornado_context:
+      with ephemeral_context(heartbeat_interval=0.02, heartbeat_misses=2) as sender_context:
+        receivers = [CountingProcess('receiver', 1), CountingProcess('receiver', 1)]
+        fast_context.spawn(receivers[0])
+        tornado_context.spawn(receivers[1])
+        sender = ExitProcess('sender')
+        sender_context.spawn(sender)
+
+        for receiver in receivers:
+          sender.link(receiver.pid)
+        wait_for(lambda: sender_context.metrics.snapshot()['connections/heartbeats'] >= 20)
+        assert sender.exits == []
+        assert sender_context.metrics.snapshot()['connections/heartbeat_failures'] == 0
+
+        # heartbeats do not disturb messages on the same connections
+        for receiver in receivers:
+          sender.send(receiver.pid, 'count', b'hello')
+          receiver.done.wait(timeout=5)
+          assert receiver.received == [b'hello']
+
+
+def test_missed_heartbeats_exit_links():
+  # a peer that accepts connections but never answers, like one behind a partition
+  blackhole = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  blackhole.bind(('127.0.0.1', 0))
+  blackhole.listen(8)
+  try:
+    with ephemeral_context(heartbeat_interval=0.02, heartbeat_misses=2) as context:
+      sender = ExitProcess('sender')
+      context.spawn(sender)
+
+      unresponsive = PID('127.0.0.1', blackhole.getsockname()[1], 'unresponsive')
+      sender.link(unresponsive)
+      sender.exited_event.wait(timeout=5)
+      assert sender.exits == [unresponsive]
+      assert context.metrics.snapshot()['connections/heartbeat_failures'] == 1
+  finally:
+    blackhole.close()
@@ -0,0 +1,163 @@
+import asyncio
+import threading
+import time
+
+from compactor.process import Process
+from compactor.testing import ephemeral_context
+
+import pytest
+import requests
+
+
+class AsyncProcess(Process):
+  def __init__(self, name, expected=1):
+    self.expected = expected
+    self.received = []
+    self.running = 0
+    self.max_running = 0
+    self.release = None
+    self.done = threading.Event()
+    super(AsyncProcess, self).__init__(name)
+
+  @Process.install('ping')
+  async def ping(self, from_pid, body):
+    self.running += 1
+    self.max_running = max(self.max_running, self.running)
+    if self.release is None:
+      self.release = asyncio.Event()
+    if len(self.received) + self.running == self.expected:
+      self.release.set()
+    await self.release.wait()
+    self.running -= 1
+    self.received.append(body)
+    if len(self.received) == self.expected:
+      self.done.set()
+
+  @Process.route('/hello')
+  async def hello(self, handler):
+    await asyncio.sleep(0.01)
+    handler.write('hello')
+
+
+@pytest.mark.parametrize('fast_path', [False, True])
+def test_coroutine_mailbox_remote(fast_path):
+  with ephemeral_context(wire_protocol_fast_path=fast_path) as context:
+    with ephemeral_context() as sender_context:
+      receiver = AsyncProcess('receiver', expected=3)
+      context.spawn(receiver)
+      sender = Process('sender')
+      sender_context.spawn(sender)
+
+      for k in range(3):
+        sender.send(receiver.pid, 'ping', str(k).encode('ascii'))
+
+      receiver.done.wait(timeout=5)
+      assert sorted(receiver.received) == [b'0', b'1', b'2']
+      # all three ran concurrently, since each waited for the others to arrive
+      assert receiver.max_running == 3
+
+
+def test_coroutine_mailbox_local():
+  with ephemeral_context() as context:
+    receiver = AsyncProcess('receiver')
+    context.spawn(receiver)
+    sender = Process('sender')
+    context.spawn(sender)
+
+    sender.send(receiver.pid, 'ping', b'local')
+    receiver.done.wait(timeout=5)
+    assert receiver.received == [b'local']
+
+    # the coroutine completes just after it signals
+    deadline = time.time() + 5
+    while context.metrics.snapshot()['coroutines/in_flight'] and time.time() < deadline:
+      time.sleep(0.01)
+    assert context.metrics.snapshot()['coroutines/in_flight'] == 0
+
+
+class SleepyProcess(Process):
+  def __init__(self, name, expected):
+    self.expected = expected
+    self.received = 0
+    self.running = 0
+    self.max_running = 0
+    self.done = threading.Event()
+    super(SleepyProcess, self).__init__(name)
+
+  @Process.install('sleep')
+  async def sleep(self, from_pid, body):
+    self.running += 1
+    self.max_running = max(self.max_running, self.running)
+    await asyncio.sleep(0.01)
+    self.running -= 1
+    self.received += 1
+    if self.received == self.expected:
+      self.done.set()
+
+
+def test_coroutine_cap():
+  with ephemeral_context(max_coroutines_per_process=2) as context:
+    receiver = SleepyProcess('receiver', expected=5)
+    context.spawn(receiver)
+    sender = Process('sender')
+    context.spawn(sender)
+
+    for k in range(5):
+      sender.send(receiver.pid, 'sleep')
+
+    receiver.done.wait(timeout=5)
+    assert receiver.received == 5
+    assert receiver.max_running == 2
+
+
+def test_coroutine_route():
+  with ephemeral_context() as context:
+    process = AsyncProcess('web')
+    context.spawn(process)
+    response = requests.get('http://%s:%d/web/hello' % (context.ip, context.port))
+    assert response.status_code == 200
+    assert response.text == 'hello'
+
+
+class StuckProcess(Process):
+  def __init__(self, name):
+    self.started = []
+    self.cancelled = threading.Event()
+    super(StuckProcess, self).__init__(name)
+
+  @Process.install('stuck')
+  async def stuck(self, from_pid, body):
+    self.started.append(body)
+    try:
+      await asyncio.Event().wait()
+    except asyncio.CancelledError:
+      self.cancelled.set()
+      raise
+
+
+def test_terminate_cancels_coroutines():
+  with ephemeral_context(max_coroutines_per_process=1) as context:
+    process = StuckProcess('stuck')
+    pid = context.spawn(process)
+    sender = Process('sender')
+    context.spawn(sender)
+
+    for k in range(4):
+      sender.send(pid, 'stuck', str(k).encode('ascii'))
+
+    deadline = time.time() + 5
+    while context.metrics.snapshot()['coroutines/queued'] < 3 and time.time() < deadline:
+      time.sleep(0.01)
+    assert process.started == [b'0']
+
+    context.terminate(pid)
+    process.cancelled.wait(timeout=5)
+    assert process.cancelled.is_set()
+
+    # no queued coroutine is started once the process is terminated
+    deadline = time.time() + 5
+    while context.metrics.snapshot()['coroutines/in_flight'] and time.time() < deadline:
+      time.sleep(0.01)
+    snapshot = context.metrics.snapshot()
+    assert (snapshot['coroutines/in_flight'], snapshot['coroutines/queued']) == (0, 0)
+    assert process.started == [b'0']
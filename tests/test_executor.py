@@ -0,0 +1,196 @@
+import pickle
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from compactor.executor import ComputePool, LoopExecutor, register
+from compactor.process import Process
+from compactor.testing import ephemeral_context
+
+import pytest
+from tornado.ioloop import IOLoop
+
+
+def square(value):
+  return value * value
+
+
+def fail(value):
+  raise ValueError(value)
+
+
+class SumProcess(Process):
+  def __init__(self, name):
+    self.results = []
+    self.done = threading.Event()
+    super(SumProcess, self).__init__(name)
+
+  @Process.install('sum')
+  @Process.cpu_bound('summed')
+  def add_up(from_pid, body):
+    return sum(range(int(body)))
+
+  def summed(self, from_pid, result):
+    self.results.append((from_pid, result))
+    self.done.set()
+
+
+def test_registered_functions_pickle_by_name():
+  target = register(square)
+  assert pickle.loads(pickle.dumps(target))(3) == 9
+
+
+def test_register_rejects_conflicting_names():
+  def first(value):
+    return value
+
+  def second(value):
+    return -value
+
+  # as on Python 2, where methods of different classes are only known by their names
+  first.__qualname__ = second.__qualname__ = 'conflicting'
+  assert register(first)(1) == register(first)(1) == 1
+  with pytest.raises(ValueError):
+    register(second)
+
+  # functions defined again by the same code are registered again
+  for k in range(2):
+    def redefined(value, k=k):
+      return value + k
+    assert register(redefined)(1) == 1 + k
+
+
+def test_cpu_bound_handler():
+  with ephemeral_context(compute_workers=1) as context:
+    process = SumProcess('summer')
+    context.spawn(process)
+    context.dispatch(process.pid, 'add_up', process.pid, b'1000')
+
+    process.done.wait(timeout=10)
+    assert process.results == [(process.pid, sum(range(1000)))]
+
+    snapshot = context.metrics.snapshot()
+    assert snapshot['compute/execution_time_secs/count'] == 1
+    assert snapshot['compute/queue_depth'] == 0
+
+
+def test_compute():
+  with ephemeral_context(compute_workers=1) as context:
+    process = Process('computer')
+    context.spawn(process)
+
+    results = []
+    done = threading.Event()
+
+    def on_done(future):
+      try:
+        results.append(future.result())
+      except ValueError as e:
+        results.append(e)
+      done.set()
+
+    process.compute(square, 7).add_done_callback(on_done)
+    done.wait(timeout=10)
+    assert results == [49]
+
+    done.clear()
+    process.compute(fail, 'oops').add_done_callback(on_done)
+    done.wait(timeout=10)
+    assert isinstance(results[1], ValueError)
+    assert context.metrics.snapshot()['compute/failures'] == 1
+
+
+def test_executor_factory():
+  created = []
+
+  def factory(max_workers):
+    created.append(max_workers)
+    return ThreadPoolExecutor(max_workers=max_workers)
+
+  loop = IOLoop()
+  thread = threading.Thread(target=loop.start)
+  thread.start()
+  try:
+    pool = LoopExecutor(loop, factory, max_workers=2)
+    assert created == []
+    results = []
+    done = threading.Event()
+
+    def on_done(future):
+      results.append(future.result())
+      done.set()
+
+    pool.submit(square, 3).add_done_callback(on_done)
+    done.wait(timeout=10)
+    assert results == [9]
+    assert created == [2]
+    pool.shutdown()
+  finally:
+    loop.add_callback(loop.stop)
+    thread.join()
+    loop.close()
+
+
+def test_invalid_pool_configuration():
+  with pytest.raises(ValueError):
+    ComputePool(None, max_workers=0)
+
+
+class StoreProcess(Process):
+  def __init__(self, name):
+    self.fetched = []
+    self.done = threading.Event()
+    super(StoreProcess, self).__init__(name)
+
+  @Process.install('fetch')
+  @Process.blocking('on_fetch')
+  def fetch(self, from_pid, body):
+    # later messages finish first, but must still be continued in order
+    time.sleep(0.05 * (3 - int(body)))
+    return int(body)
+
+  def on_fetch(self, from_pid, value):
+    self.fetched.append(value)
+    if len(self.fetched) == 3:
+      self.done.set()
+
+
+def test_blocking_handlers_continue_in_order():
+  with ephemeral_context(blocking_workers=3) as context:
+    process = StoreProcess('store')
+    context.spawn(process)
+    for k in range(3):
+      process.send(process.pid, 'fetch', str(k).encode('ascii'))
+
+    process.done.wait(timeout=10)
+    assert process.fetched == [0, 1, 2]
+    assert context.metrics.snapshot()['blocking/execution_time_secs/count'] == 3
+
+
+class PingProcess(Process):
+  def __init__(self, name):
+    self.pinged = threading.Event()
+    super(PingProcess, self).__init__(name)
+
+  @Process.install('ping')
+  def ping(self, from_pid, body):
+    self.pinged.set()
+
+
+def test_defer_does_not_block_the_loop():
+  with ephemeral_context() as context:
+    process = PingProcess('pinger')
+    context.spawn(process)
+
+    released, done = threading.Event(), threading.Event()
+    process.defer(released.wait, 10).add_done_callback(lambda future: done.set())
+
+    # messages are still delivered while the deferred call blocks
+    process.send(process.pid, 'ping')
+    process.pinged.wait(timeout=5)
+    assert process.pinged.is_set()
+    assert not done.is_set()
+
+    released.set()
+    done.wait(timeout=5)
+    assert done.is_set()
@@ -194,6 +194,36 @@ class TestHttpd(EphemeralContextTestCase):
     response = requests.get(url)
     assert response.status_code == 404
 
+  def test_pattern_route(self):
+    class TaskProcess(Process):
+      @Process.route('/tasks/([0-9]+)')
+      def task(self, handler, task_id):
+        handler.write('task %s' % task_id)
+
+    pid = self.context.spawn(TaskProcess('tasks(1)'))
+    other_pid = self.context.spawn(TaskProcess('tasks(2)'))
+
+    # only the patterns of the process named by the path are candidates
+    router = self.context.http.router
+    assert len(router.find('/tasks(1)/tasks/42')) == 2
+    assert len(router.find('/missing/tasks/42')) == 1
+
+    url = 'http://%s:%s/tasks(1)/tasks/42' % (pid.ip, pid.port)
+    response = requests.get(url)
+    assert response.status_code == 200
+    assert response.text == 'task 42'
+
+    url = 'http://%s:%s/tasks(1)/tasks/forty-two' % (pid.ip, pid.port)
+    assert requests.get(url).status_code == 404
+
+    self.context.terminate(pid)
+    url = 'http://%s:%s/tasks(1)/tasks/42' % (pid.ip, pid.port)
+    assert requests.get(url).status_code == 404
+    assert len(router.find('/tasks(1)/tasks/42')) == 1
+
+    url = 'http://%s:%s/tasks(2)/tasks/42' % (other_pid.ip, other_pid.port)
+    assert requests.get(url).text == 'task 42'
+
   def test_async_route(self):
     web = Web('web')
     pid = self.context.spawn(web)
@@ -272,6 +302,65 @@ class TestHttpd(EphemeralContextTestCase):
     child.exit_event.wait(timeout=1)
     assert child.exit_event.is_set()
 
+  def test_metrics_snapshot(self):
+    class EchoProcess(Process):
+      def __init__(self, name):
+        self.event = threading.Event()
+        super(EchoProcess, self).__init__(name)
+
+      @Process.install('echo')
+      def echo(self, from_pid, body):
+        self.event.set()
+
+      @Process.install('ping')
+      def ping(self, from_pid, body):
+        pass
+
+    receiver = EchoProcess('receiver')
+    self.context.spawn(receiver)
+    local_sender = Process('local_sender')
+    self.context.spawn(local_sender)
+
+    # the mailbox handles ping before echo sets the event
+    local_sender.send(receiver.pid, 'ping')
+    local_sender.send(receiver.pid, 'echo', b'local')
+    receiver.event.wait(timeout=5)
+    assert receiver.event.is_set()
+    receiver.event.clear()
+
+    with ephemeral_context() as remote_context:
+      remote_sender = Process('remote_sender')
+      remote_context.spawn(remote_sender)
+      remote_sender.send(receiver.pid, 'echo', b'remote')
+      receiver.event.wait(timeout=5)
+      assert receiver.event.is_set()
+
+      remote_snapshot = remote_context.metrics.snapshot()
+      assert remote_snapshot['messages/remote'] == 1
+      assert remote_snapshot['remote_sender/messages/echo/sent'] == 1
+      assert remote_snapshot['bytes/sent'] > len(b'remote')
+
+    url = 'http://%s:%s/metrics/snapshot' % (self.context.ip, self.context.port)
+    response = requests.get(url)
+    assert response.status_code == 200
+    assert response.headers['Content-Type'] == 'application/json'
+    snapshot = response.json()
+    assert snapshot['messages/local'] == 2
+    assert snapshot['messages/received'] == 1
+    assert snapshot['bytes/received'] == len(b'remote')
+    assert snapshot['local_sender/messages/echo/sent'] == 1
+    assert snapshot['local_sender/messages/ping/sent'] == 1
+    assert snapshot['receiver/messages/echo/received'] == 2
+    assert snapshot['receiver/messages/ping/received'] == 1
+    assert snapshot['receiver/mailbox/echo/handler_time_secs/count'] == 2
+    assert snapshot['receiver/mailbox/ping/handler_time_secs/count'] == 1
+    assert snapshot['processes'] == 2
+    assert snapshot['connections/open'] == 0
+
+    self.context.terminate(receiver.pid)
+    snapshot = requests.get(url).json()
+    assert not any(name.startswith('receiver/') for name in snapshot)
+
   def test_link_exit_local(self):
     parent = ParentProcess()
     self.context.spawn(parent)
@@ -287,3 +376,43 @@ class TestHttpd(EphemeralContextTestCase):
     self.context.terminate(parent.pid)
     child.exit_event.wait(timeout=1)
     assert child.exit_event.is_set()
+
+
+class TestHttpdFastPath(TestHttpd):
+  def setUp(self):
+    self.context = Context(wire_protocol_fast_path=True)
+    self.context.start()
+
+  def test_fallback_on_same_connection(self):
+    ping = PingPongProcess()
+    pid = self.context.spawn(ping)
+
+    class Receiver(Process):
+      def __init__(self):
+        self.bodies = []
+        self.event = threading.Event()
+        super(Receiver, self).__init__('receiver')
+
+      @Process.install('ping')
+      def ping(self, from_pid, body):
+        self.bodies.append(body)
+        self.event.set()
+
+    receiver = Receiver()
+    self.context.spawn(receiver)
+
+    session = requests.Session()
+    url = 'http://%s:%s/receiver/ping' % (pid.ip, pid.port)
+    response = session.post(url, data=b'hello', headers={'Libprocess-From': str(pid)})
+    assert response.status_code == 202
+    receiver.event.wait(timeout=1)
+    assert receiver.bodies == [b'hello']
+
+    # a non-message request on the same connection is served by tornado
+    url = 'http://%s:%s/pingpong/ping' % (pid.ip, pid.port)
+    assert session.get(url).text == 'pong'
+
+    # a message without a sender is not delivered
+    url = 'http://%s:%s/receiver/ping' % (pid.ip, pid.port)
+    assert requests.post(url, data=b'anonymous').status_code == 404
+    assert receiver.bodies == [b'hello']
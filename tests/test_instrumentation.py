@@ -0,0 +1,148 @@
+import io
+import os
+import signal
+import threading
+import time
+
+from compactor.instrumentation import FlightRecorder, Instrument
+from compactor.pid import PID
+from compactor.process import Process
+from compactor.testing import ephemeral_context
+
+import pytest
+import requests
+
+
+class RecordingInstrument(Instrument):
+  def __init__(self):
+    self.events = []
+
+  def on_send(self, from_pid, to_pid, method, size):
+    self.events.append(('send', from_pid.id, to_pid.id, method, size))
+
+  def on_deliver(self, pid, name, from_pid, size):
+    self.events.append(('deliver', from_pid.id, pid.id, name, size))
+
+  def on_handler_start(self, pid, handler, started):
+    self.events.append(('start', pid.id, handler.__name__))
+
+  def on_handler_end(self, pid, handler, elapsed):
+    self.events.append(('end', pid.id, handler.__name__))
+
+  def on_connect(self, endpoint):
+    self.events.append(('connect', endpoint))
+
+  def on_disconnect(self, endpoint, reason):
+    self.events.append(('disconnect', endpoint, reason))
+
+
+class EchoProcess(Process):
+  def __init__(self, name):
+    self.event = threading.Event()
+    super(EchoProcess, self).__init__(name)
+
+  @Process.install('echo')
+  def echo(self, from_pid, body):
+    self.event.set()
+
+
+def wait_for(predicate, timeout=5):
+  deadline = time.time() + timeout
+  while not predicate() and time.time() < deadline:
+    time.sleep(0.01)
+  return predicate()
+
+
+def test_instrument_events():
+  instrument = RecordingInstrument()
+  with ephemeral_context(instruments=[instrument], connection_idle_timeout=0.1) as context:
+    receiver = EchoProcess('receiver')
+    context.spawn(receiver)
+    sender = Process('sender')
+    context.spawn(sender)
+
+    sender.send(receiver.pid, 'echo', b'body')
+    receiver.event.wait(timeout=5)
+    assert wait_for(lambda: ('end', 'receiver', 'echo') in instrument.events)
+    assert instrument.events == [
+      ('send', 'sender', 'receiver', 'echo', 4),
+      ('deliver', 'sender', 'receiver', 'echo', 4),
+      ('start', 'receiver', 'echo'),
+      ('end', 'receiver', 'echo'),
+    ]
+
+    with ephemeral_context() as remote_context:
+      remote = EchoProcess('remote')
+      remote_context.spawn(remote)
+      del instrument.events[:]
+      sender.send(remote.pid, 'echo', b'body')
+      remote.event.wait(timeout=5)
+
+      endpoint = (remote_context.ip, remote_context.port)
+      assert wait_for(lambda: instrument.events[-1][0] == 'disconnect')
+      assert instrument.events[0][:4] == ('send', 'sender', 'remote', 'echo')
+      assert instrument.events[0][4] > 4
+      assert instrument.events[1] == ('connect', endpoint)
+      assert instrument.events[2][:2] == ('disconnect', endpoint)
+
+    context.remove_instrument(instrument)
+    del instrument.events[:]
+    receiver.event.clear()
+    sender.send(receiver.pid, 'echo')
+    receiver.event.wait(timeout=5)
+    assert instrument.events == []
+
+
+def test_flight_recorder():
+  recorder = FlightRecorder(size=2)
+  sender, receiver = PID('127.0.0.1', 1, 'sender'), PID('127.0.0.1', 1, 'receiver')
+  recorder.on_connect(('127.0.0.1', 1))
+  recorder.on_send(sender, receiver, 'echo', 4)
+  recorder.on_deliver(receiver, 'echo', sender, 4)
+  assert len(recorder) == 2
+
+  events = recorder.dump()
+  assert [event['event'] for event in events] == ['send', 'deliver']
+  assert events[0]['from'] == str(sender)
+  assert events[0]['to'] == str(receiver)
+  assert events[1]['method'] == 'echo'
+  assert events[1]['size'] == 4
+
+  with pytest.raises(ValueError):
+    FlightRecorder(size=0)
+
+
+def test_flight_recorder_endpoint():
+  with ephemeral_context(flight_recorder_size=16) as context:
+    receiver = EchoProcess('receiver')
+    context.spawn(receiver)
+    sender = Process('sender')
+    context.spawn(sender)
+    sender.send(receiver.pid, 'echo')
+    receiver.event.wait(timeout=5)
+    assert wait_for(lambda: len(context.flight_recorder) == 3)
+
+    url = 'http://%s:%s/flight_recorder/dump' % (context.ip, context.port)
+    events = requests.get(url).json()
+    assert [event['event'] for event in events] == ['send', 'deliver', 'handled']
+    assert events[2]['handler'] == 'echo'
+    assert events[2]['pid'] == str(receiver.pid)
+
+  with ephemeral_context() as context:
+    url = 'http://%s:%s/flight_recorder/dump' % (context.ip, context.port)
+    assert requests.get(url).status_code == 404
+
+
+@pytest.mark.skipif(not hasattr(signal, 'SIGUSR2'), reason='SIGUSR2 is not available.')
+def test_flight_recorder_dump_on_signal():
+  recorder = FlightRecorder()
+  recorder.on_connect(('127.0.0.1', 1))
+  stream = io.StringIO()
+  previous = signal.getsignal(signal.SIGUSR2)
+  try:
+    recorder.dump_on_signal(signal.SIGUSR2, stream=stream)
+    os.kill(os.getpid(), signal.SIGUSR2)
+    assert wait_for(lambda: stream.getvalue())
+  finally:
+    signal.signal(signal.SIGUSR2, previous)
+  assert 'connect endpoint=127.0.0.1:1' in stream.getvalue()
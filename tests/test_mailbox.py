@@ -0,0 +1,203 @@
+import threading
+
+from compactor.mailbox import Priority, Scheduler
+from compactor.metrics import Metrics
+from compactor.pid import PID
+from compactor.process import Process
+from compactor.testing import ephemeral_context
+
+import pytest
+
+
+class FakeLoop(object):
+  def __init__(self):
+    self.callbacks = []
+
+  def add_callback(self, callback, *args):
+    self.callbacks.append((callback, args))
+
+  def run_once(self):
+    callbacks, self.callbacks = self.callbacks, []
+    for callback, args in callbacks:
+      callback(*args)
+
+
+NOISY = PID('127.0.0.1', 1, 'noisy')
+QUIET = PID('127.0.0.1', 1, 'quiet')
+
+
+def test_round_robin_budget():
+  loop = FakeLoop()
+  scheduler = Scheduler(loop, budget=4)
+  scheduler.add(NOISY)
+  scheduler.add(QUIET)
+
+  handled = []
+  for k in range(20):
+    scheduler.deliver(NOISY, handled.append, 'noisy')
+  scheduler.deliver(QUIET, handled.append, 'quiet')
+  assert scheduler.depth(NOISY) == 20
+  assert len(loop.callbacks) == 1
+
+  # the quiet process is serviced after a single turn of the noisy one
+  loop.run_once()
+  assert handled == ['noisy'] * 4 + ['quiet']
+  assert scheduler.depth(NOISY) == 16
+
+  while loop.callbacks:
+    loop.run_once()
+  assert handled.count('noisy') == 20
+
+
+def test_weighted_budget():
+  loop = FakeLoop()
+  scheduler = Scheduler(loop, policy=Scheduler.WEIGHTED, budget=2)
+  scheduler.add(NOISY, weight=3)
+  scheduler.add(QUIET)
+
+  handled = []
+  for k in range(10):
+    scheduler.deliver(QUIET, handled.append, 'quiet')
+    scheduler.deliver(NOISY, handled.append, 'noisy')
+
+  loop.run_once()
+  assert handled == ['quiet'] * 2 + ['noisy'] * 6
+
+
+def test_removed_mailbox_discards_messages():
+  loop = FakeLoop()
+  metrics = Metrics()
+  scheduler = Scheduler(loop, metrics=metrics)
+  scheduler.add(QUIET)
+
+  handled = []
+  scheduler.deliver(QUIET, handled.append, 'quiet')
+  assert metrics.snapshot()['quiet/mailbox/depth'] == 1
+  scheduler.remove(QUIET)
+  assert not scheduler.deliver(QUIET, handled.append, 'quiet')
+  loop.run_once()
+  assert handled == []
+  assert 'quiet/mailbox/depth' not in metrics.snapshot()
+
+
+def test_invalid_scheduler_configuration():
+  with pytest.raises(ValueError):
+    Scheduler(None, policy='lottery')
+  with pytest.raises(ValueError):
+    Scheduler(None, budget=0)
+  with pytest.raises(ValueError):
+    Scheduler(None).add(QUIET, weight=0)
+  with pytest.raises(ValueError):
+    Scheduler(None, starvation_limit=0)
+
+
+def test_priorities():
+  loop = FakeLoop()
+  scheduler = Scheduler(loop, budget=1)
+  scheduler.add(NOISY)
+  scheduler.add(QUIET)
+
+  handled = []
+  scheduler.deliver(NOISY, handled.append, 'low', priority=Priority.LOW)
+  scheduler.deliver(NOISY, handled.append, 'normal')
+  scheduler.deliver(QUIET, handled.append, 'high', priority=Priority.HIGH)
+  loop.run_once()
+  assert handled == ['high', 'normal', 'low']
+
+
+def test_starvation_protection():
+  loop = FakeLoop()
+  scheduler = Scheduler(loop, budget=1, starvation_limit=3)
+  scheduler.add(NOISY)
+  scheduler.add(QUIET)
+
+  handled = []
+  scheduler.deliver(QUIET, handled.append, 'low', priority=Priority.LOW)
+  for k in range(10):
+    scheduler.deliver(NOISY, handled.append, 'high', priority=Priority.HIGH)
+  while loop.callbacks:
+    loop.run_once()
+  assert handled.index('low') == 3
+
+
+def test_installed_priority():
+  class ControlProcess(Process):
+    @Process.install('control', priority=Priority.HIGH)
+    def control(self, from_pid, body):
+      pass
+
+    @Process.install('bulk')
+    def bulk(self, from_pid, body):
+      pass
+
+  process = ControlProcess('control')
+  assert Priority.of(process.control) == Priority.HIGH
+  assert Priority.of(process.bulk) == Priority.NORMAL
+
+  with pytest.raises(ValueError):
+    Process.install('bad', priority=7)
+
+
+class CountingProcess(Process):
+  def __init__(self, name, expected):
+    self.expected = expected
+    self.received = 0
+    self.done = threading.Event()
+    super(CountingProcess, self).__init__(name)
+
+  @Process.install('count')
+  def count(self, from_pid, body):
+    self.received += 1
+    if self.received == self.expected:
+      self.done.set()
+
+
+def test_mailbox_metrics():
+  with ephemeral_context() as context:
+    receiver = CountingProcess('receiver', 10)
+    context.spawn(receiver)
+    sender = Process('sender')
+    context.spawn(sender)
+
+    for k in range(10):
+      sender.send(receiver.pid, 'count')
+    receiver.done.wait(timeout=5)
+    assert receiver.done.is_set()
+
+    snapshot = context.metrics.snapshot()
+    assert snapshot['receiver/mailbox/wait_time_secs/count'] == 10
+    assert snapshot['receiver/mailbox/depth'] == 0
+    assert context.mailbox_depth(receiver.pid) == 0
+
+
+class PriorityProcess(Process):
+  def __init__(self, name):
+    self.handled = []
+    self.done = threading.Event()
+    super(PriorityProcess, self).__init__(name)
+
+  @Process.install('burst')
+  def burst(self, from_pid, body):
+    for k in range(5):
+      self.send(self.pid, 'bulk')
+    self.send(self.pid, 'bulk', priority=Priority.LOW)
+    self.send(self.pid, 'control')
+
+  @Process.install('bulk')
+  def bulk(self, from_pid, body):
+    self.handled.append('bulk')
+
+  @Process.install('control', priority=Priority.HIGH)
+  def control(self, from_pid, body):
+    self.handled.append('control')
+    self.done.set()
+
+
+def test_control_messages_overtake_bulk():
+  with ephemeral_context() as context:
+    process = PriorityProcess('priority')
+    context.spawn(process)
+    process.send(process.pid, 'burst')
+
+    process.done.wait(timeout=5)
+    assert process.handled[0] == 'control'
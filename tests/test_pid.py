@@ -0,0 +1,74 @@
+import pickle
+
+from compactor.pid import PID
+from compactor.process import Process
+from compactor.testing import ephemeral_context
+
+import pytest
+
+
+def test_pid():
+  pid = PID('127.0.0.1', 5051, 'master(1)')
+  assert str(pid) == 'master(1)@127.0.0.1:5051'
+  assert repr(pid) == 'PID(127.0.0.1, 5051, master(1))'
+  assert pid.as_url() == 'http://127.0.0.1:5051/master(1)'
+  assert pid.as_url('ping') == 'http://127.0.0.1:5051/master(1)/ping'
+
+  same = PID('127.0.0.1', 5051, 'master(1)')
+  assert pid is not same
+  assert pid == same and not pid != same
+  assert hash(pid) == hash(same)
+  assert pid != PID('127.0.0.1', 5052, 'master(1)')
+  assert pid != PID('127.0.0.2', 5051, 'master(1)')
+  assert pid != PID('127.0.0.1', 5051, 'master(2)')
+  assert pid != str(pid)
+  assert len(set([pid, same, PID('127.0.0.1', 5051, 'slave(1)')])) == 2
+
+
+def test_intern():
+  pid = PID.intern('127.0.0.1', 5051, 'master(1)')
+  assert PID.intern('127.0.0.1', 5051, 'master(1)') is pid
+  assert PID.intern('127.0.0.1', 5051, 'master(2)') is not pid
+  assert PID.intern('127.0.0.1', 5051, 'master(1)') == PID('127.0.0.1', 5051, 'master(1)')
+
+
+def test_from_string():
+  pid = PID.from_string('master(1)@192.168.33.2:5051')
+  assert (pid.ip, pid.port, pid.id) == ('192.168.33.2', 5051, 'master(1)')
+  assert PID.from_string('master(1)@192.168.33.2:5051') is pid
+  assert PID.intern('192.168.33.2', 5051, 'master(1)') is pid
+
+  for invalid in ('master(1)', 'master(1)@192.168.33.2', 'master(1)@192.168.33.2:http',
+                  'a@b@192.168.33.2:5051'):
+    with pytest.raises(ValueError):
+      PID.from_string(invalid)
+
+
+def test_parse_cache_is_bounded():
+  for k in range(PID.PARSE_CACHE_SIZE * 2):
+    pid = PID.from_string('scheduler(%d)@127.0.0.1:5051' % k)
+    assert pid.id == 'scheduler(%d)' % k
+    assert len(PID._PARSED) <= PID.PARSE_CACHE_SIZE
+
+
+def test_pickle():
+  pid = PID.intern('127.0.0.1', 5051, 'master(1)')
+  for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+    assert pickle.loads(pickle.dumps(pid, protocol)) is pid
+
+
+class NamedProcess(Process):
+  pass
+
+
+def test_process_pid():
+  process = NamedProcess('named')
+  with pytest.raises(Process.UnboundProcess):
+    process.pid
+
+  with ephemeral_context() as context:
+    pid = context.spawn(process)
+    assert process.pid is pid
+    assert process.pid is process.pid
+    assert pid == PID(context.ip, context.port, 'named')
+    assert PID.from_string(str(pid)) is pid
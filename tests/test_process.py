@@ -1,7 +1,10 @@
-import uuid
+import socket
 import threading
+import time
+import uuid
 
 from compactor.context import Context
+from compactor.pid import PID
 from compactor.process import Process
 
 
@@ -87,3 +90,173 @@ def test_link_race_condition():
 
   context1.stop()
   context2.stop()
+
+
+def test_local_mailbox_index():
+  class IndexedProcess(Process):
+    @Process.install('ping')
+    def ping(self, from_pid, body):
+      pass
+
+  context = Context()
+  context.start()
+
+  try:
+    process = IndexedProcess('indexed')
+    pid = context.spawn(process)
+    assert context._get_local_mailbox(pid, 'ping') == process.ping
+    assert context._get_local_mailbox(pid, 'pong') is None
+
+    context.terminate(pid)
+    assert context._get_local_mailbox(pid, 'ping') is None
+  finally:
+    context.stop()
+
+
+class ExitRecordingProcess(Process):
+  def __init__(self, name, expected=1):
+    self.exits = []
+    self.expected = expected
+    self.done = threading.Event()
+    super(ExitRecordingProcess, self).__init__(name)
+
+  def exited(self, pid):
+    self.exits.append(pid)
+    if len(self.exits) == self.expected:
+      self.done.set()
+
+
+def test_terminate_notifies_only_linked_processes():
+  context = Context()
+  context.start()
+
+  try:
+    a, b, c, d, e = [ExitRecordingProcess(name) for name in 'abcde']
+    for process in (a, b, c, d, e):
+      context.spawn(process)
+    a.link(c.pid)
+    b.link(c.pid)
+    a.link(d.pid)
+
+    context.terminate(c.pid)
+    for process in (a, b):
+      process.done.wait(timeout=MAX_TIMEOUT)
+      assert process.exits == [c.pid]
+    assert context._linked_by == {d.pid: set([a.pid])}
+
+    # a terminated process is no longer linked, so it is not notified of exits
+    context.terminate(a.pid)
+    assert d.pid not in context._linked_by
+    assert a.pid not in context._links
+    context.terminate(d.pid)
+    assert a.exits == [c.pid]
+    assert e.exits == []
+  finally:
+    context.stop()
+
+
+def test_remote_exits_are_batched():
+  # a peer that accepts connections but never answers, so its connection misses heartbeats
+  blackhole = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  blackhole.bind(('127.0.0.1', 0))
+  blackhole.listen(8)
+  context = Context(heartbeat_interval=0.02, heartbeat_misses=2)
+  context.start()
+
+  try:
+    remotes = [PID('127.0.0.1', blackhole.getsockname()[1], 'remote(%d)' % k) for k in range(3)]
+    linker = ExitRecordingProcess('linker', expected=3)
+    context.spawn(linker)
+    for remote in remotes:
+      linker.link(remote)
+
+    linker.done.wait(timeout=MAX_TIMEOUT)
+    assert sorted(linker.exits, key=str) == sorted(remotes, key=str)
+    assert context._linked_by == {}
+    # every exit was delivered in a single mailbox message
+    assert context.metrics.snapshot()['linker/mailbox/wait_time_secs/count'] == 1
+  finally:
+    context.stop()
+    blackhole.close()
+
+
+class BaseHandlersProcess(Process):
+  @Process.install('ping')
+  def ping(self, from_pid, body):
+    pass
+
+  @Process.install('pong')
+  def pong(self, from_pid, body):
+    pass
+
+  @Process.route('/status')
+  def status(self, handler):
+    handler.write('base')
+
+
+class DerivedHandlersProcess(BaseHandlersProcess):
+  def __init__(self, name):
+    super(DerivedHandlersProcess, self).__init__(name)
+    # instance attributes do not shadow handlers
+    self.ping = None
+
+  def pong(self, from_pid, body):
+    pass
+
+  @Process.route('/status')
+  def derived_status(self, handler):
+    handler.write('derived')
+
+  @Process.install('derived')
+  def derived(self, from_pid, body):
+    pass
+
+
+def test_handler_tables():
+  base, derived = BaseHandlersProcess('base'), DerivedHandlersProcess('derived')
+  assert sorted(base.message_names) == ['ping', 'pong']
+  assert sorted(derived.message_names) == ['derived', 'ping']
+  assert list(base.route_paths) == list(derived.route_paths) == ['/status']
+
+  # tables are resolved once per class and shared by its instances
+  assert BaseHandlersProcess.handler_table() is base._handlers
+  assert BaseHandlersProcess('other')._handlers is base._handlers
+  assert DerivedHandlersProcess.handler_table() is not BaseHandlersProcess.handler_table()
+
+  handlers = dict(derived.message_handlers)
+  assert handlers['ping'].__self__ is derived
+  assert handlers['ping'].__func__ is BaseHandlersProcess.ping
+  assert dict(derived.iter_routes())['/status'].__func__ is DerivedHandlersProcess.derived_status
+
+
+class RenamedHandlersProcess(BaseHandlersProcess):
+  @Process.install('ping')
+  def renamed_ping(self, from_pid, body):
+    pass
+
+  @Process.route('/status')
+  def renamed_status(self, handler):
+    handler.write('renamed')
+
+
+def test_derived_handlers_take_precedence():
+  # methods of different names handling the same mailbox or route, in a base and derived class
+  table = RenamedHandlersProcess.handler_table()
+  assert table.mailboxes['ping'][0] is RenamedHandlersProcess.__dict__['renamed_ping']
+  assert table.routes['/status'][0] is RenamedHandlersProcess.__dict__['renamed_status']
+  assert table.mailboxes['pong'][0] is BaseHandlersProcess.__dict__['pong']
+
+
+def test_inherited_handlers_are_mounted():
+  context = Context()
+  context.start()
+
+  try:
+    process = DerivedHandlersProcess('derived')
+    pid = context.spawn(process)
+    assert context._get_local_mailbox(pid, 'ping').__func__ is BaseHandlersProcess.ping
+    assert context._get_local_mailbox(pid, 'pong') is None
+    assert context.http.router.lookup('/derived/ping') is not None
+    assert context.http.router.lookup('/derived/status') is not None
+  finally:
+    context.stop()
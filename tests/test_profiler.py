@@ -0,0 +1,107 @@
+import threading
+import time
+
+from compactor.process import Process
+from compactor.profiler import Profiler
+from compactor.testing import ephemeral_context
+
+import requests
+
+
+class BurnProcess(Process):
+  def __init__(self, name):
+    self.stopped = threading.Event()
+    super(BurnProcess, self).__init__(name)
+
+  @Process.install('burn')
+  def burn(self, from_pid, body):
+    deadline = time.time() + 0.02
+    while time.time() < deadline:
+      sum(range(1000))
+    if not self.stopped.is_set():
+      self.send(self.pid, 'burn')
+
+
+def profile(context, **params):
+  url = 'http://%s:%s/profiler/profile' % (context.ip, context.port)
+  return requests.get(url, params=params, timeout=30)
+
+
+def test_sampled_profile():
+  with ephemeral_context(profiling=True) as context:
+    process = BurnProcess('burner')
+    context.spawn(process)
+    process.send(process.pid, 'burn')
+    try:
+      response = profile(context, duration=0.5, format='json')
+    finally:
+      process.stopped.set()
+
+    assert response.status_code == 200
+    result = response.json()
+    assert result['mode'] == 'sample'
+    stacks = [line.rsplit(' ', 1)[0] for line in result['profile'].splitlines()]
+    assert any(stack.startswith('%s;burn;' % process.pid) for stack in stacks)
+    assert any(stack.endswith('test_profiler.py:burn') for stack in stacks)
+
+    handlers = dict(((handler['pid'], handler['name']), handler) for handler in result['handlers'])
+    burn = handlers[(str(process.pid), 'burn')]
+    assert burn['invocations'] > 0
+    assert burn['cpu_secs'] > 0
+
+
+def test_cprofile():
+  with ephemeral_context(profiling=True) as context:
+    process = BurnProcess('burner')
+    context.spawn(process)
+    process.send(process.pid, 'burn')
+    try:
+      response = profile(context, duration=0.2, mode='cprofile', sort='tottime')
+    finally:
+      process.stopped.set()
+    assert response.status_code == 200
+    assert 'test_profiler.py' in response.text
+    assert '(burn)' in response.text
+
+
+def test_one_profile_at_a_time():
+  with ephemeral_context(profiling=True) as context:
+    first = []
+    instruments = len(context._instruments)
+    thread = threading.Thread(target=lambda: first.append(profile(context, duration=0.5)))
+    thread.start()
+    deadline = time.time() + 5
+    while len(context._instruments) == instruments and time.time() < deadline:
+      time.sleep(0.01)
+    assert profile(context, duration=0.1).status_code == 409
+    thread.join()
+    assert first[0].status_code == 200
+    assert profile(context, duration=0.1).status_code == 200
+
+
+def test_invalid_profiles():
+  with ephemeral_context(profiling=True) as context:
+    assert profile(context, mode='guess').status_code == 400
+    assert profile(context, duration=0).status_code == 400
+    assert profile(context, duration=3600).status_code == 400
+    assert profile(context, duration='soon').status_code == 400
+    assert profile(context, mode='cprofile', sort='vibes').status_code == 400
+
+
+def test_profiling_is_opt_in():
+  with ephemeral_context() as context:
+    assert context.profiler is None
+    assert profile(context, duration=0.1).status_code == 404
+
+
+def test_failed_profile_does_not_block_the_next(monkeypatch):
+  def fail(cls, frame):
+    raise RuntimeError('sampler failed')
+
+  with ephemeral_context(profiling=True) as context:
+    instruments = len(context._instruments)
+    with monkeypatch.context() as patch:
+      patch.setattr(Profiler, '_collapse', classmethod(fail))
+      assert profile(context, duration=0.1).status_code == 500
+    assert len(context._instruments) == instruments
+    assert profile(context, duration=0.1).status_code == 200
@@ -0,0 +1,62 @@
+from compactor.cache import LRUCache
+from compactor.pid import PID
+from compactor.request import encode_request, encode_request_prefix, encode_request_segments
+
+import pytest
+
+FROM_PID = PID('127.0.0.1', 5051, 'sender')
+TO_PID = PID('127.0.0.1', 5052, 'receiver')
+
+
+def test_encode_request():
+  assert encode_request(FROM_PID, TO_PID, 'ping', body=b'hello') == (
+      b'POST /receiver/ping HTTP/1.0\r\n'
+      b'Connection: Keep-Alive\r\n'
+      b'Libprocess-From: sender@127.0.0.1:5051\r\n'
+      b'Content-Length: 5\r\n'
+      b'\r\n'
+      b'hello')
+
+  legacy = encode_request(FROM_PID, TO_PID, 'ping', content_type='text/plain', legacy=True)
+  assert b'User-Agent: libprocess/sender@127.0.0.1:5051\r\n' in legacy
+  assert b'Content-Type: text/plain\r\n' in legacy
+  assert legacy.endswith(b'Content-Length: 0\r\n\r\n')
+
+  with pytest.raises(TypeError):
+    encode_request(FROM_PID, TO_PID, 'ping', body=u'hello')
+
+
+def test_encode_request_segments():
+  body = b'x' * 1024
+  prefix, length, segment = encode_request_segments(FROM_PID, TO_PID, 'ping', body=body)
+  assert prefix is encode_request_prefix(FROM_PID, TO_PID, 'ping')
+  assert length == b'Content-Length: 1024\r\n\r\n'
+  assert segment is body
+
+  body = bytearray(b'hello')
+  assert encode_request(FROM_PID, TO_PID, 'ping', body=body) == (
+      b'POST /receiver/ping HTTP/1.0\r\n'
+      b'Connection: Keep-Alive\r\n'
+      b'Libprocess-From: sender@127.0.0.1:5051\r\n'
+      b'Content-Length: 5\r\n'
+      b'\r\n'
+      b'hello')
+  assert type(encode_request_segments(FROM_PID, TO_PID, 'ping', body=body)[2]) is bytes
+
+  assert len(encode_request_segments(FROM_PID, TO_PID, 'ping')) == 2
+
+
+def test_lru_cache():
+  cache = LRUCache(2)
+  cache.put('a', 1)
+  cache.put('b', 2)
+  assert cache.get('a') == 1
+  cache.put('c', 3)
+  assert 'b' not in cache
+  assert cache.get('b') is None
+  assert (cache.get('a'), cache.get('c')) == (1, 3)
+  assert (cache.hits, cache.misses) == (3, 1)
+  assert len(cache) == 2
+
+  with pytest.raises(ValueError):
+    LRUCache(0)
@@ -0,0 +1,104 @@
+import threading
+import time
+
+from compactor.metrics import Metrics
+from compactor.pid import PID
+from compactor.process import Process
+from compactor.testing import ephemeral_context
+from compactor.watchdog import handler_name, LoopMonitor, Watchdog
+
+import pytest
+import requests
+
+
+WATCHED = PID('127.0.0.1', 1, 'watched')
+
+
+def test_watchdog_threshold():
+  metrics = Metrics()
+  watchdog = Watchdog(threshold=0.5, metrics=metrics)
+
+  watchdog.on_handler_start(WATCHED, 'fast', time.time())
+  watchdog.on_handler_end(WATCHED, 'fast', 0.1)
+  watchdog.on_handler_start(WATCHED, 'slow', time.time())
+  watchdog.on_handler_end(WATCHED, 'slow', 0.6)
+
+  assert metrics.snapshot()['loop/slow_handlers'] == 1
+  status = watchdog.status()
+  assert status['running'] is None
+  assert [invocation['name'] for invocation in status['recent']] == ['slow']
+  assert status['recent'][0]['pid'] == str(WATCHED)
+  assert status['recent'][0]['elapsed_secs'] == 0.6
+
+
+def test_handler_name():
+  class Named(Process):
+    @Process.install('mailbox')
+    def handler(self, from_pid, body):
+      pass
+
+  assert handler_name(Named('named').handler) == 'mailbox'
+  assert handler_name(Named('named').initialize) == 'initialize'
+  assert handler_name('/route') == '/route'
+
+
+def test_invalid_watchdog_configuration():
+  with pytest.raises(ValueError):
+    Watchdog(threshold=0)
+  with pytest.raises(ValueError):
+    Watchdog(history=0)
+  with pytest.raises(ValueError):
+    LoopMonitor(None, interval=0)
+
+
+class SlowProcess(Process):
+  def __init__(self, name):
+    self.done = threading.Event()
+    super(SlowProcess, self).__init__(name)
+
+  @Process.install('stall')
+  def stall(self, from_pid, body):
+    time.sleep(0.3)
+    self.done.set()
+
+  @Process.route('/block')
+  def block(self, handler):
+    time.sleep(0.3)
+    handler.write('done')
+
+
+def test_slow_handlers_are_reported():
+  with ephemeral_context(loop_monitor_interval=0.01, slow_handler_threshold=0.1,
+                         capture_slow_stacks=True) as context:
+    process = SlowProcess('slow')
+    context.spawn(process)
+    process.send(process.pid, 'stall')
+    process.done.wait(timeout=5)
+    assert process.done.is_set()
+
+    url = 'http://%s:%s/slow/block' % (context.ip, context.port)
+    assert requests.get(url).text == 'done'
+
+    # The lag is only known once the monitor's next tick runs, which may be after this request.
+    url = 'http://%s:%s/loop/status' % (context.ip, context.port)
+    deadline = time.time() + 5
+    status = requests.get(url).json()
+    while status['monitor']['max_lag_secs'] < 0.1 and time.time() < deadline:
+      time.sleep(0.01)
+      status = requests.get(url).json()
+    recent = status['slow_handlers']['recent']
+    assert [invocation['name'] for invocation in recent] == ['stall', '/block']
+    assert all(invocation['pid'] == str(process.pid) for invocation in recent)
+    assert 'stall' in recent[0]['stack']
+    assert status['monitor']['max_lag_secs'] >= 0.1
+
+    snapshot = context.metrics.snapshot()
+    assert snapshot['loop/slow_handlers'] == 2
+    assert snapshot['loop/lag_secs/max'] >= 0.1
+
+
+def test_loop_monitoring_disabled():
+  with ephemeral_context(loop_monitor_interval=None, slow_handler_threshold=None) as context:
+    url = 'http://%s:%s/loop/status' % (context.ip, context.port)
+    assert requests.get(url).json() == {'monitor': None, 'slow_handlers': None}
+    assert 'loop/lag_secs/count' not in context.metrics.snapshot()